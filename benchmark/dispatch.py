@@ -0,0 +1,208 @@
+"""
+Compares the cost of selecting an opcode handler with an if/elif ladder
+(as `Chip8.execute` used to) against the `OpcodeTable` lookup cached on
+each `Instruction`.
+
+The handlers only count how often they run, so the difference between
+the two timings is the dispatch itself. Instructions are drawn from a
+fixed mix that roughly follows the opcode frequencies of common ROMs.
+
+Run untranslated with `python -m benchmark.dispatch [iterations]`, or
+translate it for meaningful numbers:
+
+```
+PYTHONPATH=. python pypy/rpython/bin/rpython benchmark/dispatch.py
+./dispatch-c [iterations]
+```
+"""
+
+import os
+import time
+
+from emulator.chip8 import *
+from emulator.optable import OpcodeTable
+
+# (opcode, weight) pairs
+MIX = [
+    (0x6012, 16), (0x7101, 12), (0x3200, 8), (0x4301, 6), (0x1200, 8),
+    (0x2300, 3), (0x00EE, 3), (0x8014, 4), (0x8122, 2), (0x8206, 1),
+    (0x8310, 2), (0xA300, 9), (0xD015, 7), (0xC00F, 2), (0xE09E, 2),
+    (0xF007, 3), (0xF015, 2), (0xF01E, 3), (0xF029, 1), (0xF065, 2),
+]
+
+
+class Counter:
+    def __init__(self):
+        self.counts = [0] * 16
+
+
+def count(counter, ins):
+    counter.counts[ins.ins_type >> 12] += 1
+
+
+def count_ladder(counter, ins):
+    ins_type = ins.ins_type
+    if ins_type == INS_SYSCALL:
+        count(counter, ins)
+    elif ins_type == INS_JUMP:
+        count(counter, ins)
+    elif ins_type == INS_CALL:
+        count(counter, ins)
+    elif ins_type == INS_IF_NE:
+        count(counter, ins)
+    elif ins_type == INS_IF_EQ:
+        count(counter, ins)
+    elif ins_type == INS_IF_NOT:
+        count(counter, ins)
+    elif ins_type == INS_IF:
+        count(counter, ins)
+    elif ins_type == INS_LOAD_IMM:
+        count(counter, ins)
+    elif ins_type == INS_ADD_IMM:
+        count(counter, ins)
+    elif ins_type == INS_ARITH:
+        op = ins.imm4
+        if op == AR_LD:
+            count(counter, ins)
+        elif op == AR_OR:
+            count(counter, ins)
+        elif op == AR_AND:
+            count(counter, ins)
+        elif op == AR_XOR:
+            count(counter, ins)
+        elif op == AR_ADD:
+            count(counter, ins)
+        elif op == AR_SUB:
+            count(counter, ins)
+        elif op == AR_SHR:
+            count(counter, ins)
+        elif op == AR_SUBN:
+            count(counter, ins)
+        elif op == AR_SHL:
+            count(counter, ins)
+    elif ins_type == INS_LOAD_INDEX_IMM:
+        count(counter, ins)
+    elif ins_type == INS_JUMP_OFFSET:
+        count(counter, ins)
+    elif ins_type == INS_RANDOM:
+        count(counter, ins)
+    elif ins_type == INS_DRAW:
+        count(counter, ins)
+    elif ins_type == INS_IFSYS:
+        op = ins.imm8
+        if op == IFSYS_KEY_DN:
+            count(counter, ins)
+        elif op == IFSYS_KEY_UP:
+            count(counter, ins)
+    elif ins_type == INS_SYSCALL1:
+        op = ins.imm8
+        if op == SYSCALL1_LOAD_DELAY:
+            count(counter, ins)
+        elif op == SYSCALL1_LOAD_KEY:
+            count(counter, ins)
+        elif op == SYSCALL1_SET_DELAY:
+            count(counter, ins)
+        elif op == SYSCALL1_SET_SOUND:
+            count(counter, ins)
+        elif op == SYSCALL1_ADD_INDEX:
+            count(counter, ins)
+        elif op == SYSCALL1_LOAD_INDEX_DIGIT:
+            count(counter, ins)
+        elif op == SYSCALL1_LOAD_BCD:
+            count(counter, ins)
+        elif op == SYSCALL1_REG_SAVE:
+            count(counter, ins)
+        elif op == SYSCALL1_REG_LOAD:
+            count(counter, ins)
+
+
+class CountingTable(OpcodeTable):
+    def __init__(self):
+        OpcodeTable.__init__(self, 12, 0xF)
+        arith = self.subtable(INS_ARITH, OpcodeTable(0, 0xF))
+        ifsys = self.subtable(INS_IFSYS, OpcodeTable(0, 0xFF))
+        syscall1 = self.subtable(INS_SYSCALL1, OpcodeTable(0, 0xFF))
+        for table in [self, arith, ifsys, syscall1]:
+            table.unhandler(count)
+
+
+COUNTING = CountingTable()
+
+
+class CountedInstruction:
+    # only the fields the dispatch looks at; using emulator.chip8.Instruction
+    # would also pull the emulator's own handlers into the translation
+    _immutable_fields_ = ['ins_type', 'imm8', 'imm4', 'count']
+
+    def __init__(self, ins):
+        self.ins_type = ins & 0xF000
+        self.imm8 = ins & 0x00FF
+        self.imm4 = ins & 0x000F
+        self.count = COUNTING.lookup(ins)
+
+
+def build_program():
+    program = []
+    for opcode, weight in MIX:
+        for i in xrange(weight):
+            program.append(CountedInstruction(opcode))
+    # interleave the opcodes, a sorted program would be too kind to
+    # the branch predictor
+    for i in xrange(len(program) - 1, 0, -1):
+        j = (i * 7919 + 13) % (i + 1)
+        program[i], program[j] = program[j], program[i]
+    return program
+
+
+def run_ladder(program, iterations):
+    counter = Counter()
+    for n in xrange(iterations):
+        for ins in program:
+            count_ladder(counter, ins)
+    return counter
+
+
+def run_table(program, iterations):
+    counter = Counter()
+    for n in xrange(iterations):
+        for ins in program:
+            ins.count(counter, ins)
+    return counter
+
+
+def report(name, dispatched, seconds):
+    if seconds <= 0.0:
+        seconds = 1e-9
+    rate = int(dispatched / seconds / 1e5)
+    os.write(1, '%s: %d instructions in %d ms, %d.%d M/s\n' % (
+        name, dispatched, int(seconds * 1000), rate / 10, rate % 10))
+
+
+def main(argv):
+    iterations = 10000
+    if len(argv) > 1:
+        iterations = int(argv[1])
+    program = build_program()
+    dispatched = len(program) * iterations
+
+    start = time.time()
+    ladder = run_ladder(program, iterations)
+    report('if/elif ladder', dispatched, time.time() - start)
+
+    start = time.time()
+    table = run_table(program, iterations)
+    report('opcode table  ', dispatched, time.time() - start)
+
+    if ladder.counts != table.counts:
+        os.write(2, 'dispatch mismatch\n')
+        return 1
+    return 0
+
+
+def target(driver, args):
+    return main
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,238 @@
+"""
+Runs a fixed set of workloads on the emulator and prints the results as
+JSON lines, so that numbers from different releases can be compared.
+
+Each workload is a small assembled loop that stresses one part of the
+emulator: arithmetic, drawing digits, drawing large sprites, key polling,
+and calls and returns. It is run in-process for a number of slices of
+emulated time, which gives:
+
+* `ips`: instructions per second over the whole run,
+* `warmup`: instructions per second of every slice, which shows how long
+  the JIT needs to settle,
+* `steady_ips`: the median of the second half of those slices.
+
+Untranslated, the round trip through `Stdio` and `Chip8_Rpc` to an
+emulator process is measured as well, as microseconds per `C_Cpu` command
+and per `C_RunReport` frame in both encodings. By default the emulator is
+the untranslated one; pass the translated binary with `--emulator`.
+
+```
+python -m benchmark.suite [--slices N] [--quantum US] [--emulator ./chip8-c]
+```
+
+Translated, only the in-process workloads are run; this is the number to
+compare between builds:
+
+```
+PYTHONPATH=. python pypy/rpython/bin/rpython -Ojit benchmark/suite.py
+./suite-c [slices [quantum]]
+```
+"""
+
+import os
+import time
+
+from assembler.chip8 import assemble
+from emulator.chip8 import Chip8, Io_Null
+from emulator.types import uint16_t
+
+# emulated time per slice, in microseconds; a few milliseconds of wall
+# time translated, a few seconds untranslated
+QUANTUM = 1000000000
+QUANTUM_UNTRANSLATED = 2000000
+
+WORKLOADS = [
+    ('arith', assemble("""
+    loop:
+        ADD V0, 1
+        ADD V1, V0
+        XOR V2, V1
+        SHR V3, V2
+        SUB V4, V0
+        OR V5, V4
+        JP loop
+    """.splitlines())),
+    ('draw', assemble("""
+        LD V2, 0x3F
+        LD V3, 0x1F
+    loop:
+        LD F, V0
+        DRW V0, V1, 5
+        ADD V0, 5
+        AND V0, V2
+        ADD V1, 3
+        AND V1, V3
+        JP loop
+    """.splitlines())),
+    ('sprite', assemble("""
+        LD I, 0x50
+        LD V2, 0x3F
+    loop:
+        DRW V0, V1, 15
+        ADD V0, 7
+        AND V0, V2
+        ADD V1, 1
+        JP loop
+    """.splitlines())),
+    ('keys', assemble("""
+    loop:
+        SKP V0
+        ADD V1, 1
+        SKNP V0
+        ADD V2, 1
+        ADD V0, 1
+        JP loop
+    """.splitlines())),
+    ('call', assemble("""
+    loop:
+        CALL outer
+        JP loop
+    outer:
+        ADD V0, 1
+        CALL inner
+        RET
+    inner:
+        ADD V1, V0
+        RET
+    """.splitlines())),
+]
+
+
+def median(values):
+    # insertion sort, there are only a few values
+    ordered = []
+    for value in values:
+        i = len(ordered)
+        ordered.append(value)
+        while i > 0 and ordered[i - 1] > value:
+            ordered[i] = ordered[i - 1]
+            i -= 1
+        ordered[i] = value
+    return ordered[len(ordered) / 2]
+
+
+def run_workload(code, slices, quantum):
+    """Returns the instructions, wall time and per-slice rates of code."""
+    chip8 = Chip8(None, Io_Null())
+    chip8.ram.load_bin(code)
+    # press every other key, so that polling takes both branches
+    chip8.keys = uint16_t(0x5555)
+    warmup = []
+    seconds = 0.0
+    for i in range(slices):
+        instructions = chip8.instructions
+        start = time.time()
+        chip8.run(quantum)
+        elapsed = time.time() - start
+        seconds += elapsed
+        warmup.append(rate(chip8.instructions - instructions, elapsed))
+    return chip8.instructions, seconds, warmup
+
+
+def rate(count, seconds):
+    if seconds <= 0.0:
+        seconds = 1e-9
+    return int(count / seconds)
+
+
+def workload_record(name, build, instructions, seconds, warmup):
+    rates = [str(r) for r in warmup]
+    return ('{"benchmark": "%s", "build": "%s", "instructions": %d, '
+            '"seconds_us": %d, "ips": %d, "steady_ips": %d, "warmup": [%s]}' % (
+                name, build, instructions, int(seconds * 1000000),
+                rate(instructions, seconds),
+                median(warmup[len(warmup) / 2:]), ', '.join(rates)))
+
+
+def run_workloads(build, slices, quantum):
+    for name, code in WORKLOADS:
+        instructions, seconds, warmup = run_workload(code, slices, quantum)
+        os.write(1, workload_record(name, build, instructions, seconds,
+                                    warmup) + '\n')
+
+
+def measure_rpc(command, encoding, rounds):
+    """Microseconds per C_Cpu command and per C_RunReport frame."""
+    import subprocess
+    import tempfile
+    from emulator.chip8 import Chip8_Rpc
+    from emulator.io.message import C_Cpu
+    from emulator.io.stdio import Stdio
+
+    fd, path = tempfile.mkstemp(suffix='.ch8')
+    os.write(fd, WORKLOADS[1][1])
+    os.close(fd)
+    proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    try:
+        chip8 = Chip8_Rpc(Stdio(proc.stdout, proc.stdin), Io_Null())
+        assert chip8.initialize(path, encoding)
+        start = time.time()
+        for i in range(rounds):
+            chip8._cmd(C_Cpu())
+        cpu = (time.time() - start) / rounds
+        start = time.time()
+        for i in range(rounds):
+            # one frame worth of emulated time
+            chip8.run(16667)
+        frame = (time.time() - start) / rounds
+        chip8.quit()
+        proc.wait()
+    finally:
+        os.remove(path)
+    return int(cpu * 1000000), int(frame * 1000000)
+
+
+def main(argv):
+    slices = 10
+    quantum = QUANTUM
+    if len(argv) > 1:
+        slices = int(argv[1])
+    if len(argv) > 2:
+        quantum = int(argv[2])
+    run_workloads('translated', slices, quantum)
+    return 0
+
+
+def target(driver, args):
+    from rpython.rlib import rfile
+    from emulator.error import errorstream
+
+    Chip8.BLOCK_MODE = not driver.config.translation.jit
+
+    def main_wrap(argv):
+        stdin, stdout, errorstream.stream = rfile.create_stdio()
+        return main(argv)
+
+    return main_wrap
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import sys
+
+    from emulator.error import errorstream
+    from emulator.io.stdio import ENCODINGS
+
+    errorstream.stream = sys.stderr
+    parser = argparse.ArgumentParser(prog='benchmark.suite')
+    parser.add_argument('--slices', type=int, default=10)
+    parser.add_argument('--quantum', type=int, default=QUANTUM_UNTRANSLATED,
+                        help='emulated time per slice, in microseconds')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--emulator', default=None,
+                        help='emulator binary for the round trip timings')
+    args = parser.parse_args()
+
+    run_workloads('untranslated', args.slices, args.quantum)
+    command = [sys.executable, '-m', 'emulator.chip8']
+    if args.emulator is not None:
+        command = [args.emulator]
+    for encoding in ENCODINGS:
+        cpu, frame = measure_rpc(command, encoding, args.rounds)
+        sys.stdout.write(json.dumps({
+            'benchmark': 'rpc', 'emulator': ' '.join(command),
+            'encoding': encoding, 'cpu_us': cpu, 'frame_us': frame,
+        }, sort_keys=True) + '\n')
@@ -0,0 +1,99 @@
+"""
+Runs a collection of ROMs headless and reports one JSON line per ROM.
+
+```
+python -m emulator.batch [-j WORKERS] [--cycles CYCLES] ROMDIR...
+```
+
+Every ROM gets its own `Chip8` with `Io_Null`, run for the given amount of
+emulated time (microseconds) or until it stops or waits for a key in
+`LD Vx, K`, since none is ever pressed. ROMs are spread over a
+pool of worker processes and reported in order, with the emulated time,
+instructions, wall time in seconds, a SHA-1 of the final display and the
+error count. Use PyPy to run the emulator at a useful speed.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+from emulator.chip8 import Chip8, Io_Null
+from emulator.error import errorstream
+
+
+def display_hash(display):
+    rows = [int(row) for row in display.data]
+    return hashlib.sha1(struct.pack('>%dQ' % len(rows), *rows)).hexdigest()
+
+
+def run_rom(path, cycles):
+    result = {'rom': path}
+    try:
+        chip8 = Chip8(None, Io_Null())
+        if not chip8.load(path):
+            result['exception'] = 'program too large'
+            return result
+        start = time.time()
+        chip8.run(cycles)
+        result['wall'] = time.time() - start
+    except Exception as e:
+        result['exception'] = '%s: %s' % (type(e).__name__, e)
+        return result
+    result['cycles'] = chip8.time
+    result['instructions'] = chip8.instructions
+    result['paused'] = chip8.paused
+    result['waiting'] = chip8.waiting_key >= 0
+    result['display'] = display_hash(chip8.display)
+    result['errors'] = chip8.errors
+    return result
+
+
+def _run_rom(args):
+    return run_rom(*args)
+
+
+def find_roms(paths):
+    roms = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                rom = os.path.join(path, name)
+                if os.path.isfile(rom):
+                    roms.append(rom)
+        else:
+            roms.append(path)
+    return roms
+
+
+def _init_worker():
+    errorstream.stream = sys.stderr
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='emulator.batch')
+    parser.add_argument('-j', '--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--cycles', type=int, default=10 ** 7,
+                        help='emulated time per ROM, in microseconds')
+    parser.add_argument('roms', nargs='+', help='ROM files or directories')
+    args = parser.parse_args(argv[1:])
+
+    jobs = [(rom, args.cycles) for rom in find_roms(args.roms)]
+    pool = multiprocessing.Pool(args.workers, _init_worker)
+    try:
+        for result in pool.imap(_run_rom, jobs):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,12 +1,22 @@
-from rpython.rlib import rrandom
+from rpython.rlib import jit, rpoll, rrandom, rsocket
+from rpython.rlib.objectmodel import always_inline
 
 from emulator.error import error, errorstream
 from emulator.io.dispatcher import Dispatcher
+from emulator.io.framebuffer import (
+    FramebufferError, FramebufferReader, FramebufferWriter)
 from emulator.io.message import *
-from emulator.io.stdio import Stdio
+from emulator.io.session import Connection
+from emulator.io.stdio import Stdio, ENCODINGS, ENCODING_TEXT, ENCODING_BINARY
+from emulator.optable import OpcodeTable
+from emulator.profile import Profile
+from emulator.record import (
+    EVENT_KEYS, EVENT_STEP, Recorder, RecordError, read_log, replay)
+from emulator.rewind import Rewind
+from emulator.snapshot import snapshot, restore
 from emulator.types import *
 
-__version__ = '0.1.0'
+__version__ = '0.5.0'
 
 from rpython.rlib.rarithmetic import intmask
 
@@ -55,6 +65,11 @@ SYSCALL1_LOAD_BCD =           0x33
 SYSCALL1_REG_SAVE =           0x55
 SYSCALL1_REG_LOAD =           0x65
 
+OPCODES = OpcodeTable(12, 0xF)
+ARITH = OPCODES.subtable(INS_ARITH, OpcodeTable(0, 0xF))
+IFSYS = OPCODES.subtable(INS_IFSYS, OpcodeTable(0, 0xFF))
+SYSCALL1 = OPCODES.subtable(INS_SYSCALL1, OpcodeTable(0, 0xFF))
+
 
 class Cpu:
     def __init__(self):
@@ -64,115 +79,231 @@ class Cpu:
         self.general_registers = [uint8_t(0)] * 16
 
 
+class Instruction:
+    _immutable_fields_ = ['ins', 'ins_type', 'imm12', 'imm8', 'imm4',
+                          'imm_r1', 'imm_r2', 'cost', 'handler']
+
+    def __init__(self, ins):
+        self.ins = ins
+        self.ins_type = ins & 0xF000
+        self.imm12 = ins & 0x0FFF
+        self.imm8 = ins & 0x00FF
+        self.imm4 = ins & 0x000F
+        self.imm_r1 = (ins & 0x0F00) >> 8
+        self.imm_r2 = (ins & 0x00F0) >> 4
+        self.cost = instruction_cost(self)
+        self.handler = OPCODES.lookup(ins)
+
+
+def instruction_cost(ins):
+    """
+    Returns the static cost of an instruction. Costs that depend on
+    machine state (skipping, drawing, BCD) are added during execution.
+    """
+    ins_type = ins.ins_type
+    if ins_type == INS_SYSCALL:
+        if ins.imm12 == SYSCALL_CLEAR:
+            return 109
+        elif ins.imm12 == SYSCALL_RETURN:
+            return 0
+        return 100
+    elif ins_type == INS_JUMP or ins_type == INS_CALL:
+        return 105
+    elif ins_type == INS_IF_NE or ins_type == INS_IF_EQ:
+        return 46
+    elif ins_type == INS_IF_NOT or ins_type == INS_IF:
+        if ins.imm4 == IF_EQ:
+            return 73
+        return 0
+    elif ins_type == INS_LOAD_IMM:
+        return 27
+    elif ins_type == INS_ADD_IMM:
+        return 45
+    elif ins_type == INS_ARITH:
+        return 200
+    elif ins_type == INS_LOAD_INDEX_IMM:
+        return 55
+    elif ins_type == INS_JUMP_OFFSET:
+        return 105
+    elif ins_type == INS_RANDOM:
+        return 164
+    elif ins_type == INS_DRAW:
+        return 0
+    elif ins_type == INS_IFSYS:
+        if ins.imm8 == IFSYS_KEY_DN or ins.imm8 == IFSYS_KEY_UP:
+            return 64
+        return 100
+    else:  # INS_SYSCALL1
+        imm8 = ins.imm8
+        if imm8 == SYSCALL1_LOAD_DELAY:
+            return 45
+        elif imm8 == SYSCALL1_LOAD_KEY:
+            return 100
+        elif imm8 == SYSCALL1_SET_DELAY or imm8 == SYSCALL1_SET_SOUND:
+            return 45
+        elif imm8 == SYSCALL1_ADD_INDEX:
+            return 72
+        elif imm8 == SYSCALL1_LOAD_INDEX_DIGIT:
+            return 91
+        elif imm8 == SYSCALL1_LOAD_BCD:
+            return 364
+        elif imm8 == SYSCALL1_REG_SAVE or imm8 == SYSCALL1_REG_LOAD:
+            return 64 * intmask(ins.imm_r1 + 1)
+        return 100
+
+
+def instruction_ends_block(ins):
+    """
+    Returns whether a basic block ends after this instruction, because it
+    may change the control flow or write to memory.
+    """
+    ins_type = ins.ins_type
+    if ins_type == INS_SYSCALL:
+        return ins.imm12 == SYSCALL_RETURN
+    elif ins_type == INS_SYSCALL1:
+        return (ins.imm8 == SYSCALL1_LOAD_KEY or
+                ins.imm8 == SYSCALL1_LOAD_BCD or
+                ins.imm8 == SYSCALL1_REG_SAVE)
+    return (ins_type == INS_JUMP or ins_type == INS_CALL or
+            ins_type == INS_IF_NE or ins_type == INS_IF_EQ or
+            ins_type == INS_IF_NOT or ins_type == INS_IF or
+            ins_type == INS_JUMP_OFFSET or ins_type == INS_IFSYS)
+
+
+def instruction_starts_block(ins):
+    """
+    Returns whether a basic block must start at this instruction, because
+    it passes the current time to the io or the timers.
+    """
+    if ins.ins_type == INS_SYSCALL1:
+        return (ins.imm8 == SYSCALL1_LOAD_DELAY or
+                ins.imm8 == SYSCALL1_SET_DELAY or
+                ins.imm8 == SYSCALL1_SET_SOUND)
+    return False
+
+
+class Block:
+    """
+    A sequence of instructions that is executed as a unit. The static costs
+    of all instructions are accounted for once, after the last one.
+    """
+
+    def __init__(self, start, instructions, version):
+        self.start = start
+        self.instructions = instructions
+        self.version = version
+        cost = 0
+        for ins in instructions:
+            cost += ins.cost
+        self.cost = cost
+        # cost of one iteration if the block starts an idle loop, see
+        # Chip8.idle_loop_cost
+        self.loop_cost = 0
+
+
+class CodeVersion:
+    pass
+
+
+FONT_ADDRESS = 0x50
+FONT = ''.join([chr(row) for row in [
+    # 0
+    0b01100000, 0b10010000, 0b10010000, 0b10010000, 0b01100000,
+    # 1
+    0b00100000, 0b01100000, 0b00100000, 0b00100000, 0b01110000,
+    # 2
+    0b11110000, 0b00010000, 0b11110000, 0b10000000, 0b11110000,
+    # 3
+    0b11110000, 0b00010000, 0b11110000, 0b00010000, 0b11110000,
+    # 4
+    0b10010000, 0b10010000, 0b11110000, 0b00010000, 0b00010000,
+    # 5
+    0b11110000, 0b10000000, 0b11110000, 0b00010000, 0b11110000,
+    # 6
+    0b11110000, 0b10000000, 0b11110000, 0b10010000, 0b11110000,
+    # 7
+    0b11110000, 0b00010000, 0b00100000, 0b01000000, 0b01000000,
+    # 8
+    0b11110000, 0b10010000, 0b11110000, 0b10010000, 0b11110000,
+    # 9
+    0b11110000, 0b10010000, 0b11110000, 0b00010000, 0b11110000,
+    # A
+    0b11110000, 0b10010000, 0b11110000, 0b10010000, 0b10010000,
+    # B
+    0b11100000, 0b10010000, 0b11100000, 0b10010000, 0b11100000,
+    # C
+    0b11110000, 0b10000000, 0b10000000, 0b10000000, 0b11110000,
+    # D
+    0b11100000, 0b10010000, 0b10010000, 0b10010000, 0b11100000,
+    # E
+    0b11110000, 0b10000000, 0b11110000, 0b10000000, 0b11110000,
+    # F
+    0b11110000, 0b10000000, 0b11110000, 0b10000000, 0b10000000,
+]])
+
+
+# memory is divided into pages to track which parts changed
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGES = 0x1000 >> PAGE_SHIFT
+
+
 class Memory:
+    _immutable_fields_ = ['code_version?']
+
     def __init__(self):
-        self.contents = [uint8_t(0)] * 0x1000
-        self.load_font()
-
-    def load_font(self):
-        # 0
-        self.contents[0x50] = uint8_t(0b01100000)
-        self.contents[0x51] = uint8_t(0b10010000)
-        self.contents[0x52] = uint8_t(0b10010000)
-        self.contents[0x53] = uint8_t(0b10010000)
-        self.contents[0x54] = uint8_t(0b01100000)
-        # 1
-        self.contents[0x55] = uint8_t(0b00100000)
-        self.contents[0x56] = uint8_t(0b01100000)
-        self.contents[0x57] = uint8_t(0b00100000)
-        self.contents[0x58] = uint8_t(0b00100000)
-        self.contents[0x59] = uint8_t(0b01110000)
-        # 2
-        self.contents[0x5A] = uint8_t(0b11110000)
-        self.contents[0x5B] = uint8_t(0b00010000)
-        self.contents[0x5C] = uint8_t(0b11110000)
-        self.contents[0x5D] = uint8_t(0b10000000)
-        self.contents[0x5E] = uint8_t(0b11110000)
-        # 3
-        self.contents[0x5F] = uint8_t(0b11110000)
-        self.contents[0x60] = uint8_t(0b00010000)
-        self.contents[0x61] = uint8_t(0b11110000)
-        self.contents[0x62] = uint8_t(0b00010000)
-        self.contents[0x63] = uint8_t(0b11110000)
-        # 4
-        self.contents[0x64] = uint8_t(0b10010000)
-        self.contents[0x65] = uint8_t(0b10010000)
-        self.contents[0x66] = uint8_t(0b11110000)
-        self.contents[0x67] = uint8_t(0b00010000)
-        self.contents[0x68] = uint8_t(0b00010000)
-        # 5
-        self.contents[0x69] = uint8_t(0b11110000)
-        self.contents[0x6A] = uint8_t(0b10000000)
-        self.contents[0x6B] = uint8_t(0b11110000)
-        self.contents[0x6C] = uint8_t(0b00010000)
-        self.contents[0x6D] = uint8_t(0b11110000)
-        # 6
-        self.contents[0x6E] = uint8_t(0b11110000)
-        self.contents[0x6F] = uint8_t(0b10000000)
-        self.contents[0x70] = uint8_t(0b11110000)
-        self.contents[0x71] = uint8_t(0b10010000)
-        self.contents[0x72] = uint8_t(0b11110000)
-        # 7
-        self.contents[0x73] = uint8_t(0b11110000)
-        self.contents[0x74] = uint8_t(0b00010000)
-        self.contents[0x75] = uint8_t(0b00100000)
-        self.contents[0x76] = uint8_t(0b01000000)
-        self.contents[0x77] = uint8_t(0b01000000)
-        # 8
-        self.contents[0x78] = uint8_t(0b11110000)
-        self.contents[0x79] = uint8_t(0b10010000)
-        self.contents[0x7A] = uint8_t(0b11110000)
-        self.contents[0x7B] = uint8_t(0b10010000)
-        self.contents[0x7C] = uint8_t(0b11110000)
-        # 9
-        self.contents[0x7D] = uint8_t(0b11110000)
-        self.contents[0x7E] = uint8_t(0b10010000)
-        self.contents[0x7F] = uint8_t(0b11110000)
-        self.contents[0x80] = uint8_t(0b00010000)
-        self.contents[0x81] = uint8_t(0b11110000)
-        # A
-        self.contents[0x82] = uint8_t(0b11110000)
-        self.contents[0x83] = uint8_t(0b10010000)
-        self.contents[0x84] = uint8_t(0b11110000)
-        self.contents[0x85] = uint8_t(0b10010000)
-        self.contents[0x86] = uint8_t(0b10010000)
-        # B
-        self.contents[0x87] = uint8_t(0b11100000)
-        self.contents[0x88] = uint8_t(0b10010000)
-        self.contents[0x89] = uint8_t(0b11100000)
-        self.contents[0x8A] = uint8_t(0b10010000)
-        self.contents[0x8B] = uint8_t(0b11100000)
-        # C
-        self.contents[0x8C] = uint8_t(0b11110000)
-        self.contents[0x8D] = uint8_t(0b10000000)
-        self.contents[0x8E] = uint8_t(0b10000000)
-        self.contents[0x8F] = uint8_t(0b10000000)
-        self.contents[0x90] = uint8_t(0b11110000)
-        # D
-        self.contents[0x91] = uint8_t(0b11100000)
-        self.contents[0x92] = uint8_t(0b10010000)
-        self.contents[0x93] = uint8_t(0b10010000)
-        self.contents[0x94] = uint8_t(0b10010000)
-        self.contents[0x95] = uint8_t(0b11100000)
-        # E
-        self.contents[0x96] = uint8_t(0b11110000)
-        self.contents[0x97] = uint8_t(0b10000000)
-        self.contents[0x98] = uint8_t(0b11110000)
-        self.contents[0x99] = uint8_t(0b10000000)
-        self.contents[0x9A] = uint8_t(0b11110000)
-        # F
-        self.contents[0x9B] = uint8_t(0b11110000)
-        self.contents[0x9C] = uint8_t(0b10000000)
-        self.contents[0x9D] = uint8_t(0b11110000)
-        self.contents[0x9E] = uint8_t(0b10000000)
-        self.contents[0x9F] = uint8_t(0b10000000)
+        # one byte per address; bytearray is a flat char array once
+        # translated, so slicing and concatenating it are bulk copies
+        self.contents = bytearray('\0' * 0x1000)
+        # decoded instruction at each address, None if not yet decoded; at
+        # one pointer per address this is larger than contents, but decode()
+        # must stay a single index for the JIT and block mode
+        self.decoded = [None] * 0x1000
+        self.code_version = CodeVersion()
+        # pages written since the last call to take_dirty_pages()
+        self.dirty_pages = [False] * PAGES
+        self.store_bytes(FONT_ADDRESS, FONT)
 
     def load_bin(self, data):
-        for i, v in enumerate(data):
-            self.contents[0x200 + i] = uint8_t(ord(v))
+        """
+        Stores a program at 0x200. Returns False, and stores nothing, if it
+        does not fit.
+        """
+        if len(data) > 0x1000 - 0x200:
+            return False
+        self.store_bytes(0x200, data)
+        return True
+
+    def invalidate_code(self):
+        # replacing the version object invalidates all JIT-compiled loops
+        # that constant-folded instructions decoded from this memory
+        self.code_version = CodeVersion()
+
+    def invalidate(self, addr):
+        # the byte at addr is part of the instructions at addr - 1 and addr
+        changed = False
+        if self.decoded[addr] is not None:
+            self.decoded[addr] = None
+            changed = True
+        if addr > 0 and self.decoded[addr - 1] is not None:
+            self.decoded[addr - 1] = None
+            changed = True
+        if changed:
+            self.invalidate_code()
+
+    def decode(self, addr):
+        return self._decode(self.code_version, addr)
+
+    @jit.elidable
+    def _decode(self, version, addr):
+        ins = self.decoded[addr]
+        if ins is None:
+            ins = Instruction(self.read16(addr))
+            self.decoded[addr] = ins
+        return ins
 
     def read8(self, addr):
-        return self.contents[addr]
+        return uint8_t(self.contents[addr])
 
     def read16(self, addr):
         a = uint16_t(self.contents[addr])
@@ -180,14 +311,100 @@ class Memory:
         return (a << 8) | b
 
     def store8(self, addr, val):
-        self.contents[addr] = val
+        self.contents[addr] = intmask(val)
+        self.dirty_pages[intmask(addr) >> PAGE_SHIFT] = True
+        self.invalidate(addr)
+
+    def store_bytes(self, addr, data):
+        end = addr + len(data)
+        assert 0 < addr and end <= 0x1000
+        # bytearray slice assignment is not RPython, but this still
+        # copies whole slices instead of going byte by byte
+        self.contents = self.contents[:addr] + data + self.contents[end:]
+        for i in xrange(addr - 1, end):
+            self.decoded[i] = None
+        self.mark_dirty(addr, end)
+        self.invalidate_code()
+
+    def mark_dirty(self, start, end):
+        for page in xrange(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+            self.dirty_pages[page] = True
+
+    def take_dirty_pages(self):
+        pages = []
+        for page in range(PAGES):
+            if self.dirty_pages[page]:
+                pages.append(page)
+                self.dirty_pages[page] = False
+        return pages
+
+    def read_page(self, page):
+        start = page << PAGE_SHIFT
+        assert start >= 0
+        return str(self.contents[start:start + PAGE_SIZE])
+
+    def write_page(self, page, data):
+        """Replaces a page, keeping what is decoded where unchanged."""
+        assert len(data) == PAGE_SIZE
+        addr = page << PAGE_SHIFT
+        for i in xrange(PAGE_SIZE):
+            if self.contents[addr] != ord(data[i]):
+                self.contents[addr] = ord(data[i])
+                self.dirty_pages[page] = True
+                self.invalidate(uint16_t(addr))
+            addr += 1
+
+    def restore(self, data):
+        """Replaces all contents, keeping what is decoded where unchanged."""
+        assert len(data) == 0x1000
+        first = 0
+        while first < 0x1000 and self.contents[first] == ord(data[first]):
+            first += 1
+        if first == 0x1000:
+            return
+        last = 0x1000 - 1
+        while self.contents[last] == ord(data[last]):
+            last -= 1
+        self.contents = bytearray(data)
+        self.mark_dirty(first, last + 1)
+        changed = False
+        for i in xrange(max(first - 1, 0), last + 1):
+            if self.decoded[i] is not None:
+                self.decoded[i] = None
+                changed = True
+        if changed:
+            self.invalidate_code()
 
     def store16(self, addr, val):
-        self.contents[addr] = uint8_t((val & 0xFF00) >> 8)
-        self.contents[addr + 1] = uint8_t(val & 0xFF)
+        self.contents[addr] = intmask((val & 0xFF00) >> 8)
+        self.contents[addr + 1] = intmask(val & 0xFF)
+        self.dirty_pages[intmask(addr) >> PAGE_SHIFT] = True
+        self.dirty_pages[intmask(addr + 1) >> PAGE_SHIFT] = True
+        self.invalidate(addr)
+        self.invalidate(addr + 1)
 
     def digit(self, d):
-        return uint16_t(0x50 + d * 5)
+        return uint16_t(FONT_ADDRESS + d * 5)
+
+
+def sprite_masks():
+    """
+    Returns the row masks of all sprite bytes at all x positions: the
+    byte b drawn at x is masks[x << 8 | b], cut off at the right edge.
+    """
+    masks = []
+    for x in range(64):
+        for byte in range(256):
+            m = uint64_t(byte)
+            if x <= 56:
+                m = m << (56 - x)
+            else:
+                m = m >> (x - 56)
+            masks.append(m)
+    return masks
+
+
+SPRITE_MASKS = sprite_masks()
 
 
 class Display:
@@ -195,39 +412,112 @@ class Display:
         self.width = 64
         self.height = 32
         self.data = [uint64_t(0)] * self.height
+        # rows changed since the last call to take_dirty()
+        self.dirty = [False] * self.height
+        # the same since the last call to take_changed(), for the rewind
+        # buffer; unlike dirty, sending the display does not reset these
+        self.changed = [False] * self.height
 
     def clear(self):
         for i in range(self.height):
-            self.data[i] = uint64_t(0)
+            if self.data[i] != 0:
+                self.data[i] = uint64_t(0)
+                self.dirty[i] = True
+                self.changed[i] = True
+
+    def draw_sprite(self, x, y, sprite, start, n):
+        """
+        XORs the n bytes of sprite from start on onto rows y to y + n - 1
+        at x, which must all be on the display. Returns whether a pixel
+        was turned off.
+        """
+        base = x << 8
+        erased = uint64_t(0)
+        for i in range(n):
+            m = SPRITE_MASKS[base | sprite[(start + i) & 0xFFF]]
+            if m != 0:
+                row = y + i
+                erased |= self.data[row] & m
+                self.data[row] ^= m
+                self.dirty[row] = True
+                self.changed[row] = True
+        return erased != 0
+
+    def take_dirty(self):
+        rows = []
+        for i in range(self.height):
+            if self.dirty[i]:
+                rows.append(i)
+                self.dirty[i] = False
+        return rows
 
-    def draw(self, x, y, m):
-        m = uint64_t(m)
-        if x <= 56:
-            m = m << (56 - x)
-        else:
-            m = m >> (x - 56)
-        self.data[y] ^= m
-        return self.data[y] & m != m
+    def take_changed(self):
+        rows = []
+        for i in range(self.height):
+            if self.changed[i]:
+                rows.append(i)
+                self.changed[i] = False
+        return rows
+
+    def mark_clean(self):
+        for i in range(self.height):
+            self.dirty[i] = False
+
+    def mark_dirty(self):
+        for i in range(self.height):
+            self.dirty[i] = True
+            self.changed[i] = True
+
+
+# by default the delay and sound timers count down at 60 Hz of emulated
+# time; a frontend running faster or slower than real time sets a longer or
+# shorter period, see C_TimerPeriod
+TIMER_PERIOD = 1000000 / 60
+
+
+class Timer:
+    def __init__(self):
+        # time at which the timer reaches zero
+        self.end = 0
+        # emulated time per count
+        self.period = TIMER_PERIOD
+
+    def set(self, time, value):
+        self.end = time + intmask(value) * self.period
+
+    def get(self, time):
+        left = self.end - time
+        if left <= 0:
+            return uint8_t(0)
+        return uint8_t((left + self.period - 1) / self.period)
+
+    def set_period(self, time, period):
+        """Changes the period, keeping the current count."""
+        value = self.get(time)
+        self.period = period
+        if self.end > time:
+            self.set(time, value)
+
+    def is_running(self, time):
+        return self.end > time
 
 
 class Io:
     def sync(self, time):
         raise NotImplementedError, 'abstract base class'
 
-    def is_key_down(self, key):
+    def set_sound(self, on):
         raise NotImplementedError, 'abstract base class'
 
-    def next_key(self):
-        raise NotImplementedError, 'abstract base class'
 
-    def set_sound(self, delay):
-        raise NotImplementedError, 'abstract base class'
+class Io_Null(Io):
+    """Io for headless runs, there is no output."""
 
-    def set_delay(self, delay):
-        raise NotImplementedError, 'abstract base class'
+    def sync(self, time):
+        pass
 
-    def get_delay(self):
-        raise NotImplementedError, 'abstract base class'
+    def set_sound(self, on):
+        pass
 
 
 class Io_Rpc(Io):
@@ -237,31 +527,26 @@ class Io_Rpc(Io):
     def sync(self, time):
         self.pipe.tell(M_Sync(time))
 
-    def is_key_down(self, key):
-        ans = self.pipe.ask(Q_KeyDown(key))
-        assert isinstance(ans, A_KeyDown)
-        return ans.down
+    def set_sound(self, on):
+        self.pipe.tell(M_Sound(on))
 
-    def next_key(self):
-        ans = self.pipe.ask(Q_NextKey())
-        assert isinstance(ans, A_NextKey)
-        return ans.key
 
-    def set_sound(self, delay):
-        self.pipe.tell(M_SetSoundTimer(delay))
+def get_printable_location(pc, ram):
+    return uint2hex(16, pc) + ': ' + uint2hex(16, ram.read16(pc))
 
-    def set_delay(self, delay):
-        self.pipe.tell(M_SetDelayTimer(delay))
 
-    def get_delay(self):
-        ans = self.pipe.ask(Q_DelayTimer())
-        assert isinstance(ans, A_DelayTimer)
-        return ans.delay
+jitdriver = jit.JitDriver(greens=['pc', 'ram'], reds=['self'],
+                          get_printable_location=get_printable_location)
 
 
 class Chip8:
     DISPATCH = Dispatcher()
 
+    # run() executes cached basic blocks instead of single instructions;
+    # translated with the JIT this is switched off to trace instructions,
+    # and replay sets it per machine to the mode of the recording
+    BLOCK_MODE = True
+
     def __init__(self, pipe, io):
         assert isinstance(io, Io)
 
@@ -271,13 +556,58 @@ class Chip8:
         self.cpu = Cpu()
         self.ram = Memory()
         self.display = Display()
+        # shared framebuffer the display is published to, see C_Framebuffer
+        self.framebuffer = None
+        # opcode and address counters while profiling, see C_Profile
+        self.profile = None
+        # checkpoints to step back to, see C_Rewind
+        self.rewind = None
+        # input log being written, see C_Record
+        self.recorder = None
+        self.delay_timer = Timer()
+        self.sound_timer = Timer()
         self.io = io
+        # whether io was last told to play sound
+        self.sound = False
+        # keypad state, bit n is set while key n is held down
+        self.keys = uint16_t(0)
+        # while LD Vx, K waits: x, and the keys that were already down;
+        # -1 if not waiting, see poll_key
+        self.waiting_key = -1
+        self.waiting_held = uint16_t(0)
+
+        self.blocks = [None] * 0x1000
 
         self.time = 0
+        # number of instructions executed
+        self.instructions = 0
         self.watchdog = 2**30
         self.errors = 0
         self.paused = False
 
+    def command(self, c):
+        """Executes a command, returns False if it was C_Die."""
+        if c is None:
+            pass
+        elif isinstance(c, C_Die):
+            return False
+        else:
+            self.DISPATCH.dispatch(self, c)
+        return True
+
+    def is_runnable(self):
+        """
+        Whether the machine is neither paused nor waiting in LD Vx, K.
+        Only poll_key(), or run(), ends a wait.
+        """
+        return self.waiting_key < 0 and not self.paused
+
+    def close(self):
+        if self.framebuffer is not None:
+            self.framebuffer.close()
+            self.framebuffer = None
+        self.stop_recording(self.time)
+
     def stack_push(self, val):
         self.ram.store16(self.cpu.stack_pointer, val)
         self.cpu.stack_pointer += 2
@@ -290,220 +620,627 @@ class Chip8:
     def cmd_run(self, msg):
         self.run(msg.watchdog)
 
+    @DISPATCH.handler(C_RunReport)
+    def cmd_run_report(self, msg):
+        self.set_keys(msg.keys)
+        self.run(intmask(msg.watchdog))
+        self.pipe.tell(M_Cpu(self))
+        rows = self.take_dirty()
+        if self.framebuffer is None:
+            self.pipe.tell(M_DisplayDelta(self.display, rows))
+
+    def take_dirty(self):
+        rows = self.display.take_dirty()
+        if self.framebuffer is not None:
+            self.framebuffer.publish(self.display.data, rows)
+        return rows
+
     def run(self, time=2**30):
         self.watchdog = self.time + time
-        while not self.paused and (self.watchdog - self.time) > 0:
-            self.step()
+        if self.waiting_key >= 0 and not self.poll_key():
+            # nothing runs until a key goes down, but time passes
+            self.time = self.watchdog
+        elif self.profile is not None:
+            self.run_profiled()
+        elif self.BLOCK_MODE:
+            self.run_blocks()
+        else:
+            self.run_interpreter()
+        if self.rewind is not None:
+            self.rewind.maybe_checkpoint(self)
+        self.update_sound()
         self.io.sync(self.time)
 
+    @DISPATCH.handler(C_Keys)
+    def cmd_keys(self, msg):
+        self.set_keys(msg.keys)
+
+    def set_keys(self, keys):
+        if keys != self.keys and self.recorder is not None:
+            self.record_event(EVENT_KEYS, intmask(keys))
+        self.keys = keys
+
+    def poll_key(self):
+        """
+        Ends the wait of LD Vx, K if a key went down since it started or
+        since the last poll. Returns whether the wait is over.
+        """
+        pressed = intmask(self.keys) & ~intmask(self.waiting_held)
+        self.waiting_held = self.keys
+        for key in range(16):
+            if (pressed >> key) & 1:
+                self.cpu.general_registers[self.waiting_key] = uint8_t(key)
+                self.waiting_key = -1
+                return True
+        return False
+
+    def is_key_down(self, key):
+        return (intmask(self.keys) >> intmask(key & 0xF)) & 1 != 0
+
+    def update_sound(self):
+        on = self.sound_timer.is_running(self.time)
+        if on != self.sound:
+            self.sound = on
+            self.io.set_sound(on)
+
+    def run_interpreter(self):
+        ram = self.ram
+        pc = self.cpu.program_counter
+        while True:
+            jitdriver.jit_merge_point(pc=pc, ram=ram, self=self)
+            if self.paused or (self.watchdog - self.time) <= 0:
+                break
+            self.execute(pc, ram.decode(pc))
+            if self.cpu.program_counter <= pc:
+                # backward jump, this may be a hot loop
+                pc = self.cpu.program_counter
+                jitdriver.can_enter_jit(pc=pc, ram=ram, self=self)
+            else:
+                pc = self.cpu.program_counter
+
+    def run_blocks(self):
+        # the watchdog is only checked between blocks, so a run may take
+        # slightly longer than requested
+        while not self.paused and (self.watchdog - self.time) > 0:
+            pc = self.cpu.program_counter
+            block = self.blocks[pc]
+            if block is None or block.version is not self.ram.code_version:
+                block = self.build_block(pc)
+                self.blocks[pc] = block
+            if block.loop_cost > 0 and self.skip_idle_loop(block):
+                continue
+            self.execute_block(block)
+
+    def build_block(self, pc):
+        version = self.ram.code_version
+        instructions = []
+        addr = pc
+        while True:
+            ins = self.ram.decode(addr)
+            if instructions and instruction_starts_block(ins):
+                break
+            instructions.append(ins)
+            addr += 2
+            if instruction_ends_block(ins) or addr >= 0xFFF:
+                break
+        block = Block(pc, instructions, version)
+        block.loop_cost = self.idle_loop_cost(block)
+        return block
+
+    def idle_loop_cost(self, block):
+        """
+        Returns the time one iteration takes if block starts an idle loop,
+        0 otherwise. An idle loop only tests the delay timer or a key and
+        jumps back:
+
+        ```
+        wait:                   wait:
+            LD V0, DT               SKNP V0
+            SE V0, 0                JP wait
+            JP wait
+        ```
+
+        Keys only change between runs, so such a loop runs the same way
+        until the timer ticks or the run ends, see skip_idle_loop.
+        """
+        instructions = block.instructions
+        first = instructions[0]
+        if (len(instructions) == 2 and first.ins_type == INS_SYSCALL1 and
+                first.imm8 == SYSCALL1_LOAD_DELAY):
+            test = instructions[1]
+            if test.ins_type != INS_IF_NE and test.ins_type != INS_IF_EQ:
+                return 0
+            if test.imm_r1 != first.imm_r1:
+                return 0
+        elif (len(instructions) == 1 and first.ins_type == INS_IFSYS and
+                (first.imm8 == IFSYS_KEY_DN or first.imm8 == IFSYS_KEY_UP)):
+            pass
+        else:
+            return 0
+        addr = block.start + 2 * len(instructions)
+        if addr >= 0xFFF:
+            return 0
+        jump = self.ram.decode(addr)
+        if jump.ins_type != INS_JUMP or jump.imm12 != block.start:
+            return 0
+        return block.cost + jump.cost
+
+    def skip_idle_loop(self, block):
+        """
+        Moves time forward over the iterations of the idle loop at block
+        that would run the same way as the next one and finish before the
+        watchdog expires. Returns False if there are none.
+        """
+        first = block.instructions[0]
+        registers = self.cpu.general_registers
+        # the last skipped iteration must get past its first block before
+        # the watchdog
+        limit = self.watchdog - block.cost
+        if first.ins_type == INS_SYSCALL1:  # LD Vx, DT
+            value = self.delay_timer.get(self.time)
+            test = block.instructions[1]
+            # SE leaves the loop when equal, SNE when not
+            if (value == test.imm8) == (test.ins_type == INS_IF_NE):
+                return False
+            if value > 0:
+                # the value read stays the same until the timer ticks
+                tick = (self.delay_timer.end -
+                        intmask(value - 1) * self.delay_timer.period)
+                if tick < limit:
+                    limit = tick
+        else:  # SKP or SKNP Vx
+            value = registers[first.imm_r1]
+            # SKNP leaves the loop when the key is up, SKP when down
+            if self.is_key_down(value) != (first.imm8 == IFSYS_KEY_DN):
+                return False
+        if limit <= self.time:
+            return False
+        cost = block.loop_cost
+        n = (limit - self.time + cost - 1) / cost
+        registers[first.imm_r1] = value
+        self.time += n * cost
+        self.instructions += n * (len(block.instructions) + 1)
+        return True
+
+    def execute_block(self, block):
+        pc = block.start
+        for ins in block.instructions:
+            self.operate(pc, ins)
+            pc += 2
+        self.time += block.cost
+        self.instructions += len(block.instructions)
+
     @DISPATCH.handler(C_Step)
     def step(self, msg=None):
-        ins = self.ram.read16(self.cpu.program_counter)
-        self.cpu.program_counter += 2
+        if self.recorder is not None:
+            # replay cannot stop in the middle of a block on its own
+            self.record_event(EVENT_STEP, 0)
+        if self.waiting_key >= 0 and not self.poll_key():
+            return
+        pc = self.cpu.program_counter
+        if self.profile is not None:
+            self.execute_profiled(pc, self.ram.decode(pc))
+        else:
+            self.execute(pc, self.ram.decode(pc))
 
-        ins_type = ins & 0xF000
-        imm12 = ins & 0x0FFF
-        imm8 = ins & 0x00FF
-        imm4 = ins & 0x000F
-        imm_r1 = (ins & 0x0F00) >> 8
-        imm_r2 = (ins & 0x00F0) >> 4
-        reg1 = self.cpu.general_registers[imm_r1]
-        reg2 = self.cpu.general_registers[imm_r2]
-
-        skip_next = False
-
-        if ins_type == INS_SYSCALL:  # 0x0nnn
-            if imm12 == SYSCALL_CLEAR:  # 0x0E0
-                self.time += 109
-                self.display.clear()
-            elif imm12 == SYSCALL_RETURN:  # 0x0EE
-                self.cpu.program_counter = self.stack_pop()
-            else:
-                self.time += 100
-                self.errors += 1
-                error('unknown syscall: ', hex(imm12))
-        elif ins_type == INS_JUMP:  # 0x1nnn
-            self.time += 105
-            if imm12 == self.cpu.program_counter - 2:
-                self.paused = True  # infinite loop, stop emulation
-            self.cpu.program_counter = uint16_t(imm12)
-        elif ins_type == INS_CALL:  # 0x2nnn
-            self.time += 105
-            self.stack_push(self.cpu.program_counter)
-            self.cpu.program_counter = uint16_t(imm12)
-        elif ins_type == INS_IF_NE:  # 0x3xkk
-            self.time += 46
-            skip_next = reg1 == imm8
-        elif ins_type == INS_IF_EQ:  # 0x4xkk
-            self.time += 46
-            skip_next = reg1 != imm8
-        elif ins_type == INS_IF_NOT or ins_type == INS_IF:  # 0x5xyn, 0x9xyn
-            if imm4 == IF_EQ:
-                self.time += 73
-                skip_next = reg1 == reg2
-            else:
-                self.errors += 1
-                error('unknown compare: ', hex(imm4))
-            if ins_type == INS_IF:
-                skip_next = not skip_next
-        elif ins_type == INS_LOAD_IMM:  # 0x6xkk
-            self.time += 27
-            self.cpu.general_registers[imm_r1] = uint8_t(imm8)
-        elif ins_type == INS_ADD_IMM:  # 0x7xkk
-            self.time += 45
-            self.cpu.general_registers[imm_r1] += uint8_t(imm8)
-        elif ins_type == INS_ARITH:  # 0x8xyn
-            self.time += 200
-            out = reg1
-            carry = -1
-            if imm4 == AR_LD:
-                out = reg2
-            elif imm4 == AR_OR:
-                out = reg1 | reg2
-            elif imm4 == AR_AND:
-                out = reg1 & reg2
-            elif imm4 == AR_XOR:
-                out = reg1 ^ reg2
-            elif imm4 == AR_ADD:
-                out = reg1 + reg2
-                if out < reg1:
-                    carry = 1
-                else:
-                    carry = 0
-            elif imm4 == AR_SUB:
-                out = reg1 - reg2
-                if reg1 > reg2:
-                    carry = 1
-                else:
-                    carry = 0
-            elif imm4 == AR_SHR:
-                out = reg1 >> 1
-                if (reg1 & 1) != 0:
-                    carry = 1
-                else:
-                    carry = 0
-            elif imm4 == AR_SUBN:
-                out = reg2 - reg1
-                if reg2 > reg1:
-                    carry = 1
-                else:
-                    carry = 0
-            elif imm4 == AR_SHL:
-                out = reg1 << 1
-                if (reg1 & 0x80) != 0:
-                    carry = 1
-                else:
-                    carry = 0
-            else:
-                self.errors += 1
-                error('unknown arithmetic instruction: ', hex(imm4))
-            if carry != -1:
-                self.cpu.general_registers[15] = uint8_t(carry)
-            self.cpu.general_registers[imm_r1] = out
-        elif ins_type == INS_LOAD_INDEX_IMM:  # 0xAnnn
-            self.time += 55
-            self.cpu.index_register = imm12
-        elif ins_type == INS_JUMP_OFFSET:  # 0xBnnn
-            self.time += 105
-            self.cpu.program_counter = self.cpu.general_registers[0] + uint16_t(imm12)
-        elif ins_type == INS_RANDOM:  # 0xCxkk
-            self.time += 164
-            self.cpu.general_registers[imm_r1] = uint8_t(self.random.genrand32() & imm8)
-        elif ins_type == INS_DRAW:  # 0xDxyn
-            collision = False
-            x = reg1 & 63  # TODO use display size
-            y = reg2 & 31
-            s = self.cpu.index_register
-            for i in range(imm4):
-                if y >= self.display.height:
-                    break
-                collision = self.display.draw(x, y, self.ram.read8(s)) or collision
-                s += 1
-                y += 1
-                self.time += 1000  # approximate
-            if not collision:
-                self.cpu.general_registers[15] = uint8_t(0)
-            else:
-                self.cpu.general_registers[15] = uint8_t(1)
-        elif ins_type == INS_IFSYS:  # 0xExkk
-            if imm8 == IFSYS_KEY_DN:
-                self.io.sync(self.time)
-                skip_next = not self.io.is_key_down(reg1)
-                self.time += 64
-            elif imm8 == IFSYS_KEY_UP:
-                self.io.sync(self.time)
-                skip_next = self.io.is_key_down(reg1)
-                self.time += 64
-            else:
-                self.time += 100
-                self.errors += 1
-                error('unknown syscall: ', hex(imm8))
-        elif ins_type == INS_SYSCALL1:  # 0xFxkk
-            if imm8 == SYSCALL1_LOAD_DELAY:
-                self.io.sync(self.time)
-                self.cpu.general_registers[imm_r1] = self.io.get_delay()
-                self.time += 45
-            elif imm8 == SYSCALL1_LOAD_KEY:
-                self.io.sync(self.time)
-                self.cpu.general_registers[imm_r1] = self.io.next_key()
-                # XXX waited for user input, however long it takes
-                self.time += 100
-            elif imm8 == SYSCALL1_SET_DELAY:
-                self.io.sync(self.time)
-                self.io.set_delay(reg1)
-                self.time += 45
-            elif imm8 == SYSCALL1_SET_SOUND:
-                self.io.sync(self.time)
-                self.io.set_sound(reg1)
-                self.time += 45
-            elif imm8 == SYSCALL1_ADD_INDEX:
-                self.time += 72
-                self.cpu.index_register += reg1
-            elif imm8 == SYSCALL1_LOAD_INDEX_DIGIT:
-                self.time += 91
-                self.cpu.index_register = self.ram.digit(reg1)
-            elif imm8 == SYSCALL1_LOAD_BCD:
-                # TODO this shouldn't need intmask
-                a = uint8_t(intmask(reg1) / 100)
-                b = uint8_t((intmask(reg1) / 10) % 10)
-                c = uint8_t(intmask(reg1) % 10)
-                self.ram.store8(self.cpu.index_register, a)
-                self.ram.store8(self.cpu.index_register + 1, b)
-                self.ram.store8(self.cpu.index_register + 2, c)
-                self.time += 364 + 73 * intmask(a + b + c)
-            elif imm8 == SYSCALL1_REG_SAVE:
-                self.time += 64 * intmask(imm_r1 + 1)
-                j = self.cpu.index_register
-                for i in xrange(imm_r1 + 1):
-                    self.ram.store8(j, self.cpu.general_registers[i])
-                    j += 1
-            elif imm8 == SYSCALL1_REG_LOAD:
-                self.time += 64 * intmask(imm_r1 + 1)
-                j = self.cpu.index_register
-                for i in xrange(imm_r1 + 1):
-                    self.cpu.general_registers[i] = self.ram.read8(j)
-                    j += 1
-            else:
-                self.time += 100
+    def run_profiled(self):
+        while not self.paused and (self.watchdog - self.time) > 0:
+            pc = self.cpu.program_counter
+            self.execute_profiled(pc, self.ram.decode(pc))
+
+    def execute_profiled(self, pc, ins):
+        time = self.time
+        self.execute(pc, ins)
+        self.profile.record(OPCODES.key(intmask(ins.ins)), intmask(pc),
+                            self.time - time)
+
+    @DISPATCH.handler(C_Snapshot)
+    def cmd_snapshot(self, msg):
+        self.pipe.tell(M_Snapshot(snapshot(self)))
+
+    @DISPATCH.handler(C_Restore)
+    def cmd_restore(self, msg):
+        time = self.time
+        if not restore(self, msg.data):
+            self.errors += 1
+            error('invalid snapshot')
+            return
+        # the log cannot follow a jump to another state
+        self.stop_recording(time)
+        self.update_sound()
+
+    @DISPATCH.handler(C_Record)
+    def cmd_record(self, msg):
+        self.stop_recording(self.time)
+        try:
+            self.recorder = Recorder(msg.path, self)
+        except RecordError as e:
+            self.errors += 1
+            error('cannot record: ', e.msg)
+
+    @DISPATCH.handler(C_StopRecording)
+    def cmd_stop_recording(self, msg):
+        self.stop_recording(self.time)
+
+    def record_event(self, kind, value):
+        try:
+            self.recorder.event(self.time, kind, value)
+        except RecordError as e:
+            # the file is closed, the log ends here
+            self.recorder = None
+            self.errors += 1
+            error('cannot record: ', e.msg)
+
+    def stop_recording(self, time):
+        recorder = self.recorder
+        if recorder is not None:
+            self.recorder = None
+            try:
+                recorder.close(time)
+            except RecordError as e:
                 self.errors += 1
-                error('unknown syscall: ', hex(imm8))
+                error('cannot record: ', e.msg)
+
+    @DISPATCH.handler(C_TimerPeriod)
+    def cmd_timer_period(self, msg):
+        period = intmask(msg.period)
+        if period <= 0:
+            self.errors += 1
+            error('invalid timer period')
+            return
+        # the log only holds the period at its start
+        self.stop_recording(self.time)
+        self.delay_timer.set_period(self.time, period)
+        self.sound_timer.set_period(self.time, period)
+
+    @DISPATCH.handler(C_Rewind)
+    def cmd_rewind(self, msg):
+        seconds = intmask(msg.seconds)
+        if seconds == 0:
+            self.rewind = None
+        else:
+            # a checkpoint per frame
+            self.rewind = Rewind(self, self.delay_timer.period, seconds,
+                                 intmask(msg.max_bytes))
+
+    @DISPATCH.handler(C_StepBack)
+    def cmd_step_back(self, msg):
+        time = self.time
+        if self.rewind is not None and self.rewind.step_back(self):
+            self.stop_recording(time)
+            self.update_sound()
+
+    @DISPATCH.handler(C_Profile)
+    def cmd_profile(self, msg):
+        if msg.enable != (self.profile is not None):
+            # runs now end at other times, the log cannot follow
+            self.stop_recording(self.time)
+        if msg.enable:
+            self.profile = Profile()
+        else:
+            self.profile = None
+
+    @DISPATCH.handler(C_ProfileReport)
+    def cmd_profile_report(self, msg):
+        profile = self.profile
+        if profile is None:
+            profile = Profile()
+        self.pipe.tell(M_Profile(profile))
+
+    def execute(self, pc, ins):
+        self.operate(pc, ins)
+        self.time += ins.cost
+        self.instructions += 1
+
+    @always_inline
+    def operate(self, pc, ins):
+        # executes the instruction, apart from its static cost (ins.cost)
+        self.cpu.program_counter = pc + 2
+        ins.handler(self, pc, ins)
+
+    def skip_next(self):
+        self.time += 18
+        self.cpu.program_counter += 2
 
-        if skip_next:
-            self.time += 18
-            self.cpu.program_counter += 2
+    @OPCODES.handler(INS_SYSCALL)  # 0x0nnn
+    def op_syscall(self, pc, ins):
+        if ins.imm12 == SYSCALL_CLEAR:  # 0x0E0
+            self.display.clear()
+        elif ins.imm12 == SYSCALL_RETURN:  # 0x0EE
+            self.cpu.program_counter = self.stack_pop()
+        else:
+            self.errors += 1
+            error('unknown syscall: ', hex(ins.imm12))
+
+    @OPCODES.handler(INS_JUMP)  # 0x1nnn
+    def op_jump(self, pc, ins):
+        if ins.imm12 == pc:
+            self.paused = True  # infinite loop, stop emulation
+        self.cpu.program_counter = uint16_t(ins.imm12)
+
+    @OPCODES.handler(INS_CALL)  # 0x2nnn
+    def op_call(self, pc, ins):
+        self.stack_push(self.cpu.program_counter)
+        self.cpu.program_counter = uint16_t(ins.imm12)
+
+    @OPCODES.handler(INS_IF_NE)  # 0x3xkk
+    def op_if_ne(self, pc, ins):
+        if self.cpu.general_registers[ins.imm_r1] == ins.imm8:
+            self.skip_next()
+
+    @OPCODES.handler(INS_IF_EQ)  # 0x4xkk
+    def op_if_eq(self, pc, ins):
+        if self.cpu.general_registers[ins.imm_r1] != ins.imm8:
+            self.skip_next()
+
+    @OPCODES.handler(INS_IF_NOT)  # 0x5xyn
+    def op_if_not(self, pc, ins):
+        if ins.imm4 != IF_EQ:
+            self.errors += 1
+            error('unknown compare: ', hex(ins.imm4))
+        elif (self.cpu.general_registers[ins.imm_r1] ==
+              self.cpu.general_registers[ins.imm_r2]):
+            self.skip_next()
+
+    @OPCODES.handler(INS_IF)  # 0x9xyn
+    def op_if(self, pc, ins):
+        if ins.imm4 != IF_EQ:
+            self.errors += 1
+            error('unknown compare: ', hex(ins.imm4))
+            self.skip_next()
+        elif (self.cpu.general_registers[ins.imm_r1] !=
+              self.cpu.general_registers[ins.imm_r2]):
+            self.skip_next()
+
+    @OPCODES.handler(INS_LOAD_IMM)  # 0x6xkk
+    def op_load_imm(self, pc, ins):
+        self.cpu.general_registers[ins.imm_r1] = uint8_t(ins.imm8)
+
+    @OPCODES.handler(INS_ADD_IMM)  # 0x7xkk
+    def op_add_imm(self, pc, ins):
+        self.cpu.general_registers[ins.imm_r1] += uint8_t(ins.imm8)
+
+    @ARITH.handler(AR_LD)  # 0x8xy0
+    def op_arith_ld(self, pc, ins):
+        regs = self.cpu.general_registers
+        regs[ins.imm_r1] = regs[ins.imm_r2]
+
+    @ARITH.handler(AR_OR)  # 0x8xy1
+    def op_arith_or(self, pc, ins):
+        regs = self.cpu.general_registers
+        regs[ins.imm_r1] = regs[ins.imm_r1] | regs[ins.imm_r2]
+
+    @ARITH.handler(AR_AND)  # 0x8xy2
+    def op_arith_and(self, pc, ins):
+        regs = self.cpu.general_registers
+        regs[ins.imm_r1] = regs[ins.imm_r1] & regs[ins.imm_r2]
+
+    @ARITH.handler(AR_XOR)  # 0x8xy3
+    def op_arith_xor(self, pc, ins):
+        regs = self.cpu.general_registers
+        regs[ins.imm_r1] = regs[ins.imm_r1] ^ regs[ins.imm_r2]
+
+    @ARITH.handler(AR_ADD)  # 0x8xy4
+    def op_arith_add(self, pc, ins):
+        regs = self.cpu.general_registers
+        reg1 = regs[ins.imm_r1]
+        out = reg1 + regs[ins.imm_r2]
+        if out < reg1:
+            regs[15] = uint8_t(1)
+        else:
+            regs[15] = uint8_t(0)
+        regs[ins.imm_r1] = out
+
+    @ARITH.handler(AR_SUB)  # 0x8xy5
+    def op_arith_sub(self, pc, ins):
+        regs = self.cpu.general_registers
+        reg1 = regs[ins.imm_r1]
+        reg2 = regs[ins.imm_r2]
+        if reg1 > reg2:
+            regs[15] = uint8_t(1)
+        else:
+            regs[15] = uint8_t(0)
+        regs[ins.imm_r1] = reg1 - reg2
+
+    @ARITH.handler(AR_SHR)  # 0x8xy6
+    def op_arith_shr(self, pc, ins):
+        regs = self.cpu.general_registers
+        reg1 = regs[ins.imm_r1]
+        if (reg1 & 1) != 0:
+            regs[15] = uint8_t(1)
+        else:
+            regs[15] = uint8_t(0)
+        regs[ins.imm_r1] = reg1 >> 1
+
+    @ARITH.handler(AR_SUBN)  # 0x8xy7
+    def op_arith_subn(self, pc, ins):
+        regs = self.cpu.general_registers
+        reg1 = regs[ins.imm_r1]
+        reg2 = regs[ins.imm_r2]
+        if reg2 > reg1:
+            regs[15] = uint8_t(1)
+        else:
+            regs[15] = uint8_t(0)
+        regs[ins.imm_r1] = reg2 - reg1
+
+    @ARITH.handler(AR_SHL)  # 0x8xyE
+    def op_arith_shl(self, pc, ins):
+        regs = self.cpu.general_registers
+        reg1 = regs[ins.imm_r1]
+        if (reg1 & 0x80) != 0:
+            regs[15] = uint8_t(1)
+        else:
+            regs[15] = uint8_t(0)
+        regs[ins.imm_r1] = reg1 << 1
+
+    @ARITH.unhandler
+    def op_arith_unknown(self, pc, ins):
+        self.errors += 1
+        error('unknown arithmetic instruction: ', hex(ins.imm4))
+
+    @OPCODES.handler(INS_LOAD_INDEX_IMM)  # 0xAnnn
+    def op_load_index_imm(self, pc, ins):
+        self.cpu.index_register = ins.imm12
+
+    @OPCODES.handler(INS_JUMP_OFFSET)  # 0xBnnn
+    def op_jump_offset(self, pc, ins):
+        self.cpu.program_counter = self.cpu.general_registers[0] + uint16_t(ins.imm12)
+
+    @OPCODES.handler(INS_RANDOM)  # 0xCxkk
+    def op_random(self, pc, ins):
+        self.cpu.general_registers[ins.imm_r1] = uint8_t(self.random.genrand32() & ins.imm8)
+
+    @OPCODES.handler(INS_DRAW)  # 0xDxyn
+    def op_draw(self, pc, ins):
+        regs = self.cpu.general_registers
+        collision = self.draw_sprite(regs[ins.imm_r1], regs[ins.imm_r2], ins.imm4)
+        if not collision:
+            regs[15] = uint8_t(0)
+        else:
+            regs[15] = uint8_t(1)
+
+    @IFSYS.handler(IFSYS_KEY_DN)  # 0xExA1
+    def op_key_dn(self, pc, ins):
+        if not self.is_key_down(self.cpu.general_registers[ins.imm_r1]):
+            self.skip_next()
+
+    @IFSYS.handler(IFSYS_KEY_UP)  # 0xEx9E
+    def op_key_up(self, pc, ins):
+        if self.is_key_down(self.cpu.general_registers[ins.imm_r1]):
+            self.skip_next()
+
+    @SYSCALL1.handler(SYSCALL1_LOAD_DELAY)  # 0xFx07
+    def op_load_delay(self, pc, ins):
+        self.cpu.general_registers[ins.imm_r1] = self.delay_timer.get(self.time)
+
+    @SYSCALL1.handler(SYSCALL1_LOAD_KEY)  # 0xFx0A
+    def op_load_key(self, pc, ins):
+        # wait for the next key press without blocking: the run ends here
+        # and later runs only poll the keys, see run
+        self.waiting_key = intmask(ins.imm_r1)
+        self.waiting_held = self.keys
+        self.watchdog = self.time
+
+    @SYSCALL1.handler(SYSCALL1_SET_DELAY)  # 0xFx15
+    def op_set_delay(self, pc, ins):
+        self.delay_timer.set(self.time, self.cpu.general_registers[ins.imm_r1])
+
+    @SYSCALL1.handler(SYSCALL1_SET_SOUND)  # 0xFx18
+    def op_set_sound(self, pc, ins):
+        self.sound_timer.set(self.time, self.cpu.general_registers[ins.imm_r1])
+        if self.sound_timer.is_running(self.time) != self.sound:
+            self.io.sync(self.time)
+            self.update_sound()
+
+    @SYSCALL1.handler(SYSCALL1_ADD_INDEX)  # 0xFx1E
+    def op_add_index(self, pc, ins):
+        self.cpu.index_register += self.cpu.general_registers[ins.imm_r1]
+
+    @SYSCALL1.handler(SYSCALL1_LOAD_INDEX_DIGIT)  # 0xFx29
+    def op_load_index_digit(self, pc, ins):
+        self.cpu.index_register = self.ram.digit(self.cpu.general_registers[ins.imm_r1])
+
+    @SYSCALL1.handler(SYSCALL1_LOAD_BCD)  # 0xFx33
+    def op_load_bcd(self, pc, ins):
+        reg1 = self.cpu.general_registers[ins.imm_r1]
+        # TODO this shouldn't need intmask
+        a = uint8_t(intmask(reg1) / 100)
+        b = uint8_t((intmask(reg1) / 10) % 10)
+        c = uint8_t(intmask(reg1) % 10)
+        self.ram.store8(self.cpu.index_register, a)
+        self.ram.store8(self.cpu.index_register + 1, b)
+        self.ram.store8(self.cpu.index_register + 2, c)
+        self.time += 73 * intmask(a + b + c)
+
+    @SYSCALL1.handler(SYSCALL1_REG_SAVE)  # 0xFx55
+    def op_reg_save(self, pc, ins):
+        self.reg_save(ins.imm_r1)
+
+    @SYSCALL1.handler(SYSCALL1_REG_LOAD)  # 0xFx65
+    def op_reg_load(self, pc, ins):
+        self.reg_load(ins.imm_r1)
+
+    @IFSYS.unhandler
+    @SYSCALL1.unhandler
+    def op_syscall_unknown(self, pc, ins):
+        self.errors += 1
+        error('unknown syscall: ', hex(ins.imm8))
+
+    # loops are kept out of operate() so the JIT can inline it
+
+    @jit.unroll_safe
+    def draw_sprite(self, x, y, n):
+        x = intmask(x & 63)  # TODO use display size
+        y = intmask(y & 31)
+        # rows below the bottom are cut off
+        rows = self.display.height - y
+        if intmask(n) < rows:
+            rows = intmask(n)
+        self.time += 1000 * rows  # approximate
+        return self.display.draw_sprite(x, y, self.ram.contents,
+                                        intmask(self.cpu.index_register),
+                                        rows)
+
+    @jit.unroll_safe
+    def reg_save(self, last):
+        j = self.cpu.index_register
+        for i in xrange(last + 1):
+            self.ram.store8(j, self.cpu.general_registers[i])
+            j += 1
+
+    @jit.unroll_safe
+    def reg_load(self, last):
+        j = self.cpu.index_register
+        for i in xrange(last + 1):
+            self.cpu.general_registers[i] = self.ram.read8(j)
+            j += 1
 
     @DISPATCH.handler(C_Load)
     def cmd_load(self, msg):
+        # the log cannot follow a change of memory it does not contain
+        self.stop_recording(self.time)
         self.load(msg.path)
 
     def load(self, path):
+        """Loads the program at path. Returns False if it is too large."""
         data = open(path, "rb").read()
-        self.ram.load_bin(data)
+        if not self.ram.load_bin(data):
+            self.errors += 1
+            error('program too large: ', str(len(data)), ' bytes')
+            return False
+        return True
+
+    @DISPATCH.handler(C_Encoding)
+    def cmd_encoding(self, msg):
+        # the command itself still arrives in the old encoding
+        if not self.pipe.set_encoding(msg.encoding):
+            error('unknown encoding: ', msg.encoding)
+
+    @DISPATCH.handler(C_Framebuffer)
+    def cmd_framebuffer(self, msg):
+        if self.framebuffer is not None:
+            self.framebuffer.close()
+            self.framebuffer = None
+        try:
+            self.framebuffer = FramebufferWriter(
+                msg.path, self.display.width, self.display.height)
+        except FramebufferError as e:
+            error('cannot attach framebuffer: ', e.msg)
+            self.pipe.tell(M_Framebuffer(False))
+            return
+        self.display.mark_clean()
+        self.framebuffer.publish(self.display.data, range(self.display.height))
+        self.pipe.tell(M_Framebuffer(True))
 
     @DISPATCH.handler(C_Display)
     def cmd_display(self, msg):
+        self.take_dirty()
         self.pipe.tell(M_Display(self.display))
 
+    @DISPATCH.handler(C_DisplayDelta)
+    def cmd_display_delta(self, msg):
+        self.pipe.tell(M_DisplayDelta(self.display, self.take_dirty()))
+
     @DISPATCH.handler(C_Cpu)
     def cmd_cpu(self, msg):
         self.pipe.tell(M_Cpu(self))
@@ -525,14 +1262,24 @@ class Chip8_Rpc:
 
         self.cpu = Cpu()
         self.display = Display()
+        # shared framebuffer the display is read from, see attach_framebuffer
+        self.framebuffer = None
+        self.framebuffer_path = None
+        # last profile and snapshot received, see get_profile and snapshot
+        self.profile = None
+        self.snapshot_data = None
+        # keypad state to send to the emulator, see Chip8.keys
+        self.keys = uint16_t(0)
+        self.keys_sent = uint16_t(0)
 
         self.errors = 0
         self.paused = False
+        # whether the program waits in LD Vx, K for a key to go down
+        self.waiting = False
 
     def _cmd(self, cmd):
         self.pipe.tell(cmd)
-        while True:
-            msg = self.pipe.get()
+        for msg in self.pipe.messages():
             if msg is None:
                 pass
             elif isinstance(msg, Q_NextCommand):
@@ -540,7 +1287,7 @@ class Chip8_Rpc:
             elif not self.DISPATCH.dispatch(self, msg):
                 error('unhandled message: ', msg.serialize())
 
-    def initialize(self, path):
+    def initialize(self, path, encoding=ENCODING_TEXT):
         vers = self.pipe.get()
         if not isinstance(vers, M_Version):
             return False
@@ -548,23 +1295,97 @@ class Chip8_Rpc:
             return False
         if not isinstance(self.pipe.get(), Q_NextCommand):
             return False
+        if encoding != ENCODING_TEXT:
+            if encoding not in vers.encodings:
+                return False
+            self.pipe.tell(C_Encoding(encoding))
+            self.pipe.set_encoding(encoding)
+            if not isinstance(self.pipe.get(), Q_NextCommand):
+                return False
         self._cmd(C_Load(path))
+        # later syncs only send the rows that changed
+        self._cmd(C_Display())
         return True
 
     def quit(self):
         self.pipe.tell(C_Die())
+        self.pipe.flush()
+        if self.framebuffer is not None:
+            self.framebuffer.close()
+            self.framebuffer = None
+
+    def snapshot(self):
+        """Returns the complete state of the emulated machine."""
+        self.snapshot_data = None
+        self._cmd(C_Snapshot())
+        return self.snapshot_data
+
+    def restore(self, data):
+        """Restores a state returned by snapshot()."""
+        self._cmd(C_Restore(data))
+        self._cmd(C_Cpu())
+        self._cmd(C_Display())
+
+    def set_timer_period(self, period):
+        """Sets the emulated time per count of the delay and sound timers."""
+        self._cmd(C_TimerPeriod(uint32_t(period)))
+
+    def set_rewind(self, seconds, max_bytes):
+        """Keeps checkpoints of the last seconds, 0 switches it off."""
+        self._cmd(C_Rewind(uint32_t(seconds), uint32_t(max_bytes)))
+
+    def step_back(self):
+        """Goes back to the previous checkpoint, see Rewind.step_back."""
+        self._cmd(C_StepBack())
+        self._sync()
+
+    def set_profiling(self, enable):
+        """Starts profiling from scratch, or stops it."""
+        self._cmd(C_Profile(enable))
+
+    def get_profile(self):
+        """Returns the M_Profile of the instructions run so far."""
+        self.profile = None
+        self._cmd(C_ProfileReport())
+        return self.profile
+
+    def record(self, path):
+        """Starts writing an input log to path."""
+        self._cmd(C_Record(path))
+
+    def stop_recording(self):
+        self._cmd(C_StopRecording())
+
+    def attach_framebuffer(self, path):
+        """Asks the emulator to publish its display in the file at path.
+
+        After this, run() reads the display from the shared mapping instead
+        of the pipe. Returns whether the emulator was able to attach.
+        """
+        self.framebuffer_path = path
+        self._cmd(C_Framebuffer(path))
+        return self.framebuffer is not None
 
     def _sync(self):
         self._cmd(C_Cpu())
-        self._cmd(C_Display())
+        self._cmd(C_DisplayDelta())
+
+    def _send_keys(self):
+        if self.keys != self.keys_sent:
+            self._cmd(C_Keys(self.keys))
+            self.keys_sent = self.keys
 
     def step(self):
+        self._send_keys()
         self._cmd(C_Step())
         self._sync()
 
     def run(self, watchdog=2**30):
-        self._cmd(C_Run(watchdog))
-        self._sync()
+        # a single round trip, the state comes back with the next command
+        self._cmd(C_RunReport(watchdog, self.keys))
+        self.keys_sent = self.keys
+        if self.framebuffer is not None:
+            self.framebuffer.read(self.display)
 
     @DISPATCH.handler(M_Cpu)
     def msg_cpu(self, msg):
@@ -574,29 +1395,33 @@ class Chip8_Rpc:
     def msg_display(self, msg):
         msg.unpack(self.display)
 
-    @DISPATCH.handler(M_Sync)
-    def msg_sync(self, msg):
-        self.io.sync(msg.time)
+    @DISPATCH.handler(M_DisplayDelta)
+    def msg_display_delta(self, msg):
+        msg.unpack(self.display)
 
-    @DISPATCH.handler(Q_KeyDown)
-    def msg_key_down(self, msg):
-        self.pipe.tell(A_KeyDown(self.io.is_key_down(msg.key)))
+    @DISPATCH.handler(M_Snapshot)
+    def msg_snapshot(self, msg):
+        self.snapshot_data = msg.data
 
-    @DISPATCH.handler(Q_NextKey)
-    def msg_next_key(self, msg):
-        self.pipe.tell(A_NextKey(self.io.next_key()))
+    @DISPATCH.handler(M_Profile)
+    def msg_profile(self, msg):
+        self.profile = msg
 
-    @DISPATCH.handler(M_SetDelayTimer)
-    def msg_set_delay(self, msg):
-        self.io.set_delay(msg.delay)
+    @DISPATCH.handler(M_Framebuffer)
+    def msg_framebuffer(self, msg):
+        if self.framebuffer is not None:
+            self.framebuffer.close()
+            self.framebuffer = None
+        if msg.attached:
+            self.framebuffer = FramebufferReader(self.framebuffer_path)
 
-    @DISPATCH.handler(M_SetSoundTimer)
-    def msg_set_sound(self, msg):
-        self.io.set_sound(msg.delay)
+    @DISPATCH.handler(M_Sync)
+    def msg_sync(self, msg):
+        self.io.sync(msg.time)
 
-    @DISPATCH.handler(Q_DelayTimer)
-    def msg_get_delay(self, msg):
-        self.pipe.tell(A_DelayTimer(self.io.get_delay()))
+    @DISPATCH.handler(M_Sound)
+    def msg_sound(self, msg):
+        self.io.set_sound(msg.on)
 
 
 class _stdio:
@@ -609,20 +1434,124 @@ class _stdio:
 _stdio = _stdio()
 
 
+class Server:
+    """Runs a Chip8 for every session of any number of connections."""
+
+    def __init__(self):
+        self.connections = {}
+        self.chips = {}
+
+    def add_connection(self, fd):
+        self.connections[fd] = Connection(fd, accept=True)
+
+    def receive(self, fd):
+        connection = self.connections[fd]
+        connection.receive()
+        self.serve(connection)
+
+    def serve(self, connection):
+        # one command per session and round, until all are waiting for
+        # the next command
+        busy = True
+        while busy and not connection.eof:
+            busy = False
+            for pipe in connection.take_opened():
+                self.chips[pipe] = Chip8(pipe, Io_Rpc(pipe))
+                pipe.tell(M_Version(__version__, [ENCODING_BINARY]))
+                pipe.tell(Q_NextCommand())
+                busy = True
+            for pipe in connection.sessions.values():
+                if connection.eof or not pipe.ready():
+                    continue
+                busy = True
+                if self.chips[pipe].command(pipe.read()):
+                    pipe.tell(Q_NextCommand())
+                else:
+                    connection.close_session(pipe.id)
+                    self.close_chip8(pipe)
+        if connection.eof:
+            for pipe in connection.sessions.values():
+                self.close_chip8(pipe)
+            del self.connections[connection.fd]
+            connection.close()
+        else:
+            connection.flush()
+
+    def close_chip8(self, pipe):
+        chip8 = self.chips.get(pipe, None)
+        if chip8 is not None:
+            chip8.close()
+            del self.chips[pipe]
+
+
+# Unix domain sockets are missing on some platforms, e.g. Windows; the
+# rest of the emulator translates without them
+if rsocket.HAS_AF_UNIX:
+    def serve(path):
+        try:
+            listener = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+            listener.bind(rsocket.UNIXAddress(path))
+            listener.listen(128)
+        except rsocket.SocketError as e:
+            error('cannot listen on ', path, ': ', e.get_msg())
+            return 1
+
+        server = Server()
+        while True:
+            fds = {listener.fd: rpoll.POLLIN}
+            for fd in server.connections:
+                fds[fd] = rpoll.POLLIN
+            for fd, events in rpoll.poll(fds, -1):
+                if fd == listener.fd:
+                    newfd, _ = listener.accept()
+                    server.add_connection(newfd)
+                elif fd in server.connections:
+                    server.receive(fd)
+
+
+def run_replay(path):
+    """Replays the input log at path and prints the final M_Cpu and M_Display."""
+    try:
+        log = read_log(path)
+    except RecordError as e:
+        error('cannot replay ', path, ': ', e.msg)
+        return 1
+    pipe = Stdio(_stdio.stdin, _stdio.stdout)
+    chip8 = Chip8(pipe, Io_Null())
+    try:
+        in_sync = replay(chip8, log)
+    except RecordError as e:
+        error('cannot replay ', path, ': ', e.msg)
+        return 1
+    pipe.tell(M_Cpu(chip8))
+    pipe.tell(M_Display(chip8.display))
+    pipe.flush()
+    if not in_sync:
+        return 1
+    return 0
+
+
 def entrypoint(argv):
+    if len(argv) == 3 and argv[1] == '--server':
+        if not rsocket.HAS_AF_UNIX:
+            error('--server needs Unix domain sockets')
+            return 1
+        return serve(argv[2])
+    if len(argv) == 3 and argv[1] == '--replay':
+        return run_replay(argv[2])
+
     pipe = Stdio(_stdio.stdin, _stdio.stdout)
-    pipe.tell(M_Version(__version__))
+    pipe.tell(M_Version(__version__, ENCODINGS))
 
     chip8 = Chip8(pipe, Io_Rpc(pipe))
 
-    while True:
-        c = pipe.ask(Q_NextCommand())
-        if c is None:
+    try:
+        while not pipe.eof and chip8.command(pipe.ask(Q_NextCommand())):
             pass
-        elif isinstance(c, C_Die):
-            return 0
-        else:
-            chip8.DISPATCH.dispatch(chip8, c)
+    finally:
+        # ends an input log that is still being recorded
+        chip8.close()
+    return 0
 
 
 if __name__ == '__main__':
@@ -634,7 +1563,9 @@ if __name__ == '__main__':
 else:
     from rpython.rlib import rfile
 
-    def target(*args):
+    def target(driver, args):
+        Chip8.BLOCK_MODE = not driver.config.translation.jit
+
         def entrypoint_wrap(argv):
             _stdio.stdin, _stdio.stdout, _stdio.stderr = rfile.create_stdio()
             errorstream.stream = _stdio.stderr
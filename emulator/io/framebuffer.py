@@ -0,0 +1,157 @@
+"""
+This file defines the shared framebuffer.
+
+Instead of sending the display over the pipe, the emulator can publish it
+in a memory-mapped file (see `C_Framebuffer`). Any number of readers may
+map the same file. It holds a header followed by the display rows:
+
+```
+offset  size    contents
+0       4       magic, 'CH8F'
+4       4       frame counter, odd while the emulator is writing
+8       2       width
+10      2       height
+12      4       reserved
+16      8 * h   rows, one per display line
+```
+
+All numbers are big-endian. Readers copy the rows between two reads of
+the frame counter, and retry if it was odd or has changed.
+
+The file is created by the frontend, e.g. with `tempfile.mkstemp`, as a
+path in a shared directory can be planted by another user. The writer does
+not follow a symlink and only maps a regular file owned by the user.
+"""
+
+import os
+import stat
+
+from rpython.rlib import rmmap
+from rpython.rlib.objectmodel import not_rpython
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rStringIO import RStringIO
+
+from emulator.io.serialize import s_uint16, s_uint32, s_uint64
+from emulator.types import uint16_t, uint32_t
+
+MAGIC = 'CH8F'
+HEADER_SIZE = 16
+OFFSET_COUNTER = 4
+
+# missing on some platforms, e.g. Windows
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+HAS_GETUID = hasattr(os, 'getuid')
+
+# how often, and how many seconds apart, a reader retries a frame that is
+# being written before it gives up on the writer
+READ_RETRIES = 1000
+READ_RETRY_DELAY = 0.001
+
+
+def framebuffer_size(height):
+    return HEADER_SIZE + 8 * height
+
+
+class FramebufferError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class FramebufferWriter:
+    def __init__(self, path, width, height):
+        self.height = height
+        self.counter = 0
+        size = framebuffer_size(height)
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | O_NOFOLLOW, 0600)
+        except OSError:
+            raise FramebufferError('cannot open ' + path)
+        try:
+            try:
+                st = os.fstat(fd)
+            except OSError:
+                raise FramebufferError('cannot stat ' + path)
+            if not stat.S_ISREG(st.st_mode):
+                raise FramebufferError('not a regular file: ' + path)
+            if HAS_GETUID and intmask(st.st_uid) != intmask(os.getuid()):
+                raise FramebufferError('not owned by the user: ' + path)
+            try:
+                os.ftruncate(fd, size)
+                self.map = rmmap.mmap(fd, size)
+            except OSError:
+                raise FramebufferError('cannot resize ' + path)
+            except rmmap.RMMapError:
+                raise FramebufferError('cannot map ' + path)
+        finally:
+            os.close(fd)
+        out = RStringIO()
+        out.write(MAGIC)
+        s_uint32.b(out, uint32_t(self.counter))
+        s_uint16.b(out, uint16_t(width))
+        s_uint16.b(out, uint16_t(height))
+        out.write('\0\0\0\0')
+        self.map.setslice(0, out.getvalue())
+
+    def set_counter(self, counter):
+        out = RStringIO()
+        s_uint32.b(out, uint32_t(counter))
+        self.map.setslice(OFFSET_COUNTER, out.getvalue())
+        self.counter = counter
+
+    def publish(self, data, rows):
+        """Writes the given rows of data and starts a new frame."""
+        self.set_counter(self.counter + 1)
+        for y in rows:
+            out = RStringIO()
+            s_uint64.b(out, data[y])
+            self.map.setslice(HEADER_SIZE + 8 * y, out.getvalue())
+        self.set_counter(self.counter + 1)
+
+    def close(self):
+        self.map.close()
+
+
+class FramebufferReader:
+    @not_rpython
+    def __init__(self, path):
+        import mmap
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[0:4] != MAGIC:
+            self.map.close()
+            raise FramebufferError('not a framebuffer: ' + path)
+
+    @not_rpython
+    def counter(self):
+        import struct
+        return struct.unpack_from('>I', self.map, OFFSET_COUNTER)[0]
+
+    @not_rpython
+    def read(self, display):
+        """
+        Copies the latest complete frame into display. Raises
+        FramebufferError if the writer stays in the middle of a frame,
+        e.g. because it died there.
+        """
+        import struct
+        import time
+        from emulator.types import uint64_t
+        for i in range(READ_RETRIES):
+            counter = self.counter()
+            if not counter & 1:
+                width, height = struct.unpack_from('>HH', self.map, 8)
+                rows = struct.unpack_from('>%dQ' % height, self.map,
+                                          HEADER_SIZE)
+                if self.counter() == counter:
+                    break
+            time.sleep(READ_RETRY_DELAY)
+        else:
+            raise FramebufferError('frame is not complete')
+        display.width = width
+        display.height = height
+        display.data = [uint64_t(row) for row in rows]
+        return counter
+
+    @not_rpython
+    def close(self):
+        self.map.close()
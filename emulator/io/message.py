@@ -2,9 +2,10 @@
 This file defines all messages that can be passed using the io functions.
 
 Each message must inherit from the abstract base class Message, and have
-the `@_register(...)` annotation listing all supported spellings for the
-given message. The `@_register(...)` function makes sure these are unique;
-the complete list is dumped to stderr when this file is imported.
+the `@_register(id, ...)` annotation giving its binary id and listing all
+supported spellings for the given message. The `@_register(...)` function
+makes sure these are unique; the complete list is dumped to stderr when
+this file is imported.
 
 Message classes should follow the following naming convention:
 * `M_...` -> Message from emulator to user, may be in response to a Command
@@ -13,33 +14,51 @@ Message classes should follow the following naming convention:
 * `C_...` -> Command from user to emulator, answer to `Q_NextCommand`
 
 Unexpected messages may be ignored or terminate the connection.
+
+Messages have two encodings, text and binary, both generated from the
+`serialized_field...` annotations. The text encoding uses the code from
+`@_register(...)`, the binary encoding its one byte id, followed by
+fixed-width fields. Ids are grouped by kind (`M_` from 0x00, `Q_` from 0x40,
+`C_` from 0x80) and never change or get reused: a new message takes a free
+id, and any change to the messages bumps `__version__` in chip8.py.
 """
 
 from rpython.rlib.objectmodel import not_rpython, always_inline, instantiate
+from rpython.rlib.rarithmetic import intmask
 from rpython.rlib.rStringIO import RStringIO
 
-from assembler.tokenizer import tokenize
 from emulator.error import error
 from emulator.io.serialize import *
 from emulator.types import *
 
 _codes = {}
+_ids = []
 
 
 @not_rpython
-def _register(*codes):
+def _register(id, *codes):
     @not_rpython
     def impl(cls):
         cls._CODE = codes[0]
         for code in codes:
             assert code not in _codes
             _codes[code] = cls
+        assert 0 <= id <= 0xFF
+        while len(_ids) <= id:
+            _ids.append(None)
+        assert _ids[id] is None
+        cls._ID = id
+        _ids[id] = cls
         return cls
     return impl
 
 
 class Message(object):
     _CODE = None
+    _ID = -1
+    # if set, a pipe may drop this message when it is directly followed by
+    # another of the same type
+    _COALESCE = False
 
     def __init__(self):
         pass
@@ -54,26 +73,50 @@ class Message(object):
         assert self._CODE is not None
         out.write(self._CODE)
 
-    def unserialize(self, m, t):
+    def unserialize(self, r):
         assert type(self) is not Message
-        return self.unserialize_impl(t) == len(t)
+        self.unserialize_impl(r)
+        return r.at_end()
+
+    @always_inline
+    def unserialize_impl(self, r):
+        pass
+
+    def serialize_binary(self):
+        out = RStringIO()
+        self.serialize_binary_impl(out)
+        return out.getvalue()
 
     @always_inline
-    def unserialize_impl(self, t):
-        return 1
+    def serialize_binary_impl(self, out):
+        assert self._ID >= 0
+        out.write(chr(self._ID))
 
+    def unserialize_binary(self, r):
+        assert type(self) is not Message
+        self.unserialize_binary_impl(r)
+        return r.at_end()
 
+    @always_inline
+    def unserialize_binary_impl(self, r):
+        pass
+
+
+@serialized_field_list('encodings', s_str)
 @serialized_field('version', s_str)
-@_register('version')
+@_register(0x00, 'version')
 class M_Version(Message):
-    def __init__(self, version=''):
+    def __init__(self, version='', encodings=None):
         self.version = version
+        if encodings is None:
+            encodings = []
+        self.encodings = encodings
 
 
 @serialized_field_list('data', s_uint64)
 @serialized_field('height', s_uint16)
 @serialized_field('width', s_uint16)
-@_register('display')
+@_register(0x01, 'display')
 class M_Display(Message):
     def __init__(self, display):
         self.width = uint16_t(display.width)
@@ -86,13 +129,32 @@ class M_Display(Message):
         display.data = self.data
 
 
+@serialized_field_list('data', s_uint64)
+@serialized_field_list('rows', s_uint16)
+@_register(0x02, 'ddisplay')
+class M_DisplayDelta(Message):
+    def __init__(self, display, rows):
+        self.rows = [uint16_t(y) for y in rows]
+        self.data = [display.data[y] for y in rows]
+
+    def unpack(self, display):
+        if len(self.rows) != len(self.data):
+            error('malformed display delta')
+            return
+        for i in range(len(self.rows)):
+            y = intmask(self.rows[i])
+            if y < display.height:
+                display.data[y] = self.data[i]
+
+
+@serialized_field('waiting', s_bool)
 @serialized_field('errors', s_uint32)
 @serialized_field('paused', s_bool)
 @serialized_field_array('cpu__general_registers', 16, s_uint8)
 @serialized_field('cpu__index_register', s_uint16)
 @serialized_field('cpu__stack_pointer', s_uint16)
 @serialized_field('cpu__program_counter', s_uint16)
-@_register('cpu')
+@_register(0x03, 'cpu')
 class M_Cpu(Message):
     def __init__(self, chip8):
         self.cpu__program_counter = chip8.cpu.program_counter
@@ -101,6 +163,7 @@ class M_Cpu(Message):
         self.cpu__general_registers = chip8.cpu.general_registers
         self.paused = chip8.paused
         self.errors = uint32_t(chip8.errors)
+        self.waiting = chip8.waiting_key >= 0
     
     def unpack(self, chip8):
         chip8.cpu.program_counter = self.cpu__program_counter
@@ -109,125 +172,239 @@ class M_Cpu(Message):
         chip8.cpu.general_registers = self.cpu__general_registers
         chip8.paused = self.paused
         chip8.errors = int(self.errors)
+        chip8.waiting = self.waiting
+
+
+@serialized_field_list('pc_counts', s_uint64)
+@serialized_field_list('pcs', s_uint16)
+@serialized_field_list('cycles', s_uint64)
+@serialized_field_list('counts', s_uint64)
+@serialized_field_list('opcodes', s_uint16)
+@_register(0x04, 'profile')
+class M_Profile(Message):
+    def __init__(self, profile):
+        self.opcodes = [uint16_t(opcode) for opcode in profile.opcodes]
+        self.counts = [uint64_t(count) for count in profile.counts]
+        self.cycles = [uint64_t(cycles) for cycles in profile.cycles]
+        self.pcs = []
+        self.pc_counts = []
+        for pc in range(len(profile.pcs)):
+            if profile.pcs[pc] != 0:
+                self.pcs.append(uint16_t(pc))
+                self.pc_counts.append(uint64_t(profile.pcs[pc]))
+
+
+@serialized_field('data', s_bytes)
+@_register(0x05, 'snapshot')
+class M_Snapshot(Message):
+    def __init__(self, data=''):
+        self.data = data
 
 
 @serialized_field('time', s_uint32)
-@_register('@')
+@_register(0x06, '@')
 class M_Sync(Message):
+    _COALESCE = True
+
     def __init__(self, time):
         self.time = uint32_t(time)
 
 
-@serialized_field('key', s_uint8)
-@_register('?k')
-class Q_KeyDown(Message):
-    def __init__(self, key):
-        self.key = key
+@serialized_field('on', s_bool)
+@_register(0x07, 'snd')
+class M_Sound(Message):
+    def __init__(self, on):
+        self.on = on
+
 
+@serialized_field('attached', s_bool)
+@_register(0x08, 'fb')
+class M_Framebuffer(Message):
+    def __init__(self, attached=False):
+        self.attached = attached
 
-@serialized_field('down', s_bool)
-@_register('!k')
-class A_KeyDown(Message):
-    def __init__(self, down):
-        self.down = down
+
+@_register(0x40, '?')
+class Q_NextCommand(Message):
+    pass
 
 
-@_register('?K')
-class Q_NextKey(Message):
+@_register(0x80, 'die')
+class C_Die(Message):
     pass
 
 
-@serialized_field('key', s_uint8)
-@_register('!K')
-class A_NextKey(Message):
-    def __init__(self, key):
-        self.key = key
+@_register(0x81, 's', 'step')
+class C_Step(Message):
+    pass
 
 
-@serialized_field('delay', s_uint8)
-@_register('td')
-class M_SetDelayTimer(Message):
-    def __init__(self, delay):
-        self.delay = delay
+@_register(0x82, 'r', 'run')
+class C_Run(Message):
+    def __init__(self, watchdog=2**30):
+        self.watchdog = watchdog
 
+    def serialize(self):
+        return self._CODE + ' ' + hex(self.watchdog)[2:]#.zfill(16)
 
-@serialized_field('delay', s_uint8)
-@_register('ts')
-class M_SetSoundTimer(Message):
-    def __init__(self, delay):
-        self.delay = delay
+    def unserialize(self, r):
+        t = r.token()
+        if not t:
+            return False
+        self.watchdog = int(t, 16)
+        return r.at_end()
 
+    def serialize_binary_impl(self, out):
+        Message.serialize_binary_impl(self, out)
+        s_uint64.b(out, uint64_t(self.watchdog))
 
-@_register('?td')
-class Q_DelayTimer(Message):
-    pass
+    def unserialize_binary_impl(self, r):
+        self.watchdog = intmask(s_uint64.ub(r))
 
 
-@serialized_field('delay', s_uint8)
-@_register('!td')
-class A_DelayTimer(Message):
-    def __init__(self, delay):
-        self.delay = delay
+@serialized_field('keys', s_uint16)
+@serialized_field('watchdog', s_uint64)
+@_register(0x83, 'rr', 'runreport')
+class C_RunReport(Message):
+    # sets the keypad like C_Keys, runs like C_Run,
+    # and is followed by M_Cpu and M_DisplayDelta
+    def __init__(self, watchdog=2**30, keys=0):
+        self.watchdog = uint64_t(watchdog)
+        self.keys = uint16_t(keys)
 
 
-@_register('?')
-class Q_NextCommand(Message):
+@serialized_field('keys', s_uint16)
+@_register(0x84, '!keys')
+class C_Keys(Message):
+    # bit n is set while key n is held down
+    def __init__(self, keys=0):
+        self.keys = uint16_t(keys)
+
+
+@serialized_field('path', s_str)
+@_register(0x85, '!load')
+class C_Load(Message):
+    def __init__(self, path=''):
+        self.path = path
+
+
+@serialized_field('encoding', s_str)
+@_register(0x86, '!encoding')
+class C_Encoding(Message):
+    def __init__(self, encoding=''):
+        self.encoding = encoding
+
+
+@serialized_field('max_bytes', s_uint32)
+@serialized_field('seconds', s_uint32)
+@_register(0x87, '!rewind')
+class C_Rewind(Message):
+    def __init__(self, seconds=uint32_t(0), max_bytes=uint32_t(0)):
+        self.seconds = seconds
+        self.max_bytes = max_bytes
+
+
+@_register(0x88, 'back')
+class C_StepBack(Message):
     pass
 
 
-@_register('die')
-class C_Die(Message):
+@_register(0x89, '!snapshot')
+class C_Snapshot(Message):
     pass
 
 
-@_register('s', 'step')
-class C_Step(Message):
+@serialized_field('data', s_bytes)
+@_register(0x8A, '!restore')
+class C_Restore(Message):
+    def __init__(self, data=''):
+        self.data = data
+
+
+@serialized_field('enable', s_bool)
+@_register(0x8B, '!profile')
+class C_Profile(Message):
+    def __init__(self, enable=False):
+        self.enable = enable
+
+
+@_register(0x8C, '!profilereport')
+class C_ProfileReport(Message):
     pass
 
 
-@_register('r', 'run')
-class C_Run(Message):
-    def __init__(self, watchdog=2**30):
-        self.watchdog = watchdog
+@serialized_field('path', s_str)
+@_register(0x8D, '!record')
+class C_Record(Message):
+    def __init__(self, path=''):
+        self.path = path
 
-    def serialize(self):
-        return self._CODE + ' ' + hex(self.watchdog)[2:]#.zfill(16)
 
-    def unserialize(self, m, t):
-        self.watchdog = int(t[1], 16)
-        return True
+@_register(0x8E, '!stoprecord')
+class C_StopRecording(Message):
+    pass
 
 
 @serialized_field('path', s_str)
-@_register('!load')
-class C_Load(Message):
+@_register(0x8F, '!framebuffer')
+class C_Framebuffer(Message):
     def __init__(self, path=''):
         self.path = path
 
 
-@_register('!display')
+@_register(0x90, '!display')
 class C_Display(Message):
     pass
 
 
-@_register('!cpu')
+@_register(0x91, '!ddisplay')
+class C_DisplayDelta(Message):
+    pass
+
+
+@_register(0x92, '!cpu')
 class C_Cpu(Message):
     pass
 
 
-def unserialize(m):
-    tokens = tokenize(m, whitespace=' \t\n\r', op='', comment='')
+@serialized_field('period', s_uint32)
+@_register(0x93, '!timerperiod')
+class C_TimerPeriod(Message):
+    # emulated time per count of the delay and sound timers
+    def __init__(self, period=uint32_t(0)):
+        self.period = period
+
+
+def unserialize(m, pos=0, end=-1):
+    r = TextReader(m, pos, end)
+    code = r.token()
+    if not code:
+        # EOF?
+        return None
     try:
-        cls = _codes[tokens[0]]
+        cls = _codes[code]
     except KeyError:
-        error('bad message: ', tokens[0])
-        return None
-    except IndexError:
-        # EOF?
+        error('bad message: ', code)
         return None
     msg = instantiate(cls)
-    if not msg.unserialize(m, tokens):
-        error('malformed message: ', tokens[0])
+    if not msg.unserialize(r):
+        error('malformed message: ', code)
+        return None
+    return msg
+
+
+def unserialize_binary(m, pos=0, end=-1):
+    if end < 0:
+        end = len(m)
+    if pos >= end:
+        return None
+    i = ord(m[pos])
+    if i >= len(_ids) or _ids[i] is None:
+        error('bad message: ', str(i))
+        return None
+    msg = instantiate(_ids[i])
+    if not msg.unserialize_binary(BinaryReader(m, pos + 1, end)):
+        error('malformed message: ', msg._CODE)
         return None
     return msg
 
@@ -1,8 +1,71 @@
 from rpython.rlib.objectmodel import always_inline, not_rpython
+from rpython.rlib.rarithmetic import intmask
 
 from emulator.types import uint2hex, hex2uint, uint8_t, uint16_t, uint32_t, uint64_t
 
 
+# Readers decode one message from data[pos:end] in place, so a buffer
+# holding several messages does not need to be split up first.
+
+class TextReader:
+    def __init__(self, data, pos=0, end=-1):
+        if end < 0:
+            end = len(data)
+        self.data = data
+        self.pos = pos
+        self.end = end
+
+    def skip(self):
+        while self.pos < self.end and self.data[self.pos] in ' \t\n\r':
+            self.pos += 1
+
+    def token(self):
+        self.skip()
+        start = self.pos
+        while self.pos < self.end and self.data[self.pos] not in ' \t\n\r':
+            self.pos += 1
+        if start == self.pos:
+            # no more tokens, see overrun()
+            self.pos = self.end + 1
+            return ''
+        return self.data[start:self.pos]
+
+    def overrun(self):
+        return self.pos > self.end
+
+    def at_end(self):
+        self.skip()
+        return self.pos == self.end
+
+
+class BinaryReader:
+    def __init__(self, data, pos=0, end=-1):
+        if end < 0:
+            end = len(data)
+        self.data = data
+        self.pos = pos
+        self.end = end
+
+    def read(self, n):
+        # past the end, pos ends up beyond end, see overrun()
+        start = self.pos
+        stop = start + n
+        assert start >= 0 and stop >= start
+        self.pos = stop
+        if stop > self.end:
+            stop = self.end
+            if start > stop:
+                start = stop
+        assert start >= 0 and stop >= start
+        return self.data[start:stop]
+
+    def overrun(self):
+        return self.pos > self.end
+
+    def at_end(self):
+        return self.pos == self.end
+
+
 @not_rpython
 def serialized_field(name, func):
     func = always_inline(func)
@@ -11,6 +74,8 @@ def serialized_field(name, func):
     def impl(cls):
         prev_s = cls.serialize_impl
         prev_u = cls.unserialize_impl
+        prev_sb = cls.serialize_binary_impl
+        prev_ub = cls.unserialize_binary_impl
 
         @always_inline
         def serialize_impl(slf, out):
@@ -19,13 +84,24 @@ def serialized_field(name, func):
             func(out, getattr(slf, name))
 
         @always_inline
-        def unserialize_impl(slf, t):
-            i = prev_u(slf, t)
-            setattr(slf, name, func.u(t[i]))
-            return i + 1
+        def unserialize_impl(slf, r):
+            prev_u(slf, r)
+            setattr(slf, name, func.u(r.token()))
+
+        @always_inline
+        def serialize_binary_impl(slf, out):
+            prev_sb(slf, out)
+            func.b(out, getattr(slf, name))
+
+        @always_inline
+        def unserialize_binary_impl(slf, r):
+            prev_ub(slf, r)
+            setattr(slf, name, func.ub(r))
 
         cls.serialize_impl = serialize_impl
         cls.unserialize_impl = unserialize_impl
+        cls.serialize_binary_impl = serialize_binary_impl
+        cls.unserialize_binary_impl = unserialize_binary_impl
 
         return cls
     return impl
@@ -39,6 +115,8 @@ def serialized_field_list(name, func):
     def impl(cls):
         prev_s = cls.serialize_impl
         prev_u = cls.unserialize_impl
+        prev_sb = cls.serialize_binary_impl
+        prev_ub = cls.unserialize_binary_impl
 
         @always_inline
         def serialize_impl(slf, out):
@@ -51,17 +129,39 @@ def serialized_field_list(name, func):
                 func(out, lst[i])
 
         @always_inline
-        def unserialize_impl(slf, t):
-            i = prev_u(slf, t)
-            ln = s_uint32.u(t[i])
+        def unserialize_impl(slf, r):
+            prev_u(slf, r)
+            ln = s_uint32.u(r.token())
+            lst = []
+            for j in xrange(ln):
+                if r.overrun():
+                    break
+                lst.append(func.u(r.token()))
+            setattr(slf, name, lst)
+
+        @always_inline
+        def serialize_binary_impl(slf, out):
+            prev_sb(slf, out)
+            lst = getattr(slf, name)
+            s_uint32.b(out, uint32_t(len(lst)))
+            for i in xrange(len(lst)):
+                func.b(out, lst[i])
+
+        @always_inline
+        def unserialize_binary_impl(slf, r):
+            prev_ub(slf, r)
+            ln = s_uint32.ub(r)
             lst = []
             for j in xrange(ln):
-                lst.append(func.u(t[i + j + 1]))
+                if r.overrun():
+                    break
+                lst.append(func.ub(r))
             setattr(slf, name, lst)
-            return i + ln + 1
 
         cls.serialize_impl = serialize_impl
         cls.unserialize_impl = unserialize_impl
+        cls.serialize_binary_impl = serialize_binary_impl
+        cls.unserialize_binary_impl = unserialize_binary_impl
 
         return cls
     return impl
@@ -75,6 +175,8 @@ def serialized_field_array(name, ln, func):
     def impl(cls):
         prev_s = cls.serialize_impl
         prev_u = cls.unserialize_impl
+        prev_sb = cls.serialize_binary_impl
+        prev_ub = cls.unserialize_binary_impl
 
         @always_inline
         def serialize_impl(slf, out):
@@ -86,16 +188,33 @@ def serialized_field_array(name, ln, func):
                 func(out, lst[i])
 
         @always_inline
-        def unserialize_impl(slf, t):
-            i = prev_u(slf, t)
+        def unserialize_impl(slf, r):
+            prev_u(slf, r)
             lst = []
             for j in xrange(ln):
-                lst.append(func.u(t[i + j]))
+                lst.append(func.u(r.token()))
+            setattr(slf, name, lst)
+
+        @always_inline
+        def serialize_binary_impl(slf, out):
+            prev_sb(slf, out)
+            lst = getattr(slf, name)
+            assert len(lst) == ln
+            for i in xrange(len(lst)):
+                func.b(out, lst[i])
+
+        @always_inline
+        def unserialize_binary_impl(slf, r):
+            prev_ub(slf, r)
+            lst = []
+            for j in xrange(ln):
+                lst.append(func.ub(r))
             setattr(slf, name, lst)
-            return i + ln
 
         cls.serialize_impl = serialize_impl
         cls.unserialize_impl = unserialize_impl
+        cls.serialize_binary_impl = serialize_binary_impl
+        cls.unserialize_binary_impl = unserialize_binary_impl
 
         return cls
     return impl
@@ -109,6 +228,22 @@ def _unserialize_impl(tgt):
     return impl
 
 
+@not_rpython
+def _serialize_binary_impl(tgt):
+    @not_rpython
+    def impl(func):
+        tgt.b = always_inline(func)
+    return impl
+
+
+@not_rpython
+def _unserialize_binary_impl(tgt):
+    @not_rpython
+    def impl(func):
+        tgt.ub = always_inline(func)
+    return impl
+
+
 def s_str(out, val):
     # TODO quoted
     out.write(val)
@@ -130,6 +265,23 @@ def _s_uint(cls):
     def u_uint(t):
         return hex2uint(cls, t)
 
+    # big-endian, fixed width
+    @_serialize_binary_impl(s_uint)
+    def b_uint(out, val):
+        assert isinstance(val, cls)
+        i = bits - 8
+        while i >= 0:
+            out.write(chr(intmask((val >> i) & 0xFF)))
+            i -= 8
+
+    @_unserialize_binary_impl(s_uint)
+    def ub_uint(r):
+        out = cls(0)
+        data = r.read(bits / 8)
+        for i in xrange(len(data)):
+            out = (out << 8) | cls(ord(data[i]))
+        return out
+
     return s_uint
 
 
@@ -149,3 +301,56 @@ def s_bool(out, val):
 @_unserialize_impl(s_bool)
 def u_bool(t):
     return t != '0'
+
+
+@_serialize_binary_impl(s_bool)
+def b_bool(out, val):
+    if val:
+        out.write('\x01')
+    else:
+        out.write('\x00')
+
+
+@_unserialize_binary_impl(s_bool)
+def ub_bool(r):
+    return r.read(1) != '\x00'
+
+
+@_serialize_binary_impl(s_str)
+def b_str(out, val):
+    s_uint32.b(out, uint32_t(len(val)))
+    out.write(val)
+
+
+@_unserialize_binary_impl(s_str)
+def ub_str(r):
+    ln = s_uint32.ub(r)
+    return r.read(intmask(ln))
+
+
+HEX_DIGITS = '0123456789ABCDEF'
+
+
+def s_bytes(out, val):
+    # arbitrary bytes, hex in the text encoding
+    for c in val:
+        out.write(HEX_DIGITS[ord(c) >> 4])
+        out.write(HEX_DIGITS[ord(c) & 0xF])
+
+
+@_unserialize_impl(s_bytes)
+def u_bytes(t):
+    out = []
+    for i in xrange(0, len(t) - 1, 2):
+        out.append(chr(intmask((hex2uint(uint8_t, t[i:i + 2])))))
+    return ''.join(out)
+
+
+@_serialize_binary_impl(s_bytes)
+def b_bytes(out, val):
+    s_str.b(out, val)
+
+
+@_unserialize_binary_impl(s_bytes)
+def ub_bytes(r):
+    return s_str.ub(r)
@@ -0,0 +1,189 @@
+"""
+This file defines the transport for many sessions sharing one connection,
+such as a Unix socket to an emulator running with `--server`.
+
+Every frame on the connection is a session id followed by a message frame
+in the binary encoding of `Stdio`:
+
+```
+offset  size    contents
+0       4       session id
+4       4       message length n
+8       n       message
+```
+
+All numbers are big-endian. A frame with an empty message opens the
+session; the emulator answers with `M_Version` and `Q_NextCommand` as it
+does on stdio. A message in the frame that opens a session is a protocol
+error, which ends the connection. `C_Die` ends a session, closing the
+connection ends all of them.
+
+Each session is a `SessionPipe`, which can be used wherever a `Stdio` can.
+Output of all sessions is collected and written with a single call.
+"""
+
+import os
+
+from rpython.rlib.objectmodel import not_rpython
+
+from emulator.error import error
+from emulator.io.stdio import (
+    Stdio, ENCODING_BINARY, frame_header, frame_length)
+
+SESSION_ID_SIZE = 4
+SESSION_HEADER_SIZE = SESSION_ID_SIZE + 4
+
+
+def session_header(id):
+    return (chr((id >> 24) & 0xFF) + chr((id >> 16) & 0xFF) +
+            chr((id >> 8) & 0xFF) + chr(id & 0xFF))
+
+
+def session_id(data, pos):
+    return ((ord(data[pos]) << 24) | (ord(data[pos + 1]) << 16) |
+            (ord(data[pos + 2]) << 8) | ord(data[pos + 3]))
+
+
+class Connection:
+    # incoming data is read in chunks of up to this many bytes
+    READ_SIZE = 65536
+
+    def __init__(self, fd, accept=False):
+        self.fd = fd
+        # whether frames for unknown session ids open new sessions
+        self.accept = accept
+        self.sessions = {}
+        # sessions opened by the other side since the last call to take_opened()
+        self.opened = []
+        self.received = ''
+        self.received_pos = 0
+        self.eof = False
+
+    def open(self, id):
+        """Opens a session from this side."""
+        pipe = SessionPipe(self, id)
+        self.sessions[id] = pipe
+        self.send(session_header(id) + frame_header(0))
+        return pipe
+
+    def close_session(self, id):
+        if id in self.sessions:
+            del self.sessions[id]
+
+    def take_opened(self):
+        opened = self.opened
+        self.opened = []
+        return opened
+
+    def send(self, data):
+        while data:
+            n = os.write(self.fd, data)
+            assert n >= 0
+            data = data[n:]
+
+    def flush(self):
+        parts = []
+        for pipe in self.sessions.values():
+            if pipe.pending:
+                parts.append(pipe.take_pending())
+        if parts:
+            self.send(''.join(parts))
+
+    def receive(self):
+        """
+        Blocks until data arrives and hands complete frames to their
+        sessions. Returns False on EOF.
+        """
+        if self.eof:
+            return False
+        self.flush()
+        data = os.read(self.fd, self.READ_SIZE)
+        if not data:
+            self.eof = True
+            return False
+        self.received = self.received[self.received_pos:] + data
+        self.received_pos = 0
+        self.demultiplex()
+        return True
+
+    def demultiplex(self):
+        received = self.received
+        pos = self.received_pos
+        while len(received) - pos >= SESSION_HEADER_SIZE:
+            start = pos + SESSION_HEADER_SIZE
+            end = start + frame_length(received, pos + SESSION_ID_SIZE)
+            if end > len(received):
+                break
+            id = session_id(received, pos)
+            pipe = self.sessions.get(id, None)
+            if pipe is None:
+                if not self.accept:
+                    error('message for unknown session')
+                elif end > start:
+                    error('message in the frame opening session ', str(id))
+                    # nothing after it can be trusted
+                    self.eof = True
+                    break
+                else:
+                    pipe = SessionPipe(self, id)
+                    self.sessions[id] = pipe
+                    self.opened.append(pipe)
+            elif end > start:
+                # the message frame, with its length
+                pipe.deliver(received, pos + SESSION_ID_SIZE, end)
+            pos = end
+        assert pos >= 0
+        self.received_pos = pos
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SessionPipe(Stdio):
+    """One session of a `Connection`, always in the binary encoding."""
+
+    def __init__(self, connection, id):
+        Stdio.__init__(self, None, None)
+        self.binary = True
+        self.connection = connection
+        self.id = id
+
+    def set_encoding(self, encoding):
+        return encoding == ENCODING_BINARY
+
+    def encode(self, msg):
+        return session_header(self.id) + Stdio.encode(self, msg)
+
+    def take_pending(self):
+        data = ''.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        self.pending_last = -1
+        return data
+
+    def flush(self):
+        self.connection.flush()
+
+    def fill(self):
+        # frames for other sessions that arrive meanwhile are kept for them
+        return self.connection.receive()
+
+    def deliver(self, data, start, end):
+        assert start >= 0 and end >= start
+        self.received = self.received[self.received_pos:] + data[start:end]
+        self.received_pos = 0
+
+    def ready(self):
+        """Whether a complete message has arrived."""
+        return self.frame_end() >= 0
+
+
+@not_rpython
+def connect(path):
+    """Connects to an emulator server listening at path."""
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    fd = os.dup(sock.fileno())
+    sock.close()
+    return Connection(fd)
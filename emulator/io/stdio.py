@@ -1,23 +1,150 @@
+import os
+
 from rpython.rlib.objectmodel import not_rpython
 
 from emulator.error import error
-from emulator.io.message import unserialize
+from emulator.io.message import unserialize, unserialize_binary
+
+# the text encoding is always supported and used until a C_Encoding
+# command selects another; binary messages are prefixed by their length
+ENCODING_TEXT = 'text'
+ENCODING_BINARY = 'binary'
+ENCODINGS = [ENCODING_TEXT, ENCODING_BINARY]
+
+
+def frame_header(ln):
+    return (chr((ln >> 24) & 0xFF) + chr((ln >> 16) & 0xFF) +
+            chr((ln >> 8) & 0xFF) + chr(ln & 0xFF))
+
+
+def frame_length(data, pos=0):
+    return ((ord(data[pos]) << 24) | (ord(data[pos + 1]) << 16) |
+            (ord(data[pos + 2]) << 8) | ord(data[pos + 3]))
 
 
 class Stdio:
+    # outgoing messages are held back until the next read, or until this
+    # many bytes are pending
+    BUFFER_SIZE = 4096
+    # incoming data is read in chunks of up to this many bytes, which may
+    # hold any number of messages
+    READ_SIZE = 65536
+
     def __init__(self, i, o):
         self.i = i
         self.o = o
+        self.binary = False
+        self.pending = []
+        self.pending_size = 0
+        # id of the last pending message if it can be coalesced, else -1
+        self.pending_last = -1
+        # received[received_pos:] has been read but not decoded yet
+        self.received = ''
+        self.received_pos = 0
+        # whether the input has been closed
+        self.eof = False
+
+    def set_encoding(self, encoding):
+        if encoding == ENCODING_TEXT:
+            self.binary = False
+        elif encoding == ENCODING_BINARY:
+            self.binary = True
+        else:
+            return False
+        return True
+
+    def encode(self, msg):
+        if self.binary:
+            data = msg.serialize_binary()
+            return frame_header(len(data)) + data
+        else:
+            return msg.serialize() + '\n'
+
+    def write(self, msg):
+        if msg._COALESCE and msg._ID == self.pending_last:
+            # only the latest of consecutive messages matters
+            self.pending_size -= len(self.pending.pop())
+        data = self.encode(msg)
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if msg._COALESCE:
+            self.pending_last = msg._ID
+        else:
+            self.pending_last = -1
+        if self.pending_size >= self.BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.o.write(''.join(self.pending))
+            self.o.flush()
+            self.pending = []
+            self.pending_size = 0
+            self.pending_last = -1
+
+    def fill(self):
+        # blocks until at least one byte arrives, returns False on EOF
+        self.flush()
+        data = os.read(self.i.fileno(), self.READ_SIZE)
+        if not data:
+            return False
+        self.received = self.received[self.received_pos:] + data
+        self.received_pos = 0
+        return True
+
+    def frame_end(self):
+        # end of the next complete message, or -1 if it has not all arrived
+        pos = self.received_pos
+        if self.binary:
+            if len(self.received) - pos < 4:
+                return -1
+            end = pos + 4 + frame_length(self.received, pos)
+            if end > len(self.received):
+                return -1
+            return end
+        else:
+            end = self.received.find('\n', pos)
+            if end < 0:
+                return -1
+            return end + 1
+
+    def decode(self, end):
+        pos = self.received_pos
+        self.received_pos = end
+        if self.binary:
+            return unserialize_binary(self.received, pos + 4, end)
+        else:
+            return unserialize(self.received, pos, end)
+
+    def read(self):
+        self.flush()
+        while True:
+            end = self.frame_end()
+            if end >= 0:
+                return self.decode(end)
+            if not self.fill():
+                self.eof = True
+                return None
+
+    def messages(self):
+        """
+        Yields incoming messages until EOF. Everything that arrived with one
+        read is decoded before reading again. Malformed messages are None.
+        """
+        while True:
+            end = self.frame_end()
+            while end >= 0:
+                yield self.decode(end)
+                end = self.frame_end()
+            if not self.fill():
+                return
 
     def tell(self, msg):
         assert msg is not None
-        self.o.write(msg.serialize())
-        self.o.write('\n')
-        self.o.flush()
+        self.write(msg)
 
     def get(self):
-        msg = self.i.readline()
-        return unserialize(msg)
+        return self.read()
 
     def ask(self, question):
         assert question is not None
@@ -32,12 +159,11 @@ class StdioTest(Stdio):
 
     def tell(self, msg):
         assert msg is not None
-        s = msg.serialize()
-        error('>>> ', s)
-        self.o.write(s)
-        self.o.write('\n')
+        error('>>> ', msg.serialize())
+        self.write(msg)
 
-    def get(self):
-        msg = self.i.readline()
-        error('<<< ', msg.rstrip())
-        return unserialize(msg)
+    def decode(self, end):
+        msg = Stdio.decode(self, end)
+        if msg is not None:
+            error('<<< ', msg.serialize())
+        return msg
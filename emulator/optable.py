@@ -0,0 +1,94 @@
+"""
+This file defines the `OpcodeTable` class.
+
+An opcode table selects the handler for an instruction word by indexing
+a list with one of its fields, so every opcode costs the same to dispatch.
+A slot can refer to a second-level table indexed by another field.
+For example:
+
+```
+class Machine:
+    OPCODES = OpcodeTable(12, 0xF)
+    ARITH = OPCODES.subtable(0x8000, OpcodeTable(0, 0xF))
+
+    def execute(self, ins):
+        self.OPCODES.lookup(ins)(self, ins)
+
+    @OPCODES.handler(0x1000)
+    def op_jump(self, ins):
+        # handle 0x1nnn
+
+    @ARITH.handler(0x8004)
+    def op_add(self, ins):
+        # handle 0x8xy4
+
+    @OPCODES.unhandler
+    @ARITH.unhandler
+    def op_unknown(self, ins):
+        # handle everything else
+```
+
+All handlers must accept the same arguments. The unhandler fills the
+slots that are still empty, so it must come after all other handlers.
+Lookups are meant to be done once per instruction word and cached.
+`key(opcode)` keeps only the fields of an instruction word that select
+its handler, which identifies the opcode, e.g. 0x8004 for 0x8AB4.
+"""
+
+from rpython.rlib.objectmodel import not_rpython
+
+
+class OpcodeTable:
+    @not_rpython
+    def __init__(self, shift, mask):
+        self.shift = shift
+        self.mask = mask
+        self.handlers = [None] * (mask + 1)
+        self.subtables = [None] * (mask + 1)
+
+    def _freeze_(self):
+        return True
+
+    @not_rpython
+    def _index(self, opcode):
+        return (opcode >> self.shift) & self.mask
+
+    @not_rpython
+    def handler(self, *opcodes):
+        @not_rpython
+        def annotate(func):
+            for opcode in opcodes:
+                i = self._index(opcode)
+                assert self.handlers[i] is None and self.subtables[i] is None
+                self.handlers[i] = func
+            return func
+        return annotate
+
+    @not_rpython
+    def subtable(self, opcode, table):
+        i = self._index(opcode)
+        assert self.handlers[i] is None and self.subtables[i] is None
+        self.subtables[i] = table
+        return table
+
+    @not_rpython
+    def unhandler(self, func):
+        for i in xrange(len(self.handlers)):
+            if self.handlers[i] is None and self.subtables[i] is None:
+                self.handlers[i] = func
+        return func
+
+    def lookup(self, opcode):
+        i = (opcode >> self.shift) & self.mask
+        table = self.subtables[i]
+        if table is not None:
+            return table.lookup(opcode)
+        return self.handlers[i]
+
+    def key(self, opcode):
+        i = (opcode >> self.shift) & self.mask
+        key = opcode & (self.mask << self.shift)
+        table = self.subtables[i]
+        if table is not None:
+            key |= table.key(opcode)
+        return key
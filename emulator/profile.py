@@ -0,0 +1,35 @@
+"""
+This file defines the `Profile` class.
+
+While profiling is switched on with `C_Profile`, every instruction is
+recorded with its opcode (see `OpcodeTable.key`), its address and the
+emulated time it took, including costs added during execution such as
+skipping or drawing. `C_ProfileReport` returns the totals as `M_Profile`.
+
+Profiling runs instructions one at a time, without blocks or the JIT, so
+it changes how fast the emulator runs but not the emulated time.
+"""
+
+
+class Profile:
+    def __init__(self):
+        # opcodes in order of first execution, and their position there
+        self.opcodes = []
+        self.index = {}
+        # executions and emulated time per opcode
+        self.counts = []
+        self.cycles = []
+        # executions per address
+        self.pcs = [0] * 0x1000
+
+    def record(self, opcode, pc, cycles):
+        i = self.index.get(opcode, -1)
+        if i < 0:
+            i = len(self.opcodes)
+            self.index[opcode] = i
+            self.opcodes.append(opcode)
+            self.counts.append(0)
+            self.cycles.append(0)
+        self.counts[i] += 1
+        self.cycles[i] += cycles
+        self.pcs[pc & 0xFFF] += 1
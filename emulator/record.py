@@ -0,0 +1,168 @@
+"""
+This file defines the input log of a session, see `C_Record`.
+
+Apart from its inputs, the emulated machine is deterministic: the timers
+count emulated time and the random generator is part of the snapshot.
+A log therefore starts with a snapshot of the machine, followed by every
+change of the keypad, stamped with the emulated time it happened at. Key
+presses that end `LD Vx, K` are among them, see `Chip8.poll_key`:
+
+```
+'CH8R', version                 5 bytes
+execution mode                  1 byte
+snapshot length, snapshot       4 + n bytes
+events: time, kind, value       11 bytes each
+```
+
+All numbers are big-endian. `EVENT_KEYS` sets the keypad state between
+runs, `EVENT_STEP` executes a single instruction (`C_Step`), which may stop
+in the middle of a basic block, and `EVENT_END` marks the time recording
+stopped. Every event is written to the file as it happens; changes of the
+keypad are rare enough that this costs nothing. A log cut short by a crash
+can therefore still be replayed up to its last complete event, but as it
+lacks `EVENT_END`, `replay` reports it as not followed to the end.
+
+Where a run ends depends on how it executes: in basic blocks, or one
+instruction at a time while profiling or in the JIT build. `replay` runs a
+machine through a log as fast as possible, in the execution mode of the
+recording, so that its runs end at the same times. Starting or stopping
+profiling changes the mode and ends the recording.
+"""
+
+import os
+
+from rpython.rlib.rarithmetic import intmask
+from rpython.rlib.rStringIO import RStringIO
+
+from emulator.error import error
+from emulator.io.serialize import BinaryReader, s_uint8, s_uint16, s_uint32, s_uint64
+from emulator.snapshot import snapshot, restore
+from emulator.types import uint8_t, uint16_t, uint32_t, uint64_t
+
+MAGIC = 'CH8R'
+VERSION = 4
+
+MODE_BLOCKS = 0
+MODE_INSTRUCTIONS = 1
+
+EVENT_KEYS = 1
+EVENT_END = 2
+EVENT_STEP = 3
+
+EVENT_SIZE = 11
+
+
+class RecordError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+
+class Recorder:
+    """
+    Writes the input log of a machine. Raises RecordError if the file
+    cannot be written, and closes it.
+    """
+
+    def __init__(self, path, chip8):
+        try:
+            self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                              0644)
+        except OSError:
+            raise RecordError('cannot open ' + path)
+        state = snapshot(chip8)
+        out = RStringIO()
+        out.write(MAGIC)
+        out.write(chr(VERSION))
+        if chip8.BLOCK_MODE and chip8.profile is None:
+            out.write(chr(MODE_BLOCKS))
+        else:
+            out.write(chr(MODE_INSTRUCTIONS))
+        s_uint32.b(out, uint32_t(len(state)))
+        out.write(state)
+        self.write(out.getvalue())
+
+    def event(self, time, kind, value):
+        out = RStringIO()
+        s_uint64.b(out, uint64_t(time))
+        s_uint8.b(out, uint8_t(kind))
+        s_uint16.b(out, uint16_t(value))
+        self.write(out.getvalue())
+
+    def write(self, data):
+        while data:
+            try:
+                n = os.write(self.fd, data)
+            except OSError:
+                os.close(self.fd)
+                raise RecordError('cannot write the input log')
+            assert n >= 0
+            data = data[n:]
+
+    def close(self, time):
+        self.event(time, EVENT_END, 0)
+        os.close(self.fd)
+
+
+class Log:
+    def __init__(self, data):
+        r = BinaryReader(data)
+        if r.read(4) != MAGIC or r.read(1) != chr(VERSION):
+            raise RecordError('not an input log')
+        self.mode = intmask(s_uint8.ub(r))
+        if self.mode != MODE_BLOCKS and self.mode != MODE_INSTRUCTIONS:
+            raise RecordError('unknown execution mode in input log')
+        self.snapshot = r.read(intmask(s_uint32.ub(r)))
+        if r.overrun():
+            raise RecordError('input log too short')
+        self.times = []
+        self.kinds = []
+        self.values = []
+        while r.end - r.pos >= EVENT_SIZE:
+            self.times.append(intmask(s_uint64.ub(r)))
+            self.kinds.append(intmask(s_uint8.ub(r)))
+            self.values.append(s_uint16.ub(r))
+
+
+def read_log(path):
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        raise RecordError('cannot open ' + path)
+    chunks = []
+    try:
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        os.close(fd)
+    return Log(''.join(chunks))
+
+
+def replay(chip8, log):
+    """
+    Restores the snapshot of log into chip8 and runs it through all
+    events. Returns False if the machine did not follow the recording, or
+    if the log ends before the recording was stopped.
+    """
+    if not restore(chip8, log.snapshot):
+        raise RecordError('invalid snapshot in input log')
+    chip8.BLOCK_MODE = log.mode == MODE_BLOCKS
+    in_sync = True
+    for i in range(len(log.kinds)):
+        # a run ends early where LD Vx, K starts to wait
+        while chip8.time < log.times[i] and not chip8.paused:
+            chip8.run(log.times[i] - chip8.time)
+        if chip8.time != log.times[i]:
+            in_sync = False
+        if log.kinds[i] == EVENT_KEYS:
+            chip8.keys = log.values[i]
+        elif log.kinds[i] == EVENT_STEP:
+            chip8.step()
+    if not in_sync:
+        error('replay did not follow the input log')
+    elif len(log.kinds) == 0 or log.kinds[-1] != EVENT_END:
+        error('input log ends before the recording was stopped')
+        in_sync = False
+    return in_sync
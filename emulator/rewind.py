@@ -0,0 +1,199 @@
+"""
+This file defines the `Rewind` buffer.
+
+While rewinding is enabled (see `C_Rewind`), the emulator takes a
+checkpoint after a run once at least `interval` of emulated time has
+passed since the last one. Runs are not cut at checkpoints, so with runs
+shorter than `interval` the checkpoints are further apart. A checkpoint
+does not copy the machine. Instead it records how to get back to the
+previous checkpoint: the memory pages written since then (see
+`Memory.take_dirty_pages`), the display rows drawn or cleared since then
+(see `Display.take_changed`), and the registers and timers. Copying and
+stepping back therefore cost time and space in proportion to what changed.
+
+Entries are kept in a ring of the checkpoints taken in the last `seconds`
+of emulated time, holding at most `max_bytes` of saved pages and rows; the
+oldest entries are dropped first.
+"""
+
+# approximate size of the fixed part of an entry, for the memory cap
+ENTRY_SIZE = 64
+ROW_SIZE = 8
+
+
+class State:
+    """Registers, timers and counters at a checkpoint."""
+
+    def __init__(self, chip8):
+        cpu = chip8.cpu
+        self.program_counter = cpu.program_counter
+        self.stack_pointer = cpu.stack_pointer
+        self.index_register = cpu.index_register
+        self.general_registers = cpu.general_registers[:]
+        self.time = chip8.time
+        self.instructions = chip8.instructions
+        self.paused = chip8.paused
+        self.errors = chip8.errors
+        self.waiting_key = chip8.waiting_key
+        self.waiting_held = chip8.waiting_held
+        self.delay_end = chip8.delay_timer.end
+        self.sound_end = chip8.sound_timer.end
+        self.timer_period = chip8.delay_timer.period
+        self.random_index = chip8.random.index
+        # only copied when it changed, see Rewind.checkpoint
+        self.random_state = None
+
+    def apply(self, chip8):
+        cpu = chip8.cpu
+        cpu.program_counter = self.program_counter
+        cpu.stack_pointer = self.stack_pointer
+        cpu.index_register = self.index_register
+        cpu.general_registers = self.general_registers[:]
+        chip8.time = self.time
+        chip8.instructions = self.instructions
+        chip8.paused = self.paused
+        chip8.errors = self.errors
+        chip8.waiting_key = self.waiting_key
+        chip8.waiting_held = self.waiting_held
+        chip8.delay_timer.end = self.delay_end
+        chip8.sound_timer.end = self.sound_end
+        chip8.delay_timer.period = self.timer_period
+        chip8.sound_timer.period = self.timer_period
+        chip8.random.index = self.random_index
+
+
+class Entry:
+    """How to get from one checkpoint back to the one before it."""
+
+    def __init__(self, state, pages, page_data, rows, row_data):
+        self.state = state
+        self.pages = pages
+        self.page_data = page_data
+        self.rows = rows
+        self.row_data = row_data
+
+    def size(self):
+        size = ENTRY_SIZE + ROW_SIZE * len(self.rows)
+        for data in self.page_data:
+            size += len(data)
+        if self.state.random_state is not None:
+            size += 4 * len(self.state.random_state)
+        return size
+
+
+class Rewind:
+    def __init__(self, chip8, interval, seconds, max_bytes):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        # emulated time the checkpoints are kept for; as they are at least
+        # interval apart, the ring never fills up before
+        self.span = seconds * 1000000
+        capacity = (self.span + interval - 1) / interval
+        if capacity < 1:
+            capacity = 1
+        self.entries = [None] * capacity
+        # entries[first:first + count] (modulo capacity), oldest first
+        self.first = 0
+        self.count = 0
+        self.size = 0
+        # the machine at the last checkpoint
+        ram = chip8.ram
+        ram.take_dirty_pages()
+        self.ram = [ram.read_page(page) for page in range(len(ram.dirty_pages))]
+        chip8.display.take_changed()
+        self.rows = chip8.display.data[:]
+        self.state = State(chip8)
+        self.random_state = chip8.random.state[:]
+
+    def maybe_checkpoint(self, chip8):
+        if chip8.time - self.state.time >= self.interval:
+            self.checkpoint(chip8)
+
+    def checkpoint(self, chip8):
+        ram = chip8.ram
+        pages = ram.take_dirty_pages()
+        page_data = []
+        for page in pages:
+            page_data.append(self.ram[page])
+            self.ram[page] = ram.read_page(page)
+        rows = []
+        row_data = []
+        data = chip8.display.data
+        for y in chip8.display.take_changed():
+            # drawing twice may have restored the row
+            if data[y] != self.rows[y]:
+                rows.append(y)
+                row_data.append(self.rows[y])
+                self.rows[y] = data[y]
+        state = self.state
+        if chip8.random.state != self.random_state:
+            state.random_state = self.random_state
+            self.random_state = chip8.random.state[:]
+        self.state = State(chip8)
+        self.push(Entry(state, pages, page_data, rows, row_data))
+
+    def push(self, entry):
+        capacity = len(self.entries)
+        if self.count == capacity:
+            self.drop_oldest()
+        self.entries[(self.first + self.count) % capacity] = entry
+        self.count += 1
+        self.size += entry.size()
+        start = self.state.time - self.span
+        while self.count > 0 and (
+                self.size > self.max_bytes or
+                self.entries[self.first].state.time < start):
+            self.drop_oldest()
+
+    def drop_oldest(self):
+        entry = self.entries[self.first]
+        assert entry is not None
+        self.entries[self.first] = None
+        self.first = (self.first + 1) % len(self.entries)
+        self.count -= 1
+        self.size -= entry.size()
+
+    def revert(self, chip8, pages, rows):
+        """
+        Undoes everything since the last checkpoint, and the given pages
+        and rows of an entry stepped back over.
+        """
+        ram = chip8.ram
+        for page in ram.take_dirty_pages() + pages:
+            ram.write_page(page, self.ram[page])
+        ram.take_dirty_pages()
+        display = chip8.display
+        for y in display.take_changed() + rows:
+            if display.data[y] != self.rows[y]:
+                display.data[y] = self.rows[y]
+                display.dirty[y] = True
+        self.state.apply(chip8)
+        if chip8.random.state != self.random_state:
+            chip8.random.state = self.random_state[:]
+
+    def step_back(self, chip8):
+        """
+        Goes back to the last checkpoint, or if the machine has not run
+        since, to the one before. Returns False if there is none.
+        """
+        if chip8.time != self.state.time:
+            self.revert(chip8, [], [])
+            return True
+        if self.count == 0:
+            return False
+        last = (self.first + self.count - 1) % len(self.entries)
+        entry = self.entries[last]
+        assert entry is not None
+        self.entries[last] = None
+        self.count -= 1
+        self.size -= entry.size()
+        for i in range(len(entry.pages)):
+            self.ram[entry.pages[i]] = entry.page_data[i]
+        for i in range(len(entry.rows)):
+            self.rows[entry.rows[i]] = entry.row_data[i]
+        self.state = entry.state
+        if entry.state.random_state is not None:
+            self.random_state = entry.state.random_state
+            entry.state.random_state = None
+        self.revert(chip8, entry.pages, entry.rows)
+        return True
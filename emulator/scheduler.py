@@ -0,0 +1,113 @@
+"""
+This file defines the `Scheduler` class.
+
+A scheduler runs many `Chip8` instances in one thread by giving each of
+them a fixed quantum of emulated time in turn. Machines that cannot run,
+because they are paused or wait in `LD Vx, K` for a key, are skipped for
+that round; the keypad of a waiting machine is polled first. As with
+`Chip8.run`, the time of a waiting machine still passes, so its timers
+keep counting down. For example:
+
+```
+scheduler = Scheduler(quantum=20000)
+for chip8 in machines:
+    scheduler.add(chip8)
+while scheduler.run_round():
+    pass
+for task in scheduler.tasks:
+    print task.instructions, task.throughput()
+print scheduler.fairness()
+```
+
+Every machine is charged the emulated time it actually used, which can be
+slightly more than the quantum because blocks are not interrupted.
+"""
+
+import time
+
+
+class Task:
+    """Per-machine counters of a `Scheduler`."""
+
+    def __init__(self, chip8):
+        self.chip8 = chip8
+        # number of quanta the machine was given and skipped
+        self.slices = 0
+        self.skipped = 0
+        # emulated time and instructions used in those quanta
+        self.cycles = 0
+        self.instructions = 0
+        # wall time spent running the machine, in seconds
+        self.wall = 0.0
+
+    def throughput(self):
+        """Instructions per second of wall time."""
+        if self.wall <= 0.0:
+            return 0.0
+        return self.instructions / self.wall
+
+
+class Scheduler:
+    def __init__(self, quantum=10000):
+        self.quantum = quantum
+        self.tasks = []
+        self.rounds = 0
+
+    def add(self, chip8):
+        task = Task(chip8)
+        self.tasks.append(task)
+        return task
+
+    def remove(self, chip8):
+        for i in range(len(self.tasks)):
+            if self.tasks[i].chip8 is chip8:
+                del self.tasks[i]
+                return
+
+    def run_round(self):
+        """
+        Gives every runnable machine one quantum. Returns whether any
+        machine was runnable.
+        """
+        ran = False
+        for task in self.tasks:
+            chip8 = task.chip8
+            if chip8.paused:
+                task.skipped += 1
+                continue
+            if chip8.waiting_key >= 0 and not chip8.poll_key():
+                # only lets the quantum pass, see Chip8.run
+                chip8.run(self.quantum)
+                task.skipped += 1
+                continue
+            ran = True
+            cycles = chip8.time
+            instructions = chip8.instructions
+            start = time.time()
+            chip8.run(self.quantum)
+            task.wall += time.time() - start
+            task.cycles += chip8.time - cycles
+            task.instructions += chip8.instructions - instructions
+            task.slices += 1
+        self.rounds += 1
+        return ran
+
+    def fairness(self):
+        """
+        Jain's index of the emulated time per quantum of the machines that
+        ran: 1.0 if every quantum was equally long, down to 1/n if one
+        machine got all the time.
+        """
+        total = 0.0
+        squares = 0.0
+        n = 0
+        for task in self.tasks:
+            if task.slices == 0:
+                continue
+            share = float(task.cycles) / task.slices
+            total += share
+            squares += share * share
+            n += 1
+        if squares == 0.0:
+            return 1.0
+        return total * total / (n * squares)
@@ -0,0 +1,149 @@
+"""
+This file defines the save-state format of a `Chip8`.
+
+A snapshot is a binary string holding the complete machine state, using
+the binary encoding of message fields:
+
+```
+'CH8S', version                 5 bytes
+cpu: pc, sp, i, v0..vf          22 bytes
+memory                          4096 bytes
+display: height, rows           2 + 8 * height bytes
+time, watchdog, instructions     24 bytes
+paused, errors, keys             7 bytes
+LD Vx, K: x or 0xFF, held keys  3 bytes
+delay and sound timer end        16 bytes
+timer period                     4 bytes
+random: index, state             4 + 4 * 624 bytes
+```
+
+Restoring keeps the instructions decoded from memory that did not
+change, so restoring snapshots of the same program is cheap.
+"""
+
+from rpython.rlib.rarithmetic import intmask, r_uint
+from rpython.rlib.rStringIO import RStringIO
+
+from emulator.io.serialize import (
+    BinaryReader, s_bool, s_uint8, s_uint16, s_uint32, s_uint64)
+from emulator.types import uint8_t, uint16_t, uint32_t, uint64_t
+
+MAGIC = 'CH8S'
+VERSION = 3
+
+# waiting register of a machine that is not in LD Vx, K
+NOT_WAITING = 0xFF
+
+
+def snapshot(chip8):
+    out = RStringIO()
+    out.write(MAGIC)
+    out.write(chr(VERSION))
+
+    cpu = chip8.cpu
+    s_uint16.b(out, cpu.program_counter)
+    s_uint16.b(out, cpu.stack_pointer)
+    s_uint16.b(out, cpu.index_register)
+    for reg in cpu.general_registers:
+        out.write(chr(intmask(reg)))
+
+    out.write(str(chip8.ram.contents))
+
+    display = chip8.display
+    s_uint16.b(out, uint16_t(display.height))
+    for row in display.data:
+        s_uint64.b(out, row)
+
+    s_uint64.b(out, uint64_t(chip8.time))
+    s_uint64.b(out, uint64_t(chip8.watchdog))
+    s_uint64.b(out, uint64_t(chip8.instructions))
+    s_bool.b(out, chip8.paused)
+    s_uint32.b(out, uint32_t(chip8.errors))
+    s_uint16.b(out, chip8.keys)
+    if chip8.waiting_key < 0:
+        s_uint8.b(out, uint8_t(NOT_WAITING))
+    else:
+        s_uint8.b(out, uint8_t(chip8.waiting_key))
+    s_uint16.b(out, chip8.waiting_held)
+    s_uint64.b(out, uint64_t(chip8.delay_timer.end))
+    s_uint64.b(out, uint64_t(chip8.sound_timer.end))
+    s_uint32.b(out, uint32_t(chip8.delay_timer.period))
+
+    random = chip8.random
+    s_uint32.b(out, uint32_t(random.index))
+    for word in random.state:
+        s_uint32.b(out, uint32_t(intmask(word)))
+    return out.getvalue()
+
+
+def restore(chip8, data):
+    """
+    Restores a snapshot. Returns False and leaves chip8 unchanged if data
+    is not a valid snapshot for it.
+    """
+    r = BinaryReader(data)
+    if r.read(4) != MAGIC or r.read(1) != chr(VERSION):
+        return False
+
+    pc = s_uint16.ub(r)
+    sp = s_uint16.ub(r)
+    index = s_uint16.ub(r)
+    # an instruction, a stack entry and I all have to lie within memory;
+    # the stack grows upwards from 0 in steps of 2
+    if pc > 0xFFE or sp > 0xFFE or sp & 1 != 0 or index > 0xFFF:
+        return False
+    registers = [uint8_t(ord(c)) for c in r.read(16)]
+
+    contents = r.read(0x1000)
+
+    height = intmask(s_uint16.ub(r))
+    if height != chip8.display.height:
+        return False
+    rows = [s_uint64.ub(r) for i in range(height)]
+
+    time = intmask(s_uint64.ub(r))
+    watchdog = intmask(s_uint64.ub(r))
+    instructions = intmask(s_uint64.ub(r))
+    paused = s_bool.ub(r)
+    errors = intmask(s_uint32.ub(r))
+    keys = s_uint16.ub(r)
+    waiting_key = intmask(s_uint8.ub(r))
+    if waiting_key == NOT_WAITING:
+        waiting_key = -1
+    elif waiting_key > 0xF:
+        return False
+    waiting_held = s_uint16.ub(r)
+    delay_end = intmask(s_uint64.ub(r))
+    sound_end = intmask(s_uint64.ub(r))
+    timer_period = intmask(s_uint32.ub(r))
+    if timer_period <= 0:
+        return False
+
+    random_index = intmask(s_uint32.ub(r))
+    random_state = [r_uint(intmask(s_uint32.ub(r)))
+                    for i in range(len(chip8.random.state))]
+    if not r.at_end():
+        return False
+
+    chip8.cpu.program_counter = pc
+    chip8.cpu.stack_pointer = sp
+    chip8.cpu.index_register = index
+    chip8.cpu.general_registers = registers
+    chip8.ram.restore(contents)
+    chip8.display.data = rows
+    chip8.display.mark_dirty()
+    chip8.time = time
+    chip8.watchdog = watchdog
+    chip8.instructions = instructions
+    chip8.paused = paused
+    chip8.errors = errors
+    chip8.keys = keys
+    chip8.waiting_key = waiting_key
+    chip8.waiting_held = waiting_held
+    chip8.delay_timer.end = delay_end
+    chip8.sound_timer.end = sound_end
+    chip8.delay_timer.period = timer_period
+    chip8.sound_timer.period = timer_period
+    chip8.random.index = random_index
+    chip8.random.state = random_state
+    return True
@@ -4,8 +4,11 @@ import pytest
 
 from assembler.chip8 import assemble
 from emulator.chip8 import Io
+from emulator.io.stdio import ENCODING_BINARY, ENCODING_TEXT
 from emulator.test.conftest import option
-from emulator.types import uint8_t
+from emulator.types import uint8_t, uint16_t
+from rpython.jit.metainterp.test.support import LLJitMixin
+from rpython.rlib.rarithmetic import intmask
 
 pytestmark = pytest.mark.timeout(10)
 
@@ -14,37 +17,38 @@ class IoTest(Io):
     def __init__(self):
         self.events = []
         self.events_expected = [("sync",)]
-        self.val_is_key_down = False
-        self.val_next_key = 0
-        self.val_delay = 0
 
     def sync(self, time):
         self.events.append(("sync",))
 
-    def is_key_down(self, key):
-        self.events.append(("is_key_down", key))
-        return self.val_is_key_down
+    def set_sound(self, on):
+        self.events.append(("set_sound", on))
 
-    def next_key(self):
-        self.events.append(("next_key",))
-        return uint8_t(self.val_next_key)
 
-    def set_sound(self, delay):
-        self.events.append(("set_sound", delay))
+class PipeTest:
+    def __init__(self):
+        self.told = []
+
+    def tell(self, msg):
+        self.told.append(msg)
 
-    def set_delay(self, delay):
-        self.events.append(("set_delay", delay))
 
-    def get_delay(self):
-        self.events.append(("get_delay",))
-        return uint8_t(self.val_delay)
+@pytest.fixture(scope="function")
+def program(request):
+    """
+    The program in the docstring of the test, assembled. Tests without a
+    docstring share the program in the docstring of their class.
+    """
+    doc = request.function.__doc__
+    if doc is None:
+        doc = request.cls.__doc__
+    return assemble(doc.splitlines())
 
 
 @pytest.yield_fixture(scope="function")
-def chip8(request):
+def chip8(request, program):
     lines = request.function.__doc__.splitlines()
-    code = assemble(lines)
-    ctx = request.instance.get_chip8(code)
+    ctx = request.instance.get_chip8(program)
     chip8 = next(ctx)
     if lines[0][:7] == ";steps=":
         for i in range(int(lines[0][7:])):
@@ -63,6 +67,28 @@ def chip8(request):
         assert False
 
 
+def load_chip8(code, io=None):
+    """A machine with code loaded, for tests that drive it themselves."""
+    from emulator.chip8 import Chip8
+    if io is None:
+        io = IoTest()
+    chip8 = Chip8(PipeTest(), io)
+    chip8.ram.load_bin(code)
+    return chip8
+
+
+def state(chip8):
+    """Everything about a machine that two ways of running it must agree on."""
+    cpu = chip8.cpu
+    return (cpu.program_counter, cpu.stack_pointer, cpu.index_register,
+            list(cpu.general_registers), chip8.ram.contents[:],
+            chip8.display.data[:], chip8.time, chip8.instructions,
+            chip8.paused, chip8.keys, chip8.waiting_key,
+            chip8.delay_timer.end, chip8.sound_timer.end,
+            chip8.delay_timer.period, chip8.sound_timer.period,
+            chip8.random.index, chip8.random.state[:])
+
+
 class TestChip8:
     def get_chip8(self, code):
         from emulator.chip8 import Chip8
@@ -470,8 +496,7 @@ class TestChip8:
             HLT
             HLT
         """
-        chip8.io.val_is_key_down = False
-        chip8.io.events_expected = [("sync",), ("is_key_down", 5), ("sync",)]
+        chip8.keys = uint16_t(0xFFFF & ~(1 << 5))
         chip8.run()
         assert chip8.cpu.program_counter == 0x204
     
@@ -482,8 +507,7 @@ class TestChip8:
             HLT
             HLT
         """
-        chip8.io.val_is_key_down = True
-        chip8.io.events_expected = [("sync",), ("is_key_down", 6), ("sync",)]
+        chip8.keys = uint16_t(1 << 6)
         chip8.run()
         assert chip8.cpu.program_counter == 0x206
     
@@ -494,8 +518,7 @@ class TestChip8:
             HLT
             HLT
         """
-        chip8.io.val_is_key_down = False
-        chip8.io.events_expected = [("sync",), ("is_key_down", 5), ("sync",)]
+        chip8.keys = uint16_t(0xFFFF & ~(1 << 5))
         chip8.run()
         assert chip8.cpu.program_counter == 0x206
     
@@ -506,42 +529,109 @@ class TestChip8:
             HLT
             HLT
         """
-        chip8.io.val_is_key_down = True
-        chip8.io.events_expected = [("sync",), ("is_key_down", 6), ("sync",)]
+        chip8.keys = uint16_t(1 << 6)
         chip8.run()
         assert chip8.cpu.program_counter == 0x204
         
-    def test_get_delay(self, chip8):
+    def test_if_key_step(self, chip8):
         """;steps=0
-            LD V3, DT
+            LD V1, 0xA
+            IFUP V1
+            HLT
+            IFDN V1
+            HLT
+            HLT
         """
-        chip8.io.val_delay = 0xFC
-        chip8.io.events_expected = [("sync",), ("get_delay",)]
+        chip8.io.events_expected = []
+        chip8.step()
+        chip8.keys = uint16_t(1 << 0xA)
         chip8.step()
+        assert chip8.cpu.program_counter == 0x206
+        chip8.keys = uint16_t(0)
+        chip8.step()
+        assert chip8.cpu.program_counter == 0x20A
+
+    def test_get_delay(self, chip8):
+        """;steps=3
+            LD V4, 0xFC
+            LD DT, V4
+            LD V3, DT
+        """
+        chip8.io.events_expected = []
         assert chip8.cpu.general_registers[3] == 0xFC
 
     def test_next_key(self, chip8):
         """;steps=0
             LD V7, K
+            LD V8, 1
         """
-        chip8.io.val_next_key = 0xB
-        chip8.io.events_expected = [("sync",), ("next_key",)]
+        chip8.io.events_expected = []
+        chip8.keys = uint16_t(1 << 2)
+        chip8.step()
+        # keys that are already down do not count
+        chip8.step()
+        assert chip8.cpu.program_counter == 0x202
+        assert chip8.cpu.general_registers[8] == 0
+        chip8.keys = uint16_t(1 << 2 | 1 << 0xB)
         chip8.step()
         assert chip8.cpu.general_registers[7] == 0xB
+        assert chip8.cpu.general_registers[8] == 1
 
-    def test_set_delay(self, chip8):
-        """;steps=2
-            LD V4, 0xAB
+    def test_next_key_run(self, chip8):
+        """;steps=0
+            LD V7, K
+            LD V8, 1
+            HLT
+        """
+        chip8.io.events_expected = [("sync",)] * 3
+        # the run ends as the wait starts, and does not block
+        chip8.run(100000)
+        assert chip8.cpu.program_counter == 0x202
+        chip8.run(100000)
+        assert chip8.cpu.program_counter == 0x202
+        assert chip8.cpu.general_registers[8] == 0
+        chip8.keys = uint16_t(1 << 3)
+        chip8.run(100000)
+        assert chip8.cpu.general_registers[7] == 3
+        assert chip8.cpu.general_registers[8] == 1
+        assert chip8.paused
+
+    def test_delay_counts_down(self, chip8):
+        """
+            LD V4, 5
             LD DT, V4
+        loop:
+            ADD V5, 1
+            SE V5, 0
+            JP loop
+            LD V3, DT
+            HLT
         """
-        chip8.io.events_expected = [("sync",), ("set_delay", 0xAB)]
+        # 256 iterations take about three periods
+        assert chip8.cpu.general_registers[3] == 2
 
     def test_set_sound(self, chip8):
         """;steps=2
             LD V4, 0xBC
             LD ST, V4
         """
-        chip8.io.events_expected = [("sync",), ("set_sound", 0xBC)]
+        chip8.io.events_expected = [("sync",), ("set_sound", True)]
+
+    def test_sound_stops(self, chip8):
+        """
+            LD V4, 2
+            LD ST, V4
+        loop:
+            ADD V5, 1
+            SE V5, 0
+            JP loop
+            ADD V6, 1
+            SE V6, 2
+            JP loop
+            HLT
+        """
+        chip8.io.events_expected = [("sync",), ("set_sound", True),
+                                    ("set_sound", False), ("sync",)]
 
     def test_add_index(self, chip8):
         """
@@ -607,6 +697,1205 @@ class TestChip8:
         assert chip8.cpu.general_registers[1] == 3
         assert chip8.cpu.general_registers[2] == 4
 
+    def test_self_modifying(self, chip8):
+        """
+            LD V0, 61h  ; LD V1, 23h
+            LD V1, 23h
+            LD I, patch
+            LD [I], V1
+        patch:
+            LD V1, 0
+            HLT
+        """
+        assert chip8.cpu.general_registers[1] == 0x23
+
+
+class TestChip8Interpreted(TestChip8):
+    def get_chip8(self, code):
+        for chip8 in TestChip8.get_chip8(self, code):
+            chip8.BLOCK_MODE = False
+            yield chip8
+
+
+class TestBlocks:
+    def build(self, code):
+        from emulator.chip8 import Chip8
+        chip8 = Chip8(None, IoTest())
+        chip8.ram.load_bin(assemble(code.splitlines()))
+        return chip8
+
+    def test_ends_at_jump(self):
+        chip8 = self.build("""
+            LD V1, 1
+            ADD V1, 2
+            JP 300h
+            LD V2, 3
+        """)
+        block = chip8.build_block(0x200)
+        assert len(block.instructions) == 3
+        assert block.cost == 27 + 45 + 105
+
+    def test_ends_at_skip(self):
+        chip8 = self.build("""
+            LD V1, 1
+            IFNE V1, 1
+            LD V2, 3
+        """)
+        assert len(chip8.build_block(0x200).instructions) == 2
+
+    def test_ends_at_store(self):
+        chip8 = self.build("""
+            LD I, 300h
+            LD [I], V3
+            LD V2, 3
+        """)
+        assert len(chip8.build_block(0x200).instructions) == 2
+
+    def test_io_starts_block(self):
+        chip8 = self.build("""
+            LD V1, 1
+            LD V2, DT
+            LD V3, 3
+            JP 300h
+        """)
+        assert len(chip8.build_block(0x200).instructions) == 1
+        assert len(chip8.build_block(0x202).instructions) == 3
+
+    def test_time_per_block(self):
+        chip8 = self.build("""
+            LD V1, 1
+            ADD V1, 2
+            JP 300h
+        """)
+        chip8.run(1)
+        assert chip8.cpu.program_counter == 0x300
+        assert chip8.time == 27 + 45 + 105
+
+    def test_cached(self):
+        chip8 = self.build("""
+        loop:
+            ADD V1, 1
+            IFNE V1, 0
+            JP loop
+            HLT
+        """)
+        chip8.run()
+        block = chip8.blocks[0x200]
+        assert block is not None
+        chip8.paused = False
+        chip8.cpu.program_counter = uint16_t(0x200)
+        chip8.run(1)
+        assert chip8.blocks[0x200] is block
+
+    def test_invalidated(self):
+        chip8 = self.build("""
+            LD V1, 1
+            JP 200h
+        """)
+        chip8.run(1)
+        block = chip8.blocks[0x200]
+        chip8.ram.store8(uint16_t(0x201), uint8_t(2))
+        chip8.cpu.program_counter = uint16_t(0x200)
+        chip8.run(1)
+        assert chip8.blocks[0x200] is not block
+        assert chip8.cpu.general_registers[1] == 2
+
+
+class CountingSkip:
+    def __init__(self, skip):
+        self.skip = skip
+        self.skipped = 0
+
+    def __call__(self, block):
+        if self.skip(block):
+            self.skipped += 1
+            return True
+        return False
+
+
+class TestIdleLoops:
+    """
+        LD V1, 30
+    again:
+        LD DT, V1
+    wait:
+        LD V0, DT
+        SE V0, 0
+        JP wait
+        ADD V2, 1
+        LD V1, 7
+        LD DT, V1
+    wait_tick:
+        LD V3, DT
+        SNE V3, 7
+        JP wait_tick
+    wait_key:
+        SKP V2
+        JP wait_key
+    release:
+        SKNP V2
+        JP release
+        ADD V2, 1
+        LD V1, 3
+        JP again
+    """
+
+    def test_detected(self, program):
+        chip8 = load_chip8(program)
+        for pc, cost in [(0x204, 45 + 46 + 105), (0x210, 45 + 46 + 105),
+                         (0x216, 64 + 105), (0x21A, 64 + 105),
+                         (0x200, 0), (0x202, 0), (0x208, 0)]:
+            assert chip8.build_block(pc).loop_cost == cost
+
+    def test_same_as_running(self, program):
+        chip8 = load_chip8(program)
+        reference = load_chip8(program)
+        reference.skip_idle_loop = lambda block: False
+        for i in range(300):
+            # all keys go down and up again every 20 runs
+            keys = uint16_t(0xFFFF * ((i / 10) % 2))
+            watchdog = 1 + (i * 7919) % 20000
+            for c in [chip8, reference]:
+                c.keys = keys
+                c.run(watchdog)
+            assert state(chip8) == state(reference)
+        assert chip8.cpu.general_registers[2] > 4
+
+    def test_skips(self, program):
+        """
+            LD V1, 1
+        wait_key:
+            SKP V2
+            JP wait_key
+        """
+        chip8 = load_chip8(program)
+        chip8.run(1000000)
+        assert chip8.cpu.program_counter in (0x202, 0x204)
+        # while the key is up, the whole run is skipped at once
+        chip8.skip_idle_loop = skip = CountingSkip(chip8.skip_idle_loop)
+        chip8.run(1000000)
+        assert chip8.cpu.program_counter in (0x202, 0x204)
+        assert skip.skipped == 1
+
+
+class TestMemory:
+    def test_decode_cached(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23')
+        ins = ram.decode(0x200)
+        assert ins.ins_type == 0x6000
+        assert ins.imm_r1 == 1
+        assert ins.imm8 == 0x23
+        assert ram.decode(0x200) is ins
+
+    def test_store_invalidates(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23\x62\x34')
+        ins1 = ram.decode(0x200)
+        ins2 = ram.decode(0x202)
+        version = ram.code_version
+        ram.store8(0x201, uint8_t(0x45))
+        assert ram.code_version is not version
+        assert ram.decode(0x200) is not ins1
+        assert ram.decode(0x200).imm8 == 0x45
+        assert ram.decode(0x202) is ins2
+
+    def test_store_overlapping_invalidates(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23\x62\x34')
+        ins = ram.decode(0x201)
+        ram.store16(0x202, uint16_t(0x1234))
+        assert ram.decode(0x201) is not ins
+        assert ram.decode(0x201).ins == 0x2312
+
+    def test_store_data_keeps_code(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23')
+        ins = ram.decode(0x200)
+        version = ram.code_version
+        ram.store8(0x300, uint8_t(0x45))
+        ram.store16(0x202, uint16_t(0x4567))
+        assert ram.code_version is version
+        assert ram.decode(0x200) is ins
+
+    def test_load_invalidates(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23')
+        ins = ram.decode(0x200)
+        ram.load_bin('\x62\x34')
+        assert ram.decode(0x200) is not ins
+        assert ram.decode(0x200).ins == 0x6234
+
+    def test_load_contents(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x61\x23\x62')
+        assert len(ram.contents) == 0x1000
+        assert ram.read8(0x1FF) == 0
+        assert ram.read16(0x200) == 0x6123
+        assert ram.read8(0x202) == 0x62
+        assert ram.read8(0x203) == 0
+        assert ram.read8(ram.digit(uint8_t(0xF))) == 0b11110000
+
+    def test_dirty_pages(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        ram.load_bin('\x12' * 0x200)
+        assert ram.take_dirty_pages() == [0, 2, 3]
+        ram.store8(0x4FF, uint8_t(1))
+        ram.store16(0x5FF, uint16_t(0x1234))
+        assert ram.take_dirty_pages() == [4, 5, 6]
+        assert ram.take_dirty_pages() == []
+        ram.write_page(3, '\x12' * 0x100)
+        assert ram.take_dirty_pages() == []
+        ram.write_page(3, '\x13' * 0x100)
+        assert ram.take_dirty_pages() == [3]
+        assert ram.read_page(3) == '\x13' * 0x100
+
+    def test_load_too_large(self):
+        from emulator.chip8 import Memory
+        ram = Memory()
+        assert ram.load_bin('\x12' * (0x1000 - 0x200))
+        assert ram.read8(0xFFF) == 0x12
+        # nothing of a program that does not fit is loaded
+        ram = Memory()
+        assert not ram.load_bin('\x12' * 0x1000)
+        assert len(ram.contents) == 0x1000
+        assert ram.read8(0x200) == 0
+        assert ram.read8(0xFFF) == 0
+
+
+class TestTimer:
+    def test_timer(self):
+        from emulator.chip8 import Timer, TIMER_PERIOD
+        timer = Timer()
+        assert timer.get(0) == 0
+        assert not timer.is_running(0)
+        timer.set(100, uint8_t(3))
+        assert timer.is_running(100)
+        assert timer.get(100) == 3
+        assert timer.get(100 + TIMER_PERIOD) == 2
+        assert timer.get(101 + TIMER_PERIOD) == 2
+        assert timer.get(101 + 2 * TIMER_PERIOD) == 1
+        assert timer.get(100 + 3 * TIMER_PERIOD) == 0
+        assert not timer.is_running(100 + 3 * TIMER_PERIOD)
+
+    def test_period(self):
+        from emulator.chip8 import Chip8, TIMER_PERIOD
+        from emulator.io.message import C_TimerPeriod
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.delay_timer.set(0, uint8_t(3))
+        # a frontend running at twice the speed
+        chip8.DISPATCH.dispatch(chip8, C_TimerPeriod(2 * TIMER_PERIOD))
+        assert chip8.delay_timer.get(0) == 3
+        assert chip8.delay_timer.get(2 * TIMER_PERIOD) == 2
+        assert not chip8.sound_timer.is_running(0)
+        chip8.sound_timer.set(0, uint8_t(1))
+        assert chip8.sound_timer.is_running(2 * TIMER_PERIOD - 1)
+        chip8.DISPATCH.dispatch(chip8, C_TimerPeriod(0))
+        assert chip8.errors == 1
+        assert chip8.delay_timer.period == 2 * TIMER_PERIOD
+
+
+class TestCommands:
+    def test_run_report(self):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_RunReport, M_Cpu, M_DisplayDelta
+        from assembler.chip8 import assemble
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.ram.load_bin(assemble('''
+            LD F, V0
+            DRW V0, V0, 5
+        loop:
+            JP loop
+        '''.splitlines()))
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(10000))
+        cpu, delta = chip8.pipe.told
+        assert isinstance(cpu, M_Cpu)
+        assert cpu.paused
+        assert isinstance(delta, M_DisplayDelta)
+        assert delta.rows == [0, 1, 2, 3, 4]
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(10000))
+        assert chip8.pipe.told[3].rows == []
+
+    def test_run_report_framebuffer(self, tmpdir):
+        from emulator.chip8 import Chip8, Display
+        from emulator.io.framebuffer import FramebufferReader
+        from emulator.io.message import C_Framebuffer, C_RunReport, M_Cpu, M_Framebuffer
+        from assembler.chip8 import assemble
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.ram.load_bin(assemble('''
+            LD F, V0
+            DRW V0, V0, 5
+        loop:
+            JP loop
+        '''.splitlines()))
+        path = str(tmpdir.join('fb'))
+        chip8.DISPATCH.dispatch(chip8, C_Framebuffer(path))
+        attached, = chip8.pipe.told
+        assert isinstance(attached, M_Framebuffer)
+        assert attached.attached
+        reader = FramebufferReader(path)
+        client = Display()
+        assert reader.read(client) == 2
+        assert client.data == [0] * 32
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(10000))
+        # the display is no longer sent over the pipe
+        attached, cpu = chip8.pipe.told
+        assert isinstance(cpu, M_Cpu)
+        assert reader.read(client) == 4
+        assert client.data == chip8.display.data
+        assert client.data[0] != 0
+        reader.close()
+
+    def test_framebuffer_error(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Framebuffer
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Framebuffer(str(tmpdir.join('missing', 'fb'))))
+        attached, = chip8.pipe.told
+        assert not attached.attached
+        assert chip8.framebuffer is None
+
+    def test_load_too_large(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Load
+        rom = tmpdir.join('rom')
+        rom.write_binary('\x12' * 0x1000)
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Load(str(rom)))
+        assert chip8.errors == 1
+        assert chip8.ram.read8(0x200) == 0
+
+    def test_framebuffer_symlink(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.framebuffer import FramebufferError, FramebufferWriter
+        from emulator.io.message import C_Framebuffer
+        target = tmpdir.join('target')
+        target.write_binary('keep')
+        link = tmpdir.join('fb')
+        link.mksymlinkto(target)
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Framebuffer(str(link)))
+        attached, = chip8.pipe.told
+        assert not attached.attached
+        assert target.read_binary() == 'keep'
+        with pytest.raises(FramebufferError):
+            FramebufferWriter(str(tmpdir), 64, 32)
+
+    def test_framebuffer_torn(self, tmpdir, monkeypatch):
+        from emulator.chip8 import Display
+        from emulator.io import framebuffer
+        path = str(tmpdir.join('fb'))
+        writer = framebuffer.FramebufferWriter(path, 64, 32)
+        # the writer died in the middle of a frame
+        writer.set_counter(1)
+        reader = framebuffer.FramebufferReader(path)
+        monkeypatch.setattr(framebuffer, 'READ_RETRIES', 3)
+        with pytest.raises(framebuffer.FramebufferError):
+            reader.read(Display())
+        writer.set_counter(2)
+        assert reader.read(Display()) == 2
+        reader.close()
+        writer.close()
+
+    def test_wait_for_key(self):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_RunReport
+        from emulator.snapshot import snapshot, restore
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.ram.load_bin(assemble("""
+            LD V1, 2
+            LD ST, V1
+            LD V7, K
+            LD V8, V7
+        """.splitlines()))
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(100000))
+        assert chip8.pipe.told[0].waiting
+        assert chip8.waiting_key == 7
+        assert not chip8.is_runnable()
+        # time and timers go on while waiting
+        time = chip8.time
+        chip8.run(1000)
+        assert chip8.time == time + 1000
+        chip8.run(100000)
+        assert not chip8.sound_timer.is_running(chip8.time)
+        saved = snapshot(chip8)
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(100000, 1 << 5))
+        assert not chip8.pipe.told[2].waiting
+        assert chip8.cpu.general_registers[8] == 5
+        assert restore(chip8, saved)
+        assert chip8.waiting_key == 7
+        chip8.keys = uint16_t(1 << 6)
+        # asking does not end the wait, polling does
+        assert not chip8.is_runnable()
+        assert chip8.waiting_key == 7
+        assert chip8.poll_key()
+        assert chip8.is_runnable()
+        assert chip8.cpu.general_registers[7] == 6
+
+
+class TestProfile:
+    def test_profile(self):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Profile, C_ProfileReport, M_Profile
+        code = assemble("""
+            LD V1, 2
+        loop:
+            ADD V0, V1
+            SE V0, 10
+            JP loop
+            LD F, V0
+            DRW V0, V0, 5
+        stop:
+            JP stop
+        """.splitlines())
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.ram.load_bin(code)
+        chip8.DISPATCH.dispatch(chip8, C_Profile(True))
+        chip8.run(100000)
+        unprofiled = Chip8(PipeTest(), IoTest())
+        unprofiled.ram.load_bin(code)
+        unprofiled.run(100000)
+        chip8.DISPATCH.dispatch(chip8, C_ProfileReport())
+        profile, = chip8.pipe.told
+        assert isinstance(profile, M_Profile)
+        counts = dict(zip(profile.opcodes, profile.counts))
+        assert counts == {0x6000: 1, 0x8004: 5, 0x3000: 5, 0x1000: 5,
+                          0xF029: 1, 0xD000: 1}
+        cycles = dict(zip(profile.opcodes, profile.cycles))
+        # drawing costs more than its static cost
+        assert cycles[0xD000] >= 5000
+        assert sum(cycles.values()) == chip8.time == unprofiled.time
+        pcs = dict(zip(profile.pcs, profile.pc_counts))
+        assert pcs[0x202] == 5
+        assert pcs[0x20C] == 1
+
+    def test_disabled(self):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Profile, C_ProfileReport
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Profile(True))
+        chip8.step()
+        chip8.DISPATCH.dispatch(chip8, C_Profile(False))
+        chip8.step()
+        chip8.DISPATCH.dispatch(chip8, C_ProfileReport())
+        assert chip8.pipe.told[0].opcodes == []
+
+
+class TestSnapshot:
+    def test_restore(self, program):
+        """
+            LD V1, 40
+            LD DT, V1
+        loop:
+            RND V0, 0x3F
+            LD F, V2
+            DRW V0, V2, 5
+            ADD V2, 1
+            LD I, 0x300
+            LD [I], V2
+            LD V3, DT
+            SE V3, 0
+            JP loop
+        stop:
+            JP stop
+        """
+        from emulator.chip8 import Chip8
+        from emulator.snapshot import snapshot, restore
+        chip8 = load_chip8(program)
+        chip8.run(100000)
+        saved = snapshot(chip8)
+        chip8.run(1000000)
+        expected = state(chip8)
+        assert chip8.paused
+
+        other = Chip8(PipeTest(), IoTest())
+        assert restore(other, saved)
+        assert not other.paused
+        assert other.display.take_dirty() == range(32)
+        other.run(1000000)
+        assert state(other) == expected
+        assert snapshot(other) == snapshot(chip8)
+
+    def test_restore_keeps_decoded(self, program):
+        """
+        loop:
+            LD I, 0x300
+            LD [I], V2
+            RND V0, 0x3F
+            ADD V2, V0
+            JP loop
+        """
+        from emulator.snapshot import snapshot, restore
+        chip8 = load_chip8(program)
+        chip8.run(100000)
+        saved = snapshot(chip8)
+        version = chip8.ram.code_version
+        chip8.run(10000)
+        assert restore(chip8, saved)
+        assert chip8.ram.code_version is version
+        assert chip8.ram.decoded[0x204] is not None
+        # changing code drops what was decoded from it
+        chip8.ram.store8(0x205, uint8_t(0))
+        assert chip8.ram.decode(0x204).ins == 0xC000
+        version = chip8.ram.code_version
+        assert restore(chip8, saved)
+        assert chip8.ram.code_version is not version
+        assert chip8.ram.decode(0x204).ins == 0xC03F
+
+    def test_invalid(self, program):
+        """
+        loop:
+            ADD V0, 1
+            LD I, 0x300
+            LD [I], V0
+            JP loop
+        """
+        from emulator.io.message import C_Restore
+        from emulator.snapshot import snapshot, restore
+        chip8 = load_chip8(program)
+        saved = snapshot(chip8)
+        chip8.run(100000)
+        expected = state(chip8)
+        assert not restore(chip8, saved[:-1])
+        assert not restore(chip8, saved + '\0')
+        assert not restore(chip8, 'CH8S')
+        # program counter, stack pointer and I outside of memory
+        for offset, value in [(5, '\xFF\xF0'), (5, '\x0F\xFF'),
+                              (7, '\xFF\xFF'), (7, '\x00\x03'),
+                              (9, '\x10\x00')]:
+            bad = saved[:offset] + value + saved[offset + 2:]
+            assert not restore(chip8, bad)
+        assert state(chip8) == expected
+        assert restore(chip8, saved[:5] + '\x0F\xFE' + saved[7:])
+        assert chip8.cpu.program_counter == 0xFFE
+        assert restore(chip8, saved)
+        chip8.run(100000)
+        assert state(chip8) == expected
+        chip8.DISPATCH.dispatch(chip8, C_Restore('junk'))
+        assert chip8.errors == 1
+
+
+def assert_history(rewind, span):
+    """Checks that the checkpoints of rewind reach just span back."""
+    times = [rewind.entries[(rewind.first + i) % len(rewind.entries)].state.time
+             for i in range(rewind.count)] + [rewind.state.time]
+    gap = max(times[i + 1] - times[i] for i in range(rewind.count))
+    start = rewind.state.time - span
+    assert start <= times[0] < start + gap
+
+
+class TestRewind:
+    """
+        LD V1, 40
+        LD DT, V1
+    loop:
+        RND V0, 0x3F
+        LD F, V2
+        DRW V0, V2, 5
+        ADD V2, 1
+        LD I, 0x400
+        LD [I], V2
+        LD I, 0x800
+        LD B, V2
+        JP loop
+    """
+
+    def test_step_back(self, program):
+        from emulator.chip8 import TIMER_PERIOD
+        from emulator.io.message import C_Rewind, C_StepBack
+        chip8 = load_chip8(program)
+        chip8.DISPATCH.dispatch(chip8, C_Rewind(10, 1 << 20))
+        states = [state(chip8)]
+        for i in range(8):
+            chip8.run(TIMER_PERIOD)
+            states.append(state(chip8))
+        chip8.run(TIMER_PERIOD / 2)
+        # the first step goes back to the last checkpoint
+        for expected in reversed(states):
+            chip8.DISPATCH.dispatch(chip8, C_StepBack())
+            assert state(chip8) == expected
+        assert not chip8.rewind.step_back(chip8)
+        # and it runs the same way again
+        chip8.run(TIMER_PERIOD)
+        chip8.run(TIMER_PERIOD)
+        assert state(chip8) == states[2]
+        # right at a checkpoint, the first step goes to the one before
+        chip8.DISPATCH.dispatch(chip8, C_StepBack())
+        assert state(chip8) == states[1]
+
+    def test_deltas(self, program):
+        from emulator.chip8 import TIMER_PERIOD
+        from emulator.rewind import Rewind
+        chip8 = load_chip8(program)
+        rewind = Rewind(chip8, TIMER_PERIOD, 10, 1 << 20)
+        chip8.run(TIMER_PERIOD)
+        rewind.checkpoint(chip8)
+        entry = rewind.entries[0]
+        # only the pages with the counter and the digits were written
+        assert entry.pages == [4, 8]
+        assert 0 < len(entry.rows) < 32
+        assert entry.state.time == 0
+
+    def test_limits(self, program):
+        """
+        loop:
+            RND V0, 0x3F
+            LD F, V2
+            DRW V0, V2, 5
+            ADD V2, 1
+            LD I, 0x400
+            LD [I], V2
+            JP loop
+        """
+        from emulator.chip8 import TIMER_PERIOD
+        from emulator.rewind import Rewind
+        chip8 = load_chip8(program)
+        rewind = Rewind(chip8, TIMER_PERIOD, 1, 1 << 20)
+        for i in range(100):
+            chip8.run(TIMER_PERIOD)
+            rewind.maybe_checkpoint(chip8)
+        assert 55 <= rewind.count <= len(rewind.entries)
+        assert_history(rewind, 1000000)
+        size = rewind.size
+        rewind.max_bytes = size / 2
+        chip8.run(TIMER_PERIOD)
+        rewind.checkpoint(chip8)
+        assert rewind.size <= size / 2
+        assert 0 < rewind.count < 60
+        count = rewind.count
+        for i in range(count):
+            assert rewind.step_back(chip8)
+        assert rewind.step_back(chip8) is False
+
+    def test_short_runs(self, program):
+        from emulator.chip8 import TIMER_PERIOD
+        from emulator.rewind import Rewind
+        chip8 = load_chip8(program)
+        rewind = Rewind(chip8, TIMER_PERIOD, 1, 1 << 20)
+        # frames of the pygame frontend, a checkpoint after every second
+        for i in range(200):
+            chip8.run(16000)
+            rewind.maybe_checkpoint(chip8)
+        assert rewind.count < 55
+        # but still a second of history
+        assert_history(rewind, 1000000)
+
+
+class TestRecord:
+    def test_replay(self, program, tmpdir):
+        """
+        loop:
+            RND V0, 0x3F
+            SKNP V1
+            ADD V2, V0
+            ADD V1, 1
+            LD V4, 0xF
+            AND V1, V4
+            LD I, 0x400
+            LD [I], V2
+            ADD V6, 1
+            AND V6, V4
+            SE V6, 0
+            JP loop
+            LD V5, K
+            ADD V7, V5
+            LD F, V5
+            DRW V0, V2, 5
+            JP loop
+        """
+        from emulator.chip8 import Chip8, Io_Null
+        from emulator.io.message import (
+            C_Keys, C_Record, C_RunReport, C_StopRecording)
+        from emulator.record import read_log, replay
+        path = str(tmpdir.join('log'))
+        chip8 = load_chip8(program)
+        chip8.run(20000)
+        chip8.DISPATCH.dispatch(chip8, C_Record(path))
+        waits = 0
+        for i in range(20):
+            chip8.DISPATCH.dispatch(chip8, C_RunReport(10000, 1 << (i % 5)))
+            if chip8.waiting_key >= 0:
+                waits += 1
+            if i % 3 == 0:
+                chip8.DISPATCH.dispatch(chip8, C_Keys(0xFFFF))
+            chip8.run(3000)
+        chip8.DISPATCH.dispatch(chip8, C_StopRecording())
+        expected = state(chip8)
+        assert waits > 2
+
+        replayed = Chip8(PipeTest(), Io_Null())
+        assert replay(replayed, read_log(path))
+        assert state(replayed) == expected
+
+    def test_replay_step(self, program, tmpdir):
+        """
+        loop:
+            RND V0, 0x3F
+            SKNP V1
+            ADD V2, V0
+            ADD V1, 1
+            LD V4, 0xF
+            AND V1, V4
+            LD I, 0x400
+            LD [I], V2
+            ADD V6, 1
+            AND V6, V4
+            SE V6, 0
+            JP loop
+            LD V5, K
+            ADD V7, V5
+            LD F, V5
+            DRW V0, V2, 5
+            JP loop
+        """
+        from emulator.chip8 import Chip8, Io_Null
+        from emulator.io.message import (
+            C_Record, C_RunReport, C_Step, C_StopRecording)
+        from emulator.record import EVENT_STEP, read_log, replay
+        path = str(tmpdir.join('log'))
+        chip8 = load_chip8(program)
+        chip8.DISPATCH.dispatch(chip8, C_Record(path))
+        for i in range(20):
+            chip8.DISPATCH.dispatch(chip8, C_RunReport(10000, 1 << (i % 5)))
+            # stops in the middle of a block
+            chip8.DISPATCH.dispatch(chip8, C_Step())
+        chip8.DISPATCH.dispatch(chip8, C_StopRecording())
+        expected = state(chip8)
+        log = read_log(path)
+        assert log.kinds.count(EVENT_STEP) == 20
+
+        replayed = Chip8(PipeTest(), Io_Null())
+        assert replay(replayed, log)
+        assert state(replayed) == expected
+
+    @pytest.mark.parametrize('mode', ['interpreted', 'profiled'])
+    def test_replay_mode(self, tmpdir, mode):
+        from emulator.chip8 import Chip8, Io_Null
+        from emulator.io.message import (
+            C_Profile, C_Record, C_RunReport, C_StopRecording)
+        from emulator.record import MODE_INSTRUCTIONS, read_log, replay
+        path = str(tmpdir.join('log'))
+        chip8 = load_chip8(assemble(self.test_replay_step.__doc__.splitlines()))
+        if mode == 'interpreted':
+            chip8.BLOCK_MODE = False
+        else:
+            chip8.DISPATCH.dispatch(chip8, C_Profile(True))
+        chip8.DISPATCH.dispatch(chip8, C_Record(path))
+        for i in range(20):
+            # runs end between the instructions of a block
+            chip8.DISPATCH.dispatch(chip8, C_RunReport(1000, 1 << (i % 5)))
+        chip8.DISPATCH.dispatch(chip8, C_StopRecording())
+        expected = state(chip8)
+        log = read_log(path)
+        assert log.mode == MODE_INSTRUCTIONS
+
+        replayed = Chip8(PipeTest(), Io_Null())
+        assert replay(replayed, log)
+        assert state(replayed) == expected
+
+    def test_profile_stops(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Profile, C_Record
+        from emulator.record import EVENT_END, read_log
+        path = str(tmpdir.join('log'))
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Record(path))
+        chip8.DISPATCH.dispatch(chip8, C_Profile(False))
+        assert chip8.recorder is not None
+        chip8.DISPATCH.dispatch(chip8, C_Profile(True))
+        assert chip8.recorder is None
+        assert read_log(path).kinds == [EVENT_END]
+
+    def test_truncated(self, program, tmpdir):
+        """
+        loop:
+            SKNP V1
+            ADD V2, 1
+            ADD V1, 1
+            JP loop
+        """
+        from emulator.chip8 import Chip8, Io_Null
+        from emulator.io.message import C_Record, C_RunReport
+        from emulator.record import (
+            EVENT_KEYS, EVENT_SIZE, Log, RecordError, read_log, replay)
+        path = tmpdir.join('log')
+        chip8 = load_chip8(program)
+        chip8.DISPATCH.dispatch(chip8, C_Record(str(path)))
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(100000, 1))
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(100000, 2))
+        chip8.DISPATCH.dispatch(chip8, C_RunReport(100000, 4))
+        # events are on disk before the recording stops
+        assert read_log(str(path)).kinds == [EVENT_KEYS] * 3
+        chip8.close()
+        data = path.read_binary()
+        log = Log(data[:-EVENT_SIZE - 3])
+        assert len(log.kinds) == len(read_log(str(path)).kinds) - 2
+        # without EVENT_END, replay stops at the last change of keys
+        replayed = Chip8(PipeTest(), Io_Null())
+        assert not replay(replayed, log)
+        assert replayed.keys == 2
+        assert replayed.time == log.times[log.kinds.index(EVENT_KEYS, 1)]
+        with pytest.raises(RecordError):
+            Log(data[:20])
+        with pytest.raises(RecordError):
+            Log('junk')
+
+    def test_load_stops(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Load, C_Record
+        from emulator.record import EVENT_END, read_log
+        rom = tmpdir.join('rom')
+        rom.write_binary('\x12\x00')
+        path = str(tmpdir.join('log'))
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Record(path))
+        chip8.DISPATCH.dispatch(chip8, C_Load(str(rom)))
+        assert chip8.recorder is None
+        assert read_log(path).kinds == [EVENT_END]
+
+    def test_cannot_record(self, tmpdir):
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Record
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Record(str(tmpdir.join('no', 'log'))))
+        assert chip8.recorder is None
+        assert chip8.errors == 1
+
+    @pytest.mark.skipif('not os.path.exists("/dev/full")')
+    def test_disk_full(self, tmpdir):
+        import os
+        from emulator.chip8 import Chip8
+        from emulator.io.message import C_Keys, C_Record
+        chip8 = Chip8(PipeTest(), IoTest())
+        chip8.DISPATCH.dispatch(chip8, C_Record('/dev/full'))
+        assert chip8.recorder is None
+        assert chip8.errors == 1
+        chip8.DISPATCH.dispatch(chip8, C_Record(str(tmpdir.join('log'))))
+        recorder = chip8.recorder
+        os.close(recorder.fd)
+        recorder.fd = os.open('/dev/full', os.O_WRONLY)
+        # the recording ends, the machine goes on
+        chip8.DISPATCH.dispatch(chip8, C_Keys(1))
+        assert chip8.recorder is None
+        assert chip8.errors == 2
+        assert chip8.keys == 1
+        with pytest.raises(OSError):
+            os.close(recorder.fd)
+
+
+def draw(display, x, y, byte):
+    return display.draw_sprite(x, y, bytearray([byte]), 0, 1)
+
+
+class TestDisplay:
+    def test_draw_dirty(self):
+        from emulator.chip8 import Display
+        display = Display()
+        draw(display, 0, 3, 0xF0)
+        draw(display, 60, 5, 0x0F)  # shifted out of the screen
+        draw(display, 0, 7, 0)
+        assert display.take_dirty() == [3]
+        assert display.take_dirty() == []
+
+    def test_clear_dirty(self):
+        from emulator.chip8 import Display
+        display = Display()
+        draw(display, 0, 3, 0xF0)
+        draw(display, 8, 9, 0xF0)
+        display.mark_clean()
+        display.clear()
+        assert display.take_dirty() == [3, 9]
+        display.clear()
+        assert display.take_dirty() == []
+
+    def test_delta(self):
+        from emulator.chip8 import Display
+        from emulator.io.message import M_Display, M_DisplayDelta
+        display = Display()
+        client = Display()
+        M_Display(display).unpack(client)
+        draw(display, 0, 3, 0xF0)
+        draw(display, 0, 31, 0x81)
+        M_DisplayDelta(display, display.take_dirty()).unpack(client)
+        assert client.data == display.data
+        draw(display, 0, 3, 0xF0)
+        msg = M_DisplayDelta(display, display.take_dirty())
+        assert msg.rows == [3]
+        msg.unpack(client)
+        assert client.data == display.data
+
+    def test_draw_sprite(self):
+        from emulator.chip8 import Display
+        display = Display()
+        sprite = bytearray('\0' * 0x1000)
+        sprite[0xFFE:0x1000] = '\xFF\x81'
+        sprite[0:2] = '\x00\x3C'
+        assert not display.draw_sprite(60, 10, sprite, 0xFFE, 4)
+        # the sprite wraps around memory, and is cut off at the right edge
+        assert display.data[10:14] == [0xF, 0x8, 0, 0x3]
+        assert display.take_dirty() == [10, 11, 13]
+        assert display.draw_sprite(60, 11, sprite, 0xFFF, 1)
+        assert display.data[11] == 0
+        assert not display.draw_sprite(0, 0, sprite, 0xFFF, 1)
+        assert display.data[0] == 0x81 << 56
+
+    def test_sprite_masks(self):
+        from emulator.chip8 import SPRITE_MASKS
+        for x in range(64):
+            for byte in [0x01, 0x80, 0xA5, 0xFF]:
+                mask = (byte << 56 >> x) & (2 ** 64 - 1)
+                assert SPRITE_MASKS[x << 8 | byte] == mask
+
+
+class TestServer:
+    def test_sessions(self, tmpdir):
+        import os
+        import socket
+        import threading
+        from emulator.chip8 import Chip8_Rpc, Server
+        from emulator.io.session import Connection
+        a, b = socket.socketpair()
+        server = Server()
+        server.add_connection(os.dup(a.fileno()))
+        fd, = server.connections
+        client = Connection(os.dup(b.fileno()))
+        a.close()
+        b.close()
+
+        def loop():
+            while fd in server.connections:
+                server.receive(fd)
+        thread = threading.Thread(target=loop)
+        thread.start()
+
+        chips = []
+        for i in range(3):
+            path = tmpdir.join('%d.ch8' % i)
+            path.write_binary(assemble(("""
+                LD V0, %d
+            loop:
+                JP loop
+            """ % i).splitlines()))
+            chip8 = Chip8_Rpc(client.open(i), IoTest())
+            assert chip8.initialize(str(path))
+            chips.append(chip8)
+        for chip8 in chips:
+            chip8.run(1000)
+        for i, chip8 in enumerate(chips):
+            assert chip8.cpu.general_registers[0] == i
+            assert chip8.cpu.program_counter == 0x202
+        chips[1].quit()
+        chips[0].step()
+        assert len(server.chips) == 2
+        client.close()
+        thread.join()
+        assert server.chips == {}
+
+
+class TestScheduler:
+    def test_round_robin(self, program):
+        """
+        loop:
+            ADD V0, 1
+            JP loop
+        """
+        from emulator.scheduler import Scheduler
+        scheduler = Scheduler(quantum=1000)
+        a = scheduler.add(load_chip8(program))
+        b = scheduler.add(load_chip8(program))
+        stop = scheduler.add(load_chip8(assemble("""
+        stop:
+            JP stop
+        """.splitlines())))
+        for i in range(5):
+            assert scheduler.run_round()
+        assert a.slices == b.slices == 5
+        assert stop.slices == 1
+        assert stop.skipped == 4
+        assert a.cycles >= 5000
+        assert a.cycles == b.cycles
+        assert a.instructions == b.instructions > 0
+        assert a.chip8.instructions == a.instructions
+        assert a.throughput() > 0
+        assert 0.5 < scheduler.fairness() <= 1.0
+
+    def test_all_paused(self, program):
+        """
+        stop:
+            JP stop
+        """
+        from emulator.scheduler import Scheduler
+        scheduler = Scheduler()
+        task = scheduler.add(load_chip8(program))
+        assert scheduler.run_round()
+        assert not scheduler.run_round()
+        scheduler.remove(task.chip8)
+        assert scheduler.tasks == []
+        assert scheduler.fairness() == 1.0
+
+    def test_waiting_for_key(self, program):
+        """
+            LD V0, K
+        loop:
+            ADD V1, 1
+            JP loop
+        """
+        from emulator.scheduler import Scheduler
+        scheduler = Scheduler(quantum=1000)
+        task = scheduler.add(load_chip8(program))
+        assert scheduler.run_round()
+        assert not scheduler.run_round()
+        assert task.skipped == 1
+        task.chip8.keys = uint16_t(1)
+        assert scheduler.run_round()
+        assert task.chip8.cpu.general_registers[1] > 0
+
+    def test_timers_while_waiting(self, program):
+        """
+            LD V0, 2
+            LD DT, V0
+            LD ST, V0
+            LD V1, K
+        """
+        from emulator.chip8 import TIMER_PERIOD
+        from emulator.scheduler import Scheduler
+        scheduler = Scheduler(quantum=TIMER_PERIOD)
+        task = scheduler.add(load_chip8(program))
+        chip8 = task.chip8
+        assert scheduler.run_round()
+        assert chip8.waiting_key >= 0
+        assert chip8.delay_timer.get(chip8.time) > 0
+        for i in range(3):
+            assert not scheduler.run_round()
+        # time passed as with Chip8.run, the timers ran out
+        assert task.skipped == 3
+        assert chip8.time >= 3 * TIMER_PERIOD
+        assert chip8.delay_timer.get(chip8.time) == 0
+        assert chip8.io.events.count(("set_sound", True)) == 1
+        assert chip8.io.events.count(("set_sound", False)) == 1
+        assert not chip8.sound
+
+
+class TestBatch:
+    def test_run_rom(self, tmpdir):
+        from emulator.batch import run_rom
+        path = tmpdir.join('rom.ch8')
+        path.write_binary(assemble("""
+            LD F, V0
+            DRW V0, V0, 5
+        stop:
+            JP stop
+        """.splitlines()))
+        result = run_rom(str(path), 10000)
+        assert result['paused']
+        assert result['instructions'] == 3
+        assert result['errors'] == 0
+        assert 'exception' in run_rom(str(tmpdir.join('missing')), 10)
+        large = tmpdir.join('large.ch8')
+        large.write_binary('\x12' * 0x1000)
+        assert run_rom(str(large), 10)['exception'] == 'program too large'
+
+    def test_main(self, tmpdir, capsys):
+        import json
+        from emulator.batch import main
+        for i in range(3):
+            tmpdir.join('%d.ch8' % i).write_binary(assemble(("""
+                LD V0, %d
+                LD F, V0
+                DRW V0, V0, 5
+            stop:
+                JP stop
+            """ % i).splitlines()))
+        assert main(['batch', '-j', '2', '--cycles', '1000', str(tmpdir)]) == 0
+        results = [json.loads(line) for line in capsys.readouterr()[0].splitlines()]
+        assert [r['rom'] for r in results] == [
+            str(tmpdir.join('%d.ch8' % i)) for i in range(3)]
+        assert len(set(r['display'] for r in results)) == 3
+        assert all(r['cycles'] > 0 for r in results)
+
+
+class IoJitted(Io):
+    def sync(self, time):
+        pass
+
+
+class StreamJitted:
+    def write(self, s):
+        pass
+
+
+class TestChip8Jitted(LLJitMixin):
+    @pytest.mark.timeout(300)
+    def test_loop(self, monkeypatch):
+        from emulator.chip8 import Chip8
+        from emulator.error import errorstream
+        monkeypatch.setattr(errorstream, 'stream', StreamJitted())
+        monkeypatch.setattr(Chip8, 'BLOCK_MODE', False)
+        code = assemble("""
+            LD V1, 0
+            LD V2, 0
+        loop:
+            ADD V1, 1
+            ADD V2, 3
+            IFNE V1, 0
+            JP loop
+            HLT
+        """.splitlines())
+
+        def main(watchdog):
+            chip8 = Chip8(None, IoJitted())
+            chip8.ram.load_bin(code)
+            chip8.run(watchdog)
+            return intmask(chip8.cpu.general_registers[2])
+
+        res = self.meta_interp(main, [2**30], backendopt=True, inline=True)
+        assert res == (256 * 3) & 0xFF
+        self.check_trace_count(1)
+        # instructions are constant-folded, there are no fetches or calls
+        self.check_simple_loop(getarrayitem_gc_i=0, call_n=0, call_i=0)
+
+    @pytest.mark.timeout(300)
+    def test_self_modifying_loop(self, monkeypatch):
+        from emulator.chip8 import Chip8
+        from emulator.error import errorstream
+        monkeypatch.setattr(errorstream, 'stream', StreamJitted())
+        monkeypatch.setattr(Chip8, 'BLOCK_MODE', False)
+        code = assemble("""
+            LD V2, 0
+            LD V3, 0
+            LD V4, 0
+        loop:
+            ADD V2, 1
+        step:
+            ADD V3, 1
+            IFNE V3, 0
+            JP loop
+            IFNE V4, 0
+            HLT
+            LD V4, 1
+            LD V0, 73h  ; ADD V3, 2
+            LD V1, 02h
+            LD I, step
+            LD [I], V1
+            JP loop
+        """.splitlines())
+
+        def main(watchdog):
+            chip8 = Chip8(None, IoJitted())
+            chip8.ram.load_bin(code)
+            chip8.run(watchdog)
+            return intmask(chip8.cpu.general_registers[2])
+
+        res = self.meta_interp(main, [2**30], backendopt=True, inline=True)
+        assert res == (256 + 128) & 0xFF
+
 
 def _apptest_unique_file(LAST=[0]):
     from rpython.tool.udir import udir
@@ -617,18 +1906,195 @@ def _apptest_unique_file(LAST=[0]):
 
 
 class AppTestChip8(TestChip8):
+    # how get_chip8 talks to the emulator; subclasses only change these
+    encoding = ENCODING_TEXT
+    framebuffer = False
+    server = False
+
     def get_chip8(self, code):
-        from emulator.chip8 import Chip8_Rpc, Io
+        import os
+        import time
+        from emulator.chip8 import Chip8_Rpc
+        from emulator.io.session import connect
         from emulator.io.stdio import StdioTest
 
         path = _apptest_unique_file()
         path.write_binary(code)
 
+        if self.server:
+            socket_path = str(path) + '.sock'
+            proc = subprocess.Popen([option.apptest, '--server', socket_path],
+                                    executable=option.apptest)
+            while not os.path.exists(socket_path):
+                assert proc.poll() is None
+                time.sleep(0.01)
+            connection = connect(socket_path)
+            # another session on the same connection must not interfere
+            other = Chip8_Rpc(connection.open(2), IoTest())
+            assert other.initialize(str(path), self.encoding)
+            pipe = connection.open(1)
+        else:
+            proc = subprocess.Popen([option.apptest], executable=option.apptest,
+                                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            pipe = StdioTest(proc.stdout, proc.stdin)
+        chip8 = Chip8_Rpc(pipe, IoTest())
+        assert chip8.initialize(str(path), self.encoding)
+        if self.framebuffer:
+            assert chip8.attach_framebuffer(str(path) + '.fb')
+        yield chip8
+        assert chip8.io.events == chip8.io.events_expected
+        chip8.quit()
+        if self.server:
+            other.quit()
+            connection.close()
+            proc.kill()
+            proc.wait()
+            os.remove(socket_path)
+        else:
+            assert proc.wait() == 0
+
+
+class AppTestChip8Binary(AppTestChip8):
+    encoding = ENCODING_BINARY
+
+
+class AppTestChip8Framebuffer(AppTestChip8):
+    encoding = ENCODING_BINARY
+    framebuffer = True
+
+
+class AppTestChip8Server(AppTestChip8):
+    # sessions are always binary, no encoding is negotiated
+    server = True
+
+
+class AppTestSnapshot:
+    def test_snapshot_restore(self, program):
+        """
+            LD V1, 40
+            LD DT, V1
+        loop:
+            RND V0, 0x3F
+            LD F, V2
+            DRW V0, V2, 5
+            ADD V2, 1
+            LD I, 0x300
+            LD [I], V2
+            LD V3, DT
+            SE V3, 0
+            JP loop
+        stop:
+            JP stop
+        """
+        from emulator.chip8 import Chip8_Rpc
+        from emulator.io.stdio import StdioTest
+
+        path = _apptest_unique_file()
+        path.write_binary(program)
         proc = subprocess.Popen([option.apptest], executable=option.apptest,
                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE)
         chip8 = Chip8_Rpc(StdioTest(proc.stdout, proc.stdin), IoTest())
-        assert chip8.initialize(str(path))
-        yield chip8
-        assert chip8.io.events == chip8.io.events_expected
+        assert chip8.initialize(str(path), ENCODING_BINARY)
+        chip8.run(100000)
+        saved = chip8.snapshot()
+        chip8.run(1000000)
+        assert chip8.paused
+        expected = (chip8.cpu.general_registers, chip8.display.data[:])
+        chip8.restore(saved)
+        assert not chip8.paused
+        chip8.run(1000000)
+        assert (chip8.cpu.general_registers, chip8.display.data) == expected
+        assert chip8.snapshot() != saved
+        assert chip8.errors == 0
         chip8.quit()
         assert proc.wait() == 0
+
+
+class AppTestRecord:
+    """
+    loop:
+        RND V0, 0x3F
+        SKNP V1
+        ADD V2, V0
+        ADD V1, 1
+        LD V4, 0xF
+        AND V1, V4
+        JP loop
+    """
+
+    def record(self, program, log, stop, encoding=ENCODING_BINARY):
+        from emulator.chip8 import Chip8_Rpc
+        from emulator.io.stdio import StdioTest
+
+        path = _apptest_unique_file()
+        path.write_binary(program)
+        proc = subprocess.Popen([option.apptest], executable=option.apptest,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        chip8 = Chip8_Rpc(StdioTest(proc.stdout, proc.stdin), IoTest())
+        assert chip8.initialize(str(path), encoding)
+        chip8.run(20000)
+        chip8.record(log)
+        for i in range(10):
+            chip8.keys = uint16_t(1 << i)
+            chip8.run(10000)
+        assert chip8.errors == 0
+        stop(chip8, proc)
+        assert proc.wait() == 0
+        return chip8
+
+    def check_replay(self, log, chip8):
+        from emulator.chip8 import Chip8_Rpc
+        from emulator.io.stdio import StdioTest
+
+        proc = subprocess.Popen([option.apptest, '--replay', log],
+                                executable=option.apptest,
+                                stdout=subprocess.PIPE)
+        replayed = Chip8_Rpc(StdioTest(proc.stdout, None), IoTest())
+        for i in range(2):
+            msg = replayed.pipe.get()
+            assert replayed.DISPATCH.dispatch(replayed, msg)
+        assert proc.wait() == 0
+        assert replayed.cpu.program_counter == chip8.cpu.program_counter
+        assert replayed.cpu.general_registers == chip8.cpu.general_registers
+        assert replayed.display.data == chip8.display.data
+
+    def test_record_replay(self, program):
+        """
+        loop:
+            RND V0, 0x3F
+            SKNP V1
+            ADD V2, V0
+            ADD V1, 1
+            LD V4, 0xF
+            AND V1, V4
+            ADD V6, 1
+            AND V6, V4
+            SE V6, 0
+            JP loop
+            LD V5, K
+            ADD V7, V5
+            LD F, V5
+            DRW V0, V2, 5
+            JP loop
+        """
+        log = str(_apptest_unique_file()) + '.log'
+
+        def stop(chip8, proc):
+            chip8.stop_recording()
+            chip8.quit()
+        # in the default encoding
+        self.check_replay(log, self.record(program, log, stop, ENCODING_TEXT))
+
+    def test_quit_while_recording(self, program):
+        log = str(_apptest_unique_file()) + '.log'
+
+        def stop(chip8, proc):
+            chip8.quit()
+        self.check_replay(log, self.record(program, log, stop))
+
+    def test_eof_while_recording(self, program):
+        log = str(_apptest_unique_file()) + '.log'
+
+        def stop(chip8, proc):
+            proc.stdin.close()
+        self.check_replay(log, self.record(program, log, stop))
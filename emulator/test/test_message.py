@@ -0,0 +1,336 @@
+import os
+import socket
+
+from emulator.io.message import *
+from emulator.io.session import Connection
+from emulator.io.stdio import Stdio, ENCODING_BINARY, frame_header
+from emulator.types import uint8_t, uint16_t, uint32_t, uint64_t
+
+
+class Buffer:
+    def __init__(self, data=''):
+        self.data = data
+        self.pos = 0
+        self.flushes = 0
+
+    def write(self, s):
+        self.data += s
+
+    def flush(self):
+        self.flushes += 1
+
+
+
+def reader(data):
+    r, w = os.pipe()
+    os.write(w, data)
+    os.close(w)
+    return os.fdopen(r, 'rb')
+
+
+def make_display():
+    class Display:
+        width = 64
+        height = 32
+        data = [uint64_t(i * 0x0123456789ABCDEF) for i in range(32)]
+    return M_Display(Display())
+
+
+def make_cpu():
+    msg = instantiate(M_Cpu)
+    msg.cpu__program_counter = uint16_t(0x234)
+    msg.cpu__stack_pointer = uint16_t(0xEA0)
+    msg.cpu__index_register = uint16_t(0xFFF)
+    msg.cpu__general_registers = [uint8_t(i * 17) for i in range(16)]
+    msg.paused = True
+    msg.errors = uint32_t(3)
+    msg.waiting = True
+    return msg
+
+
+class TestMessage:
+    def roundtrip(self, msg):
+        text = unserialize(msg.serialize())
+        binary = unserialize_binary(msg.serialize_binary())
+        assert type(text) is type(msg)
+        assert type(binary) is type(msg)
+        assert text.serialize() == msg.serialize()
+        assert binary.serialize() == msg.serialize()
+        return binary
+
+    def test_version(self):
+        msg = self.roundtrip(M_Version('1.2.3', ['text', 'binary']))
+        assert msg.version == '1.2.3'
+        assert msg.encodings == ['text', 'binary']
+
+    def test_display(self):
+        msg = self.roundtrip(make_display())
+        assert msg.width == 64
+        assert msg.data[31] == uint64_t(31 * 0x0123456789ABCDEF)
+
+    def test_display_delta(self):
+        display = make_display()
+        msg = self.roundtrip(M_DisplayDelta(display, [1, 30]))
+        assert msg.rows == [1, 30]
+        assert msg.data == [display.data[1], display.data[30]]
+        empty = M_DisplayDelta(display, [])
+        assert len(empty.serialize_binary()) == 1 + 4 + 4
+
+    def test_display_size(self):
+        msg = make_display()
+        assert len(msg.serialize_binary()) == 1 + 2 + 2 + 4 + 32 * 8
+
+    def test_cpu(self):
+        msg = self.roundtrip(make_cpu())
+        assert msg.cpu__general_registers[15] == 0xFF
+        assert msg.paused
+        assert msg.waiting
+
+    def test_run(self):
+        msg = self.roundtrip(C_Run(0x123456789))
+        assert msg.watchdog == 0x123456789
+
+    def test_run_report(self):
+        msg = self.roundtrip(C_RunReport(16000, 0x8001))
+        assert msg.watchdog == 16000
+        assert msg.keys == 0x8001
+
+    def test_keys(self):
+        msg = self.roundtrip(C_Keys(0x1234))
+        assert msg.keys == 0x1234
+
+    def test_profile(self):
+        from emulator.profile import Profile
+        profile = Profile()
+        profile.record(0x8004, 0x202, 200)
+        profile.record(0x8004, 0x202, 200)
+        profile.record(0xF01E, 0x204, 86)
+        msg = self.roundtrip(M_Profile(profile))
+        assert msg.opcodes == [0x8004, 0xF01E]
+        assert msg.counts == [2, 1]
+        assert msg.cycles == [400, 86]
+        assert msg.pcs == [0x202, 0x204]
+        assert msg.pc_counts == [2, 1]
+
+    def test_snapshot(self):
+        data = ''.join(chr(i) for i in range(256))
+        msg = self.roundtrip(M_Snapshot(data))
+        assert msg.data == data
+        assert unserialize(M_Snapshot(data).serialize()).data == data
+        assert self.roundtrip(C_Restore(data)).data == data
+
+    def test_rewind(self):
+        msg = self.roundtrip(C_Rewind(uint32_t(10), uint32_t(1 << 20)))
+        assert msg.seconds == 10
+        assert msg.max_bytes == 1 << 20
+
+    def test_timer_period(self):
+        assert self.roundtrip(C_TimerPeriod(uint32_t(33333))).period == 33333
+
+    def test_record(self):
+        msg = self.roundtrip(C_Record('/tmp/session.log'))
+        assert msg.path == '/tmp/session.log'
+        self.roundtrip(C_StopRecording())
+
+    def test_framebuffer(self):
+        msg = self.roundtrip(C_Framebuffer('/dev/shm/chip8.fb'))
+        assert msg.path == '/dev/shm/chip8.fb'
+
+    def test_empty(self):
+        self.roundtrip(Q_NextCommand())
+        self.roundtrip(C_Encoding('binary'))
+
+    def test_binary_malformed(self):
+        data = make_cpu().serialize_binary()
+        assert unserialize_binary(data[:-1]) is None
+        assert unserialize_binary(data + '\x00') is None
+        assert unserialize_binary('\xFF') is None
+        # a gap between the ids of two kinds
+        assert unserialize_binary('\x41') is None
+        assert unserialize_binary('') is None
+
+    def test_binary_ids(self):
+        # the wire format, these must not change
+        assert M_Version._ID == 0x00
+        assert M_Sync._ID == 0x06
+        assert Q_NextCommand._ID == 0x40
+        assert C_Die._ID == 0x80
+        assert C_RunReport._ID == 0x83
+        assert C_Cpu._ID == 0x92
+
+
+class TestStdio:
+    def test_binary(self):
+        o = Buffer()
+        pipe = Stdio(None, o)
+        assert pipe.set_encoding(ENCODING_BINARY)
+        pipe.tell(M_Sync(0x1234))
+        pipe.flush()
+        data = M_Sync(0x1234).serialize_binary()
+        assert o.data == frame_header(len(data)) + data
+
+        pipe = Stdio(reader(o.data + o.data), None)
+        pipe.set_encoding(ENCODING_BINARY)
+        assert pipe.get().time == 0x1234
+        assert pipe.get().time == 0x1234
+        assert pipe.get() is None
+
+    def test_switch(self):
+        o = Buffer()
+        pipe = Stdio(None, o)
+        pipe.tell(C_Encoding(ENCODING_BINARY))
+        pipe.set_encoding(ENCODING_BINARY)
+        pipe.tell(Q_NextCommand())
+        pipe.flush()
+
+        pipe = Stdio(reader(o.data), None)
+        msg = pipe.get()
+        assert isinstance(msg, C_Encoding)
+        assert pipe.set_encoding(msg.encoding)
+        assert isinstance(pipe.get(), Q_NextCommand)
+
+    def test_unknown_encoding(self):
+        pipe = Stdio(None, None)
+        assert not pipe.set_encoding('morse')
+        assert not pipe.binary
+
+    def test_buffered_until_read(self):
+        o = Buffer()
+        pipe = Stdio(reader('?\n'), o)
+        pipe.tell(M_Sound(True))
+        pipe.tell(M_Sync(1))
+        assert o.data == ''
+        assert isinstance(pipe.get(), Q_NextCommand)
+        assert o.data == 'snd 1\n@ 00000001\n'
+        assert o.flushes == 1
+
+    def test_buffer_limit(self):
+        o = Buffer()
+        pipe = Stdio(None, o)
+        while o.flushes == 0:
+            pipe.tell(C_Load('x' * 100))
+        assert len(o.data) >= pipe.BUFFER_SIZE
+        assert pipe.pending == []
+
+    def test_sync_coalesced(self):
+        o = Buffer()
+        pipe = Stdio(None, o)
+        pipe.tell(M_Sync(1))
+        pipe.tell(M_Sync(2))
+        pipe.tell(M_Sound(True))
+        pipe.tell(M_Sync(3))
+        pipe.tell(M_Sync(4))
+        pipe.flush()
+        pipe.tell(M_Sync(5))
+        pipe.flush()
+        assert o.data == ('@ 00000002\nsnd 1\n@ 00000004\n'
+                          '@ 00000005\n')
+
+    def test_messages(self):
+        data = ''.join(M_Sync(i).serialize() + '\n' for i in range(1000))
+        data += 'bad\n?\n@ 0000'
+        pipe = Stdio(reader(data), None)
+        pipe.READ_SIZE = 1000
+        msgs = list(pipe.messages())
+        assert [msg.time for msg in msgs[:1000]] == range(1000)
+        assert msgs[1000] is None
+        assert isinstance(msgs[1001], Q_NextCommand)
+        # the incomplete message at EOF is not decoded
+        assert len(msgs) == 1002
+
+    def test_messages_binary(self):
+        o = Buffer()
+        pipe = Stdio(None, o)
+        pipe.set_encoding(ENCODING_BINARY)
+        for i in range(1000):
+            pipe.tell(C_Keys(i))
+        pipe.tell(Q_NextCommand())
+        pipe.flush()
+        pipe = Stdio(reader(o.data), None)
+        pipe.set_encoding(ENCODING_BINARY)
+        pipe.READ_SIZE = 1001
+        keys = []
+        for msg in pipe.messages():
+            if isinstance(msg, Q_NextCommand):
+                break
+            keys.append(msg.keys)
+        assert keys == range(1000)
+        assert pipe.get() is None
+
+
+def connection_pair():
+    a, b = socket.socketpair()
+    server = Connection(os.dup(a.fileno()), accept=True)
+    client = Connection(os.dup(b.fileno()))
+    a.close()
+    b.close()
+    return server, client
+
+
+class TestSession:
+    def test_open(self):
+        server, client = connection_pair()
+        client.open(7)
+        client.open(3)
+        assert server.receive()
+        opened = server.take_opened()
+        assert sorted(pipe.id for pipe in opened) == [3, 7]
+        assert server.take_opened() == []
+        assert not any(pipe.ready() for pipe in opened)
+
+    def test_demultiplex(self):
+        server, client = connection_pair()
+        one = client.open(1)
+        two = client.open(2)
+        one.tell(C_Cpu())
+        two.tell(C_Keys(uint16_t(0x10)))
+        two.tell(C_Step())
+        client.flush()
+        server.receive()
+        s1, s2 = sorted(server.take_opened(), key=lambda pipe: pipe.id)
+        assert isinstance(s1.read(), C_Cpu)
+        assert not s1.ready()
+        assert s2.read().keys == 0x10
+        assert isinstance(s2.read(), C_Step)
+
+    def test_reply(self):
+        server, client = connection_pair()
+        one = client.open(1)
+        two = client.open(2)
+        client.flush()
+        server.receive()
+        s1, s2 = sorted(server.take_opened(), key=lambda pipe: pipe.id)
+        s2.tell(M_Sync(uint64_t(2)))
+        s1.tell(M_Sync(uint64_t(1)))
+        s1.tell(M_Sync(uint64_t(3)))
+        server.flush()
+        # reading one session keeps the messages for the other
+        assert one.get().time == 3
+        assert two.get().time == 2
+
+    def test_binary_only(self):
+        server, client = connection_pair()
+        pipe = client.open(1)
+        assert pipe.set_encoding(ENCODING_BINARY)
+        assert not pipe.set_encoding('text')
+
+    def test_open_with_message(self):
+        from emulator.io.session import session_header
+        server, client = connection_pair()
+        data = C_Cpu().serialize_binary()
+        client.send(session_header(5) + frame_header(len(data)) + data)
+        client.open(6)
+        assert server.receive()
+        # the message is not dropped quietly, the connection is given up
+        assert server.eof
+        assert server.take_opened() == []
+        assert not server.receive()
+
+    def test_eof(self):
+        server, client = connection_pair()
+        pipe = client.open(1)
+        client.close()
+        assert server.receive()
+        assert len(server.take_opened()) == 1
+        assert not server.receive()
+        assert server.eof
@@ -1,14 +1,22 @@
+import os
+import struct
 import subprocess
+import tempfile
 from array import array
 from math import pi, sin
 
 import pygame
-from PIL import Image, ImageEnhance
+from PIL import Image, ImageChops
 
-from emulator.chip8 import Chip8_Rpc, Io
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from emulator.chip8 import Chip8_Rpc, Io, TIMER_PERIOD
 from emulator.error import errorstream
-from emulator.io.stdio import Stdio, StdioTest
-from emulator.types import uint64_t, uint8_t
+from emulator.io.stdio import Stdio, StdioTest, ENCODING_BINARY
+from emulator.types import uint16_t
 
 speed_factor = 1
 crt_factor = 0.7
@@ -31,30 +39,66 @@ keypad = [keymap[13], keymap[0], keymap[1], keymap[2],
           keymap[3], keymap[7], keymap[11], keymap[15]]
 
 
+# brightness of a pixel one frame later, lit pixels fade out like on a CRT
+FADE = [int(level * crt_factor) for level in xrange(256)]
+if numpy is not None:
+    FADE_LEVELS = numpy.array(FADE, dtype=numpy.uint8)
+
+# the 8 pixels of a byte of a display row, 255 where the bit is set
+BYTE_PIXELS = [''.join(['\xff' if byte & (0x80 >> i) else '\0'
+                        for i in xrange(8)])
+               for byte in xrange(256)]
+
+
 class Screen:
+    """Converts the display into `surface`, with whole rows at a time."""
+
     def __init__(self):
-        self.im = Image.new("RGBA", (1, 1))
+        self.size = None
+        self.surface = None
+        # brightness of every pixel
+        self.levels = None
 
     def update(self, display):
         size = display.width, display.height
-        if self.im.size != size:
-            self.im = Image.new("RGBA", size)
-        self.im = ImageEnhance.Brightness(self.im).enhance(crt_factor)
-        # This loop is fine on PyPy, avoid CPython if possible
-        for y in xrange(display.height):
-            x = 0
-            j = uint64_t(1) << (display.width - 1)
-            while j:
-                if j & display.data[y]:
-                    self.im.putpixel((x, y), (255, 255, 255, 255))
-                j >>= 1
-                x += 1
+        if self.size != size:
+            self.size = size
+            self.surface = pygame.Surface(size, depth=24)
+            self.levels = None
+        if numpy is not None:
+            self.update_numpy(display)
+        else:
+            self.update_lut(display)
+
+    def update_numpy(self, display):
+        if self.levels is None:
+            self.levels = numpy.zeros(self.size, dtype=numpy.uint8)
+        rows = numpy.array([long(row) for row in display.data], dtype='>u8')
+        pixels = numpy.unpackbits(rows.view(numpy.uint8))
+        # surfarray indexes by x, then y
+        lit = pixels.reshape(display.height, 64)[:, 64 - display.width:].T
+        self.levels = FADE_LEVELS[self.levels]
+        self.levels[lit != 0] = 255
+        pygame.surfarray.blit_array(self.surface,
+                                    numpy.dstack([self.levels] * 3))
+
+    def update_lut(self, display):
+        if self.levels is None:
+            self.levels = Image.new("L", self.size)
+        rows = [''.join([BYTE_PIXELS[ord(c)]
+                         for c in struct.pack('>Q', long(row))])
+                for row in display.data]
+        start = 64 - display.width
+        lit = Image.frombytes("L", self.size,
+                              ''.join([row[start:] for row in rows]))
+        self.levels = ImageChops.lighter(self.levels.point(FADE), lit)
+        self.surface = pygame.image.frombuffer(
+            self.levels.convert("RGB").tobytes(), self.size, "RGB")
 
 
 class Io_Impl(Io):
     def __init__(self):
         self.sound = create_sound()
-        self.delay = 0L
         self.last = 0L
         self.offset = 0L
 
@@ -74,36 +118,20 @@ class Io_Impl(Io):
             print "cpu is %d ms behind" % (-ahead)
             self.offset += ahead
 
-    def is_key_down(self, key):
-        return pygame.key.get_pressed()[keypad[key]]
-
-    def next_key(self):
-        print "waiting for key..."
-        for event in pygame.event.get(pygame.KEYDOWN):
-            pass
-        while True:
-            for event in pygame.event.get(pygame.KEYDOWN):
-                # print event
-                try:
-                    i = keypad.index(event.key)
-                except ValueError:
-                    pass
-                else:
-                    return uint8_t(i)
-
-    def set_sound(self, delay):
-        self.sound.stop()
-        self.sound.play(loops=-1, maxtime=long(delay) * ms_per_frame)
-
-    def set_delay(self, delay):
-        self.delay = self.last + long(delay) * cycles_per_frame
-
-    def get_delay(self):
-        diff = self.delay - self.last
-        if diff <= 0:
-            return uint8_t(0)
-        diff = diff / cycles_per_frame
-        return uint8_t(min(diff, 255))
+    def set_sound(self, on):
+        if on:
+            self.sound.play(loops=-1)
+        else:
+            self.sound.stop()
+
+
+def keypad_state():
+    pressed = pygame.key.get_pressed()
+    keys = 0
+    for i, key in enumerate(keypad):
+        if pressed[key]:
+            keys |= 1 << i
+    return uint16_t(keys)
 
 
 def create_sound():
@@ -128,7 +156,14 @@ def main(argv):
                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     pipe = Stdio(proc.stdout, proc.stdin)
     chip8 = Chip8_Rpc(pipe, Io_Impl())
-    chip8.initialize(argv[1])
+    chip8.initialize(argv[1], ENCODING_BINARY)
+    # the timers count at 60 Hz of real time, whatever the speed
+    chip8.set_timer_period(int(TIMER_PERIOD * speed_factor))
+    # read the display from shared memory, falls back to the pipe; the file
+    # is created here so that no other user can plant it first
+    fd, framebuffer = tempfile.mkstemp(prefix='chip8-', suffix='.fb')
+    os.close(fd)
+    chip8.attach_framebuffer(framebuffer)
 
     # ticks = pygame.time.get_ticks()
 
@@ -138,16 +173,18 @@ def main(argv):
             if event.type == pygame.QUIT:
                 chip8.quit()
                 pygame.quit()
+                if os.path.exists(framebuffer):
+                    os.remove(framebuffer)
                 return 0
 
         if not chip8.paused:
             # print "game loop took %d ms" % (pygame.time.get_ticks() - ticks)
+            chip8.keys = keypad_state()
             chip8.run(cycles_per_frame)
             # ticks = pygame.time.get_ticks()
             screen.update(chip8.display)
 
-            im = pygame.image.frombuffer(screen.im.tobytes(), screen.im.size, "RGBA")
-            pygame.transform.scale(im, window.get_size(), window)
+            pygame.transform.scale(screen.surface, window.get_size(), window)
             pygame.display.flip()
 
 